@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.utils.html import format_html
-from .models import Category, Product, ProductReview, Wishlist, ProductView
+from .models import Category, Product, ProductReview, Wishlist, ProductView, ProductViewRollup, StockMovement, WebhookEvent
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -57,3 +57,43 @@ class ProductViewAdmin(admin.ModelAdmin):
     list_filter = ('viewed_at',)
     search_fields = ('product__name', 'user__email', 'ip_address')
     readonly_fields = ('viewed_at',)
+    list_select_related = ('product', 'user')
+    raw_id_fields = ('product', 'user')
+    # Newest first by primary key, and no exact count of a very large table
+    ordering = ('-id',)
+    show_full_result_count = False
+
+@admin.register(ProductViewRollup)
+class ProductViewRollupAdmin(admin.ModelAdmin):
+    list_display = ('product', 'granularity', 'period', 'views')
+    list_filter = ('granularity', 'period')
+    search_fields = ('product__name',)
+    list_select_related = ('product',)
+    ordering = ('-period', '-views')
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'type', 'status', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('status', 'type', 'received_at')
+    search_fields = ('event_id',)
+    readonly_fields = ('event_id', 'type', 'payload', 'attempts', 'error', 'received_at', 'processed_at')
+
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ('product', 'kind', 'quantity', 'order', 'note', 'created_at')
+    list_filter = ('kind', 'created_at')
+    search_fields = ('product__name', 'note')
+    raw_id_fields = ('product', 'order')
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,341 @@
+"""
+Cache backends shared between worker processes on the same host.
+
+SQLiteCache keeps entries in a WAL-mode SQLite file, so every gunicorn worker
+sees the same cache, the same throttle counters and the same tag generations.
+TieredCache puts a small in-process LRU in front of it for hot keys.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS cache ('
+    'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL, '
+    'accessed REAL NOT NULL, size INTEGER NOT NULL) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)',
+    'CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)',
+)
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+class SQLiteCache(BaseCache):
+    """
+    Size bounded, approximately LRU cache in a SQLite file.
+
+    LOCATION is the database path. OPTIONS:
+        MAX_ENTRIES     entry limit (default 300, as for every Django backend)
+        MAX_SIZE        byte limit for stored values, 0 for no limit
+        CULL_FREQUENCY  1/n of the entries is evicted when a limit is hit
+        CHECK_EVERY     writes between limit checks (default 100)
+        ACCESS_RESOLUTION  seconds; a read only refreshes the LRU clock of an
+                        entry last touched longer ago than this (default 1)
+        BUSY_TIMEOUT    seconds to wait for the write lock (default 5)
+    """
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._path = location
+        self._max_size = int(options.get('MAX_SIZE', 0))
+        self._check_every = int(options.get('CHECK_EVERY', 100))
+        self._access_resolution = float(options.get('ACCESS_RESOLUTION', 1))
+        self._busy_timeout = float(options.get('BUSY_TIMEOUT', 5))
+        self._local = threading.local()
+        self._writes = 0
+
+    @property
+    def _db(self):
+        # One connection per thread, reopened after a fork
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(
+                self._path, timeout=self._busy_timeout,
+                isolation_level=None, check_same_thread=False
+            )
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                db.execute(statement)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _encode(self, value):
+        # Plain ints are stored natively so incr() can run inside SQLite
+        if type(value) is int and INT64_MIN <= value <= INT64_MAX:
+            return value
+        return pickle.dumps(value, self.pickle_protocol)
+
+    def _decode(self, value):
+        if isinstance(value, int):
+            return value
+        return pickle.loads(value)
+
+    def _size(self, value):
+        return 8 if isinstance(value, int) else len(value)
+
+    def _write(self, sql, params):
+        db = self._db
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = db.execute(sql, params)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        self._writes += 1
+        if self._writes >= self._check_every:
+            self._writes = 0
+            self._cull(now)
+        return cursor.rowcount
+
+    def _cull(self, now):
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+            count, size = db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache'
+            ).fetchone()
+            over_size = self._max_size and size > self._max_size
+            if count > self._max_entries or over_size:
+                if self._cull_frequency == 0:
+                    db.execute('DELETE FROM cache')
+                else:
+                    db.execute(
+                        'DELETE FROM cache WHERE key IN ('
+                        'SELECT key FROM cache ORDER BY accessed LIMIT ?)',
+                        (max(count // self._cull_frequency, count - self._max_entries),)
+                    )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        value = self._encode(value)
+        now = time.time()
+        return bool(self._write(
+            'INSERT INTO cache (key, value, expires, accessed, size) '
+            'VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value, '
+            'expires = excluded.expires, accessed = excluded.accessed, '
+            'size = excluded.size '
+            'WHERE cache.expires IS NOT NULL AND cache.expires <= excluded.accessed',
+            (key, value, self.get_backend_timeout(timeout), now, self._size(value))
+        ))
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        now = time.time()
+        row = self._db.execute(
+            'SELECT value, accessed FROM cache '
+            'WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, now)
+        ).fetchone()
+        if row is None:
+            return default
+        if now - row[1] > self._access_resolution:
+            self._db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        return self._decode(row[0])
+
+    def get_many(self, keys, version=None):
+        mapping = {
+            self.make_and_validate_key(key, version=version): key for key in keys
+        }
+        if not mapping:
+            return {}
+        now = time.time()
+        placeholders = ', '.join('?' * len(mapping))
+        rows = self._db.execute(
+            f'SELECT key, value FROM cache WHERE key IN ({placeholders}) '
+            'AND (expires IS NULL OR expires > ?)',
+            (*mapping, now)
+        ).fetchall()
+        return {mapping[key]: self._decode(value) for key, value in rows}
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        value = self._encode(value)
+        self._write(
+            'INSERT OR REPLACE INTO cache (key, value, expires, accessed, size) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (key, value, self.get_backend_timeout(timeout), time.time(), self._size(value))
+        )
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        now = time.time()
+        return bool(self._write(
+            'UPDATE cache SET expires = ?, accessed = ? '
+            'WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (self.get_backend_timeout(timeout), now, key, now)
+        ))
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        db = self._db
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                'SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)',
+                (key, now)
+            ).fetchone()
+            if row is None:
+                raise ValueError("Key '%s' not found" % key)
+            if isinstance(row[0], int):
+                new_value = row[0] + delta
+            else:
+                new_value = self._decode(row[0]) + delta
+            value = self._encode(new_value)
+            db.execute(
+                'UPDATE cache SET value = ?, accessed = ?, size = ? WHERE key = ?',
+                (value, now, self._size(value), key)
+            )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return new_value
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._db.execute(
+            'SELECT 1 FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time.time())
+        ).fetchone() is not None
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return bool(self._write('DELETE FROM cache WHERE key = ?', (key,)))
+
+    def delete_many(self, keys, version=None):
+        keys = [self.make_and_validate_key(key, version=version) for key in keys]
+        if keys:
+            placeholders = ', '.join('?' * len(keys))
+            self._write(f'DELETE FROM cache WHERE key IN ({placeholders})', keys)
+
+    def clear(self):
+        self._write('DELETE FROM cache', ())
+
+    def close(self, **kwargs):
+        # Connections are kept for the life of the thread
+        pass
+
+
+class TieredCache(SQLiteCache):
+    """
+    SQLiteCache with a small in-process LRU in front of it.
+
+    Entries are served from the front tier for at most LOCAL_TIMEOUT seconds
+    (default 2) before being re-read from the shared file, which bounds how
+    long another process's write can go unseen. LOCAL_MAX_ENTRIES (default
+    1000) caps the front tier. Counters updated with incr() always go to the
+    shared tier.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(location, params)
+        options = params.get('OPTIONS', {})
+        self._local_timeout = float(options.get('LOCAL_TIMEOUT', 2))
+        self._local_max_entries = int(options.get('LOCAL_MAX_ENTRIES', 1000))
+        self._front = OrderedDict()
+        self._front_lock = threading.Lock()
+
+    def _front_get(self, key):
+        with self._front_lock:
+            entry = self._front.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._front[key]
+                return None
+            self._front.move_to_end(key)
+            return entry
+
+    def _front_set(self, key, value):
+        with self._front_lock:
+            self._front[key] = (time.time() + self._local_timeout, value)
+            self._front.move_to_end(key)
+            while len(self._front) > self._local_max_entries:
+                self._front.popitem(last=False)
+
+    def _front_discard(self, key):
+        with self._front_lock:
+            self._front.pop(key, None)
+
+    def get(self, key, default=None, version=None):
+        local_key = self.make_and_validate_key(key, version=version)
+        entry = self._front_get(local_key)
+        if entry is not None:
+            return pickle.loads(entry[1])
+        sentinel = object()
+        value = super().get(key, sentinel, version=version)
+        if value is sentinel:
+            return default
+        self._front_set(local_key, pickle.dumps(value, self.pickle_protocol))
+        return value
+
+    def get_many(self, keys, version=None):
+        found = {}
+        missing = []
+        for key in keys:
+            entry = self._front_get(self.make_and_validate_key(key, version=version))
+            if entry is not None:
+                found[key] = pickle.loads(entry[1])
+            else:
+                missing.append(key)
+        for key, value in super().get_many(missing, version=version).items():
+            self._front_set(
+                self.make_and_validate_key(key, version=version),
+                pickle.dumps(value, self.pickle_protocol)
+            )
+            found[key] = value
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        super().set(key, value, timeout, version=version)
+        if timeout != 0:
+            self._front_set(
+                self.make_and_validate_key(key, version=version),
+                pickle.dumps(value, self.pickle_protocol)
+            )
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._front_discard(self.make_and_validate_key(key, version=version))
+        return super().add(key, value, timeout, version=version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        self._front_discard(self.make_and_validate_key(key, version=version))
+        return super().touch(key, timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        self._front_discard(self.make_and_validate_key(key, version=version))
+        return super().incr(key, delta, version=version)
+
+    def delete(self, key, version=None):
+        self._front_discard(self.make_and_validate_key(key, version=version))
+        return super().delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self._front_discard(self.make_and_validate_key(key, version=version))
+        super().delete_many(keys, version=version)
+
+    def clear(self):
+        with self._front_lock:
+            self._front.clear()
+        super().clear()
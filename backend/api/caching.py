@@ -0,0 +1,228 @@
+"""
+Response cache with tag-based invalidation.
+
+Every cached response records the generation of each tag it depends on.
+Writes bump the generation of the affected tags, which makes every entry
+that recorded an older generation stale without scanning or deleting keys.
+
+Generations are nanosecond clock readings: a bump moves the generation to
+at least the current time. A response whose tags are all older than the
+moment its handler started cannot have missed a write, and one that is not
+is returned without being stored.
+"""
+import hashlib
+import time
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+CATALOG = 'catalog'
+CATEGORIES = 'categories'
+FACETS = 'facets'
+ANALYTICS = 'analytics'
+VIEWS = 'views'
+BESTSELLERS = 'bestsellers'
+RECOMMENDATIONS = 'recommendations'
+
+TAG_KEY_PREFIX = 'tag'
+RESPONSE_KEY_PREFIX = 'response'
+CHANGES_KEY_PREFIX = 'changes'
+
+# Entries of a change log are kept this long; a reader further behind starts over
+CHANGE_LOG_TIMEOUT = 60 * 60
+CHANGE_LOG_LIMIT = 1000
+
+
+def product_tag(product_id):
+    return f'product:{product_id}'
+
+
+def category_tag(category_id):
+    return f'category:{category_id}'
+
+
+def _tag_key(tag):
+    return f'{TAG_KEY_PREFIX}:{tag}'
+
+
+def get_tag_versions(tags, seeded=None):
+    """
+    Current generation of each tag, creating missing ones
+    seeded: optional set, gets the tags this call created
+    """
+    keys = {_tag_key(tag): tag for tag in tags}
+    found = cache.get_many(list(keys))
+    versions = {}
+    for key, tag in keys.items():
+        if key not in found:
+            # Seed from the clock so an evicted tag never reuses an old generation
+            if cache.add(key, time.time_ns(), timeout=None) and seeded is not None:
+                seeded.add(tag)
+            found[key] = cache.get(key)
+        versions[tag] = found[key]
+    return versions
+
+
+def bump_tags(tags):
+    for tag in tags:
+        key = _tag_key(tag)
+        now = time.time_ns()
+        current = cache.get(key)
+        try:
+            # incr keeps concurrent bumps from losing each other; the delta
+            # only has to bring the generation up to the clock
+            cache.incr(key, max(now - current, 1) if current is not None else 1)
+        except ValueError:
+            cache.add(key, now, timeout=None)
+
+
+def invalidate(*tags):
+    """Invalidate every cached response depending on any of the tags once the
+    current transaction commits"""
+    tags = set(tags)
+    if tags:
+        transaction.on_commit(lambda: bump_tags(tags))
+
+
+def invalidate_products(product_ids, category_ids=()):
+    invalidate(
+        CATALOG,
+        *(product_tag(pk) for pk in product_ids),
+        *(category_tag(pk) for pk in category_ids)
+    )
+
+
+def _changes_key(name):
+    return f'{CHANGES_KEY_PREFIX}:{name}'
+
+
+def current_change(name):
+    """Sequence number of the latest entry of the change log `name`"""
+    key = _changes_key(name)
+    change = cache.get(key)
+    if change is None:
+        # Seeded from the clock, like tag generations
+        cache.add(key, time.time_ns(), timeout=None)
+        change = cache.get(key)
+    return change
+
+
+def _append_changes(name, ids):
+    key = _changes_key(name)
+    try:
+        change = cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), timeout=None)
+        change = cache.incr(key)
+    cache.set(f'{key}:{change}', ids, CHANGE_LOG_TIMEOUT)
+
+
+def log_changes(name, ids):
+    """
+    Append ids to the change log `name` once the current transaction
+    commits, for in-process state that can update just those ids
+    """
+    ids = list(ids)
+    if ids:
+        transaction.on_commit(lambda: _append_changes(name, ids))
+
+
+def changes_between(name, start, end):
+    """
+    Ids logged under `name` after entry start up to entry end, or None when
+    some of those entries are gone and the reader has to start over
+    """
+    if not 0 <= end - start <= CHANGE_LOG_LIMIT:
+        return None
+    key = _changes_key(name)
+    keys = [f'{key}:{change}' for change in range(start + 1, end + 1)]
+    found = cache.get_many(keys)
+    if len(found) != len(keys):
+        return None
+    return set().union(*found.values())
+
+
+def response_cache_key(request):
+    query = '&'.join(sorted(request.META.get('QUERY_STRING', '').split('&')))
+    url = f'{request.scheme}://{request.get_host()}{request.path}?{query}'
+    digest = hashlib.sha1(url.encode()).hexdigest()
+    return f'{RESPONSE_KEY_PREFIX}:{request.method}:{digest}'
+
+
+def _conditional_headers(entry):
+    return {
+        'ETag': quote_etag(entry['etag']),
+        'Last-Modified': http_date(entry['modified']),
+    }
+
+
+def _not_modified(request, entry):
+    """Evaluate If-None-Match / If-Modified-Since against a cache entry"""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return '*' in etags or quote_etag(entry['etag']) in etags
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', '')
+    )
+    return if_modified_since is not None and int(entry['modified']) <= if_modified_since
+
+
+def cache_response(tags, timeout=None):
+    """
+    Cache the serialized data of a viewset handler and answer conditional
+    GETs from it.
+    tags: callable(view, request, data) returning the tags the response depends on
+
+    The ETag is derived from the cache key and the tag generations, and
+    Last-Modified is the time the entry was built, so a 304 is decided from
+    the cache entry alone without running the view.
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(view, request, *args, **kwargs):
+            key = response_cache_key(request)
+            entry = cache.get(key)
+            if entry is not None and get_tag_versions(entry['tags']) == entry['tags']:
+                headers = _conditional_headers(entry)
+                if _not_modified(request, entry):
+                    return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+                return Response(entry['data'], headers=headers)
+
+            started = time.time_ns()
+            response = handler(view, request, *args, **kwargs)
+            if response.status_code == 200:
+                seeded = set()
+                versions = get_tag_versions(tags(view, request, response.data), seeded)
+                # A bump would have created a missing tag, so one seeded just
+                # now was not written while the handler ran
+                if any(
+                    version >= started for tag, version in versions.items()
+                    if tag not in seeded
+                ):
+                    # A tag was bumped while the handler ran, so the data may
+                    # predate that write: don't store it under the new generation
+                    return response
+                fingerprint = key + repr(sorted(versions.items()))
+                entry = {
+                    'tags': versions,
+                    'data': response.data,
+                    'etag': hashlib.sha1(fingerprint.encode()).hexdigest(),
+                    'modified': time.time(),
+                }
+                cache.set(
+                    key, entry,
+                    settings.RESPONSE_CACHE_TIMEOUT if timeout is None else timeout
+                )
+                headers = _conditional_headers(entry)
+                if _not_modified(request, entry):
+                    return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+                for header, value in headers.items():
+                    response[header] = value
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,307 @@
+"""
+Streaming bulk import and export of the product catalog as CSV or NDJSON.
+
+Imports upsert by slug in chunks: each chunk is validated in memory, then
+written with one bulk_create and one bulk_update inside its own transaction,
+so memory and lock time stay bounded whatever the size of the feed. The
+chunk's existing rows are locked before their stock is compared, and stock is
+left alone for products that pending orders hold stock of. Exports iterate
+the catalog in chunks and yield one encoded line at a time.
+"""
+import csv
+import io
+import json
+from decimal import Decimal, InvalidOperation
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_slug
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+from .models import Category, Product, StockMovement, StockReservation
+from . import caching, images, search
+
+FORMATS = ('csv', 'ndjson')
+
+COLUMNS = (
+    'slug', 'name', 'category', 'description', 'price',
+    'size', 'stock', 'available', 'image',
+)
+
+# Product fields written by an import, in addition to updated_at
+IMPORT_FIELDS = (
+    'name', 'category_id', 'description', 'price',
+    'size', 'stock', 'available', 'image',
+)
+
+SIZES = {value for value, _ in Product._meta.get_field('size').choices}
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 't'}
+FALSE_VALUES = {'0', 'false', 'no', 'n', 'f', ''}
+
+
+class RowError(Exception):
+    pass
+
+
+class ImportResult:
+    def __init__(self, dry_run=False, max_errors=1000):
+        self.dry_run = dry_run
+        self.max_errors = max_errors
+        self.created = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors = []
+        self.warnings = []
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'error': message})
+
+    def add_warning(self, line, message):
+        if len(self.warnings) < self.max_errors:
+            self.warnings.append({'line': line, 'warning': message})
+
+    def as_dict(self):
+        return {
+            'dry_run': self.dry_run,
+            'created': self.created,
+            'updated': self.updated,
+            'error_count': self.error_count,
+            'errors': self.errors,
+            'warnings': self.warnings,
+        }
+
+
+def detect_format(filename, default='csv'):
+    if filename and filename.lower().endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return default
+
+
+def read_rows(stream, fmt):
+    """
+    Yield (line number, row dict) from a text stream.
+    Lines that cannot be parsed are yielded as (line number, RowError).
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == 'ndjson':
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, RowError(f'Invalid JSON: {e}')
+                continue
+            if not isinstance(row, dict):
+                yield line_number, RowError('Expected a JSON object')
+                continue
+            yield line_number, row
+    else:
+        raise ValueError(f'Unsupported format {fmt!r}, expected one of {FORMATS}')
+
+
+def _text(row, field, required=False, max_length=None):
+    value = row.get(field)
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise RowError(f'{field} is required')
+    if max_length and len(value) > max_length:
+        raise RowError(f'{field} is longer than {max_length} characters')
+    return value
+
+
+def _boolean(value):
+    if isinstance(value, bool):
+        return value
+    value = '' if value is None else str(value).strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise RowError(f'available must be a boolean, got {value!r}')
+
+
+def clean_row(row, categories):
+    """Validate a raw row and return the Product field values for it"""
+    slug = _text(row, 'slug', required=True, max_length=50)
+    try:
+        validate_slug(slug)
+    except ValidationError:
+        raise RowError(f'Invalid slug {slug!r}')
+    category_slug = _text(row, 'category', required=True)
+    if category_slug not in categories:
+        raise RowError(f'Unknown category {category_slug!r}')
+    try:
+        price = Decimal(_text(row, 'price', required=True))
+    except InvalidOperation:
+        raise RowError(f'Invalid price {row.get("price")!r}')
+    if not price.is_finite() or price < 0 or price.as_tuple().exponent < -2 or price >= Decimal('1e8'):
+        raise RowError(f'Invalid price {row.get("price")!r}')
+    size = _text(row, 'size')
+    if size and size not in SIZES:
+        raise RowError(f'Invalid size {size!r}')
+    try:
+        stock = int(_text(row, 'stock') or 0)
+    except ValueError:
+        raise RowError(f'Invalid stock {row.get("stock")!r}')
+    if stock < 0:
+        raise RowError(f'Invalid stock {row.get("stock")!r}')
+    return slug, {
+        'name': _text(row, 'name', required=True, max_length=255),
+        'category_id': categories[category_slug],
+        'description': _text(row, 'description'),
+        'price': price,
+        'size': size,
+        'stock': stock,
+        'available': _boolean(row.get('available', True)),
+        'image': _text(row, 'image', max_length=100),
+    }
+
+
+def _write_chunk(chunk, result):
+    """Upsert one chunk of cleaned rows: {slug: (line, values)}"""
+    with transaction.atomic():
+        # Locked, so a checkout cannot change stock between this read and the write
+        existing = Product.objects.select_for_update().filter(slug__in=list(chunk)).only(
+            'id', 'slug', *IMPORT_FIELDS
+        ).in_bulk(field_name='slug')
+        # Stock held by pending orders is already out of Product.stock and is
+        # added back if the hold is released, so an absolute count would be off
+        held = set(StockReservation.objects.filter(
+            product__in=existing.values(), status=StockReservation.STATUS_HELD
+        ).values_list('product_id', flat=True))
+        now = timezone.now()
+        to_create = []
+        to_update = []
+        # slug -> (movement kind, change) for the stock ledger
+        stock_changes = {}
+        for slug, (line, values) in chunk.items():
+            product = existing.get(slug)
+            if product is None:
+                to_create.append(Product(slug=slug, **values))
+                if values['stock']:
+                    stock_changes[slug] = (StockMovement.KIND_RESTOCK, values['stock'])
+                continue
+            if values['stock'] != product.stock:
+                if product.pk in held:
+                    result.add_warning(
+                        line, 'Stock left unchanged while pending orders hold some of it'
+                    )
+                    values = {**values, 'stock': product.stock}
+                else:
+                    stock_changes[slug] = (
+                        StockMovement.KIND_ADJUSTMENT, values['stock'] - product.stock
+                    )
+            for field, value in values.items():
+                setattr(product, field, value)
+            product.updated_at = now
+            to_update.append(product)
+
+        Product.objects.bulk_create(to_create)
+        Product.objects.bulk_update(to_update, [*IMPORT_FIELDS, 'updated_at'])
+        # Bulk writes skip model signals, so refresh the derived state here
+        products = list(
+            Product.objects.filter(slug__in=list(chunk)).select_related('category')
+        )
+        StockMovement.objects.bulk_create([
+            StockMovement(
+                product=product, kind=stock_changes[product.slug][0],
+                quantity=stock_changes[product.slug][1], note='Catalog import'
+            )
+            for product in products if product.slug in stock_changes
+        ])
+        search.index_products(products)
+        caching.invalidate_products(
+            [product.pk for product in products],
+            {product.category_id for product in products}
+        )
+        caching.log_changes(caching.FACETS, [product.pk for product in products])
+        for product in products:
+            source = product.image.name
+            if source and product.image_variants.get('source') != source:
+                transaction.on_commit(
+                    lambda pk=product.pk, source=source: images.schedule_derivatives(pk, source)
+                )
+    result.created += len(to_create)
+    result.updated += len(to_update)
+
+
+def import_products(rows, batch_size=1000, dry_run=False):
+    """Upsert products by slug from (line, row) pairs as produced by read_rows()"""
+    result = ImportResult(dry_run=dry_run)
+    categories = dict(Category.objects.values_list('slug', 'id'))
+    chunk = {}
+
+    def flush():
+        if not chunk:
+            return
+        if dry_run:
+            existing = set(
+                Product.objects.filter(slug__in=list(chunk)).values_list('slug', flat=True)
+            )
+            result.updated += len(existing)
+            result.created += len(chunk) - len(existing)
+        else:
+            try:
+                _write_chunk(chunk, result)
+            except DatabaseError as e:
+                for line, _ in chunk.values():
+                    result.add_error(line, f'Batch rolled back: {e}')
+        chunk.clear()
+
+    for line, row in rows:
+        if isinstance(row, RowError):
+            result.add_error(line, str(row))
+            continue
+        try:
+            slug, values = clean_row(row, categories)
+        except RowError as e:
+            result.add_error(line, str(e))
+            continue
+        if slug in chunk:
+            result.add_error(chunk[slug][0], f'Duplicate slug {slug!r}, superseded by line {line}')
+        chunk[slug] = (line, values)
+        if len(chunk) >= batch_size:
+            flush()
+    flush()
+    return result
+
+
+def export_rows(queryset=None, chunk_size=2000):
+    queryset = Product.objects.all() if queryset is None else queryset
+    fields = [
+        'slug', 'name', 'category__slug', 'description', 'price',
+        'size', 'stock', 'available', 'image',
+    ]
+    for values in queryset.order_by('id').values_list(*fields).iterator(chunk_size=chunk_size):
+        yield dict(zip(COLUMNS, values))
+
+
+def export_lines(fmt, queryset=None, chunk_size=2000):
+    """Yield the catalog encoded as CSV or NDJSON, one line at a time"""
+    if fmt not in FORMATS:
+        raise ValueError(f'Unsupported format {fmt!r}, expected one of {FORMATS}')
+    rows = export_rows(queryset, chunk_size)
+    if fmt == 'ndjson':
+        for row in rows:
+            row['price'] = str(row['price'])
+            yield json.dumps(row) + '\n'
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COLUMNS)
+
+    def drain():
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    writer.writeheader()
+    yield drain()
+    for row in rows:
+        writer.writerow(row)
+        yield drain()
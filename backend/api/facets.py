@@ -0,0 +1,210 @@
+"""
+In-memory bitmap index for catalog facet counts.
+
+Every product gets one bit, assigned in (price, id) order so that any price
+range is a contiguous run of bits. Each facet value (category slug, size,
+in stock, available) is a bitmap stored as a Python int, and counting is an
+AND of bitmaps followed by a popcount.
+
+Product writes append the changed ids to the `facets` change log, and each
+worker process re-reads just those products and flips their bits. A new
+product or a new price moves products between positions, and category
+writes bump the `facets` cache tag; both rebuild the index from one narrow
+query.
+"""
+import copy
+import threading
+from bisect import bisect_left, bisect_right
+from decimal import Decimal, InvalidOperation
+from django.conf import settings
+from .models import Product
+from . import caching
+
+_lock = threading.Lock()
+_index = None
+
+
+def _bitmap(positions, length):
+    bits = bytearray((length + 7) // 8)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def parse_price(params, name):
+    """Price query parameter, or None. Raises ValueError."""
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise ValueError(f'{name} must be a number')
+    if not price.is_finite():
+        raise ValueError(f'{name} must be a finite number')
+    return price
+
+
+FIELDS = ('id', 'category__slug', 'size', 'price', 'stock', 'available')
+
+
+class FacetIndex:
+    def __init__(self, rows, version=None, change=None):
+        self.version = version
+        self.change = change
+        self.size = len(rows)
+        self.prices = []
+        self.positions = {}
+        categories = {}
+        sizes = {}
+        in_stock = []
+        available = []
+        for position, (pk, category, size, price, stock, is_available) in enumerate(rows):
+            self.positions[pk] = position
+            self.prices.append(price)
+            categories.setdefault(category, []).append(position)
+            sizes.setdefault(size, []).append(position)
+            if stock > 0:
+                in_stock.append(position)
+            if is_available:
+                available.append(position)
+
+        self.all = (1 << self.size) - 1
+        self.categories = {k: _bitmap(v, self.size) for k, v in categories.items()}
+        self.sizes = {k: _bitmap(v, self.size) for k, v in sizes.items()}
+        self.in_stock = _bitmap(in_stock, self.size)
+        self.available = _bitmap(available, self.size)
+
+    @classmethod
+    def build(cls, version=None, change=None):
+        rows = list(Product.objects.order_by('price', 'id').values_list(*FIELDS))
+        return cls(rows, version, change)
+
+    def updated(self, product_ids, change):
+        """
+        A copy with the bits of product_ids re-read from the database, or
+        None when a product was added or repriced and the index has to be
+        rebuilt
+        """
+        rows = {row[0]: row for row in Product.objects.filter(
+            id__in=product_ids
+        ).values_list(*FIELDS)}
+        index = copy.copy(self)
+        index.change = change
+        index.categories = dict(self.categories)
+        index.sizes = dict(self.sizes)
+        for pk in product_ids:
+            position = self.positions.get(pk)
+            row = rows.get(pk)
+            if position is None:
+                if row is None:
+                    # Created and deleted since the index was built
+                    continue
+                return None
+            if row is not None and row[3] != self.prices[position]:
+                return None
+            index._clear(position)
+            if row is None:
+                index.all &= ~(1 << position)
+            else:
+                index._set(position, row)
+        return index
+
+    def _clear(self, position):
+        mask = ~(1 << position)
+        for bitmaps in (self.categories, self.sizes):
+            for key, bitmap in list(bitmaps.items()):
+                if bitmap >> position & 1:
+                    bitmap &= mask
+                    if bitmap:
+                        bitmaps[key] = bitmap
+                    else:
+                        del bitmaps[key]
+        self.in_stock &= mask
+        self.available &= mask
+
+    def _set(self, position, row):
+        _, category, size, _, stock, is_available = row
+        bit = 1 << position
+        self.categories[category] = self.categories.get(category, 0) | bit
+        self.sizes[size] = self.sizes.get(size, 0) | bit
+        if stock > 0:
+            self.in_stock |= bit
+        if is_available:
+            self.available |= bit
+
+    def _run(self, low, high):
+        if high <= low:
+            return 0
+        return ((1 << high) - 1) ^ ((1 << low) - 1)
+
+    def price_mask(self, min_price=None, max_price=None):
+        """Products priced within [min_price, max_price]"""
+        low = 0 if min_price is None else bisect_left(self.prices, min_price)
+        high = self.size if max_price is None else bisect_right(self.prices, max_price)
+        return self._run(low, high)
+
+    def bucket_mask(self, low, high=None):
+        """Products priced within [low, high)"""
+        end = self.size if high is None else bisect_left(self.prices, Decimal(high))
+        return self._run(bisect_left(self.prices, Decimal(low)), end)
+
+    def ids_mask(self, ids):
+        return _bitmap(
+            (self.positions[pk] for pk in ids if pk in self.positions), self.size
+        )
+
+    def counts(self, category=None, size=None, min_price=None, max_price=None, ids=None):
+        """
+        Facet counts for a filter state. Each facet is counted with every
+        filter applied except its own, so the client can show how many
+        results selecting another value of that facet would give.
+        """
+        base = self.all if ids is None else self.ids_mask(ids)
+        category_mask = self.categories.get(category, 0) if category else self.all
+        size_mask = self.sizes.get(size, 0) if size else self.all
+        price_mask = self.price_mask(min_price, max_price)
+        selected = base & category_mask & size_mask & price_mask
+
+        edges = settings.FACET_PRICE_BUCKETS
+        buckets = []
+        for low, high in zip(edges, list(edges[1:]) + [None]):
+            mask = self.bucket_mask(low, high)
+            buckets.append({
+                'min': low,
+                'max': high,
+                'count': (base & category_mask & size_mask & mask).bit_count(),
+            })
+
+        return {
+            'total': selected.bit_count(),
+            'category': {
+                slug: (base & size_mask & price_mask & mask).bit_count()
+                for slug, mask in sorted(self.categories.items())
+            },
+            'size': {
+                value: (base & category_mask & price_mask & self.sizes.get(value, 0)).bit_count()
+                for value, _ in Product._meta.get_field('size').choices
+            },
+            'price': buckets,
+            'in_stock': (selected & self.in_stock).bit_count(),
+            'available': (selected & self.available).bit_count(),
+        }
+
+
+def get_index():
+    """The current facet index, brought up to date with the products changed since"""
+    global _index
+    version = caching.get_tag_versions([caching.FACETS])[caching.FACETS]
+    change = caching.current_change(caching.FACETS)
+    index = _index
+    if index is None or index.version != version or index.change != change:
+        with _lock:
+            index = _index
+            if index is not None and index.version == version and index.change != change:
+                changed = caching.changes_between(caching.FACETS, index.change, change)
+                index = None if changed is None else index.updated(changed, change)
+            if index is None or index.version != version:
+                index = FacetIndex.build(version, change)
+            _index = index
+    return index
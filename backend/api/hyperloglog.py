@@ -0,0 +1,87 @@
+"""
+HyperLogLog cardinality sketches.
+
+A sketch estimates the number of distinct values added to it within about
+1.04 / sqrt(2 ** precision) (1.6% at the default precision of 12) in a
+fixed 2 ** precision bytes, however many values are added. Sketches of the
+same precision merge by taking the register-wise maximum, so per-day or
+per-product sketches can be combined into the count of a union without
+going back to the raw data.
+"""
+import hashlib
+import math
+import zlib
+from collections import Counter
+
+DEFAULT_PRECISION = 12
+
+
+class HyperLogLog:
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError('precision must be between 4 and 16')
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+        if len(self.registers) != self.size:
+            raise ValueError('register count does not match the precision')
+
+    def add(self, value):
+        digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+        hashed = int.from_bytes(digest, 'big')
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        # Position of the leftmost 1 bit in the remaining 64 - precision bits
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other):
+        """Fold another sketch into this one, in place"""
+        if other.precision != self.precision:
+            raise ValueError('cannot merge sketches of different precision')
+        # Byte-wise maximum on the registers as one big integer. Registers
+        # stay below 0x80, so (a | 0x80) - b never borrows across bytes and
+        # leaves the high bit of each byte set exactly where a >= b.
+        a = int.from_bytes(self.registers, 'big')
+        b = int.from_bytes(other.registers, 'big')
+        high = int.from_bytes(b'\x80' * self.size, 'big')
+        keep = ((((a | high) - b) & high) >> 7) * 0xFF
+        self.registers = bytearray(((a & keep) | (b & ~keep)).to_bytes(self.size, 'big'))
+        return self
+
+    def count(self):
+        """Estimated number of distinct values added"""
+        m = self.size
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        ranks = Counter(self.registers)
+        estimate = alpha * m * m / math.fsum(count * 2.0 ** -r for r, count in ranks.items())
+        zeros = ranks[0]
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate while many registers are empty
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def __len__(self):
+        return self.count()
+
+    def to_bytes(self):
+        """Compact serialized form: precision byte followed by the compressed registers"""
+        return bytes([self.precision]) + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        return cls(data[0], zlib.decompress(data[1:]))
+
+    @classmethod
+    def union(cls, sketches, precision=DEFAULT_PRECISION):
+        merged = cls(precision)
+        for sketch in sketches:
+            merged.merge(sketch)
+        return merged
@@ -0,0 +1,125 @@
+"""
+Idempotency-Key support for POST endpoints.
+
+The first request with a given key (per user, or per IP for anonymous
+clients) stores a keyed fingerprint of the request and, once handled, its
+response. Retries with the same key replay the stored response after one
+indexed lookup instead of running the view again. A claim whose request
+never finishes (a crashed worker) lapses after IDEMPOTENCY_LOCK_TIMEOUT.
+"""
+import json
+from datetime import timedelta
+from functools import wraps
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.response import Response
+from .models import IdempotencyKey
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+MAX_KEY_LENGTH = 255
+
+
+def request_scope(request):
+    if request.user and request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    return f'ip:{request.META.get("REMOTE_ADDR", "")}'
+
+
+def request_fingerprint(request):
+    """HMAC of the request, so stored fingerprints reveal nothing of bodies
+    that carry passwords"""
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    payload = f'{request.method}\n{request.path}\n{body}'
+    return salted_hmac('api.idempotency', payload, algorithm='sha256').hexdigest()
+
+
+def _claim(scope, key, fingerprint):
+    """Insert an in-progress record, or return the existing one for the key"""
+    now = timezone.now()
+    # Held only for as long as a request can run, until the response is stored
+    expires_at = now + timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT)
+    try:
+        with transaction.atomic():
+            IdempotencyKey.objects.create(
+                scope=scope, key=key, fingerprint=fingerprint, expires_at=expires_at
+            )
+        return None
+    except IntegrityError:
+        pass
+    record = IdempotencyKey.objects.filter(scope=scope, key=key).first()
+    if record is not None and record.expires_at <= now:
+        # Expired but not purged yet: take it over
+        claimed = IdempotencyKey.objects.filter(
+            pk=record.pk, expires_at__lte=now
+        ).update(
+            fingerprint=fingerprint, status_code=None, response_body=None,
+            created_at=now, expires_at=expires_at
+        )
+        return None if claimed else IdempotencyKey.objects.filter(pk=record.pk).first()
+    return record
+
+
+def idempotent(handler=None, *, exclude_fields=()):
+    """
+    Honour an Idempotency-Key header on a DRF view function or method.
+    exclude_fields: top-level response fields, such as issued tokens, that
+    are not stored and so are left out of replays
+    """
+    if handler is None:
+        return lambda handler: idempotent(handler, exclude_fields=exclude_fields)
+
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        request = next(arg for arg in args if isinstance(arg, Request))
+        key = request.META.get(HEADER, '').strip()
+        if not key:
+            return handler(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response(
+                {'error': f'Idempotency-Key must be at most {MAX_KEY_LENGTH} characters'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        scope = request_scope(request)
+        fingerprint = request_fingerprint(request)
+        record = _claim(scope, key, fingerprint)
+        if record is not None:
+            if record.fingerprint != fingerprint:
+                return Response(
+                    {'error': 'Idempotency-Key was already used for a different request'},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY
+                )
+            if record.status_code is None:
+                return Response(
+                    {'error': 'A request with this Idempotency-Key is still being processed'},
+                    status=status.HTTP_409_CONFLICT
+                )
+            return Response(
+                record.response_body,
+                status=record.status_code,
+                headers={'Idempotent-Replayed': 'true'}
+            )
+
+        try:
+            response = handler(*args, **kwargs)
+        except Exception:
+            IdempotencyKey.objects.filter(scope=scope, key=key).delete()
+            raise
+        if response.status_code >= 500:
+            # Let the client retry server errors for real
+            IdempotencyKey.objects.filter(scope=scope, key=key).delete()
+        else:
+            body = getattr(response, 'data', None)
+            if exclude_fields and isinstance(body, dict):
+                body = {name: value for name, value in body.items() if name not in exclude_fields}
+            IdempotencyKey.objects.filter(scope=scope, key=key).update(
+                status_code=response.status_code,
+                response_body=body,
+                expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+            )
+        return response
+    return wrapper
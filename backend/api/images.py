@@ -0,0 +1,151 @@
+"""
+Product image derivatives.
+
+When a product image is uploaded, resized WebP and JPEG variants are rendered
+in a process pool and saved next to the original under content-hashed names
+(products/<stem>.<variant>.<hash>.<ext>). The names never change for a given
+content, so the files can be served with far-future cache headers. The
+variant map is stored in Product.image_variants. Replaced variants are
+deleted unless an order line still shows them as its thumbnail.
+"""
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from django.views.static import serve
+from .imaging import VARIANTS, render_derivatives
+from .models import OrderItem, Product
+from . import caching
+
+logger = logging.getLogger(__name__)
+
+HASHED_NAME_RE = re.compile(r'\.(?:%s)\.[0-9a-f]{12}\.(?:webp|jpeg)$' % '|'.join(VARIANTS))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.IMAGE_DERIVATIVE_WORKERS
+            )
+        return _executor
+
+
+def variant_name(source, variant, fmt, digest):
+    stem, _ = os.path.splitext(source)
+    return f'{stem}.{variant}.{digest}.{fmt}'
+
+
+def store_derivatives(product_id, source, results):
+    """Save rendered variants and record them on the product"""
+    variants = {'source': source}
+    for variant, fmt, width, height, digest, content in results:
+        name = variant_name(source, variant, fmt, digest)
+        if not default_storage.exists(name):
+            name = default_storage.save(name, ContentFile(content))
+        entry = variants.setdefault(variant, {'width': width, 'height': height})
+        entry[fmt] = name
+
+    previous = Product.objects.filter(pk=product_id).values_list(
+        'image_variants', flat=True
+    ).first() or {}
+    # Only record variants if the image was not replaced in the meantime
+    updated = Product.objects.filter(pk=product_id, image=source).update(
+        image_variants=variants
+    )
+    if updated:
+        caching.invalidate_products([product_id])
+        delete_derivatives(previous, keep=variants)
+    else:
+        delete_derivatives(variants)
+    return variants
+
+
+def delete_derivatives(variants, keep=None):
+    """Delete the files of variants, except those in keep and those that
+    order lines still show"""
+    names = set(_names(variants)) - set(_names(keep or {}))
+    if not names:
+        return
+    # Order lines snapshot the thumbnail at purchase time and keep showing it
+    names -= set(OrderItem.objects.filter(product_thumbnail__in=names).values_list(
+        'product_thumbnail', flat=True
+    ))
+    for name in names:
+        default_storage.delete(name)
+
+
+def _names(variants):
+    for variant in VARIANTS:
+        for key, value in variants.get(variant, {}).items():
+            if key not in ('width', 'height'):
+                yield value
+
+
+def schedule_derivatives(product_id, source):
+    """Render variants in the process pool and store them when ready"""
+    if not source:
+        return
+    try:
+        with default_storage.open(source, 'rb') as original:
+            data = original.read()
+    except OSError as e:
+        logger.warning('Could not read product image %s: %s', source, e)
+        return
+
+    if not settings.IMAGE_DERIVATIVES_ASYNC:
+        store_derivatives(product_id, source, render_derivatives(data))
+        return
+
+    def done(future):
+        try:
+            store_derivatives(product_id, source, future.result())
+        except Exception:
+            logger.exception('Could not generate variants for product %s', product_id)
+        finally:
+            close_old_connections()
+
+    get_executor().submit(render_derivatives, data).add_done_callback(done)
+
+
+def storage_url(name, request=None):
+    location = default_storage.url(name)
+    return request.build_absolute_uri(location) if request else location
+
+
+def variant_urls(variants, request=None):
+    """Variant map with storage names replaced by absolute URLs, plus
+    srcset strings per format"""
+    def url(name):
+        return storage_url(name, request)
+
+    images = {}
+    srcset = {}
+    for variant in VARIANTS:
+        entry = variants.get(variant)
+        if not entry:
+            continue
+        images[variant] = {'width': entry['width'], 'height': entry['height']}
+        for key, name in entry.items():
+            if key in ('width', 'height'):
+                continue
+            images[variant][key] = url(name)
+            srcset.setdefault(key, []).append(f'{url(name)} {entry["width"]}w')
+    return images, {fmt: ', '.join(items) for fmt, items in srcset.items()}
+
+
+def serve_media(request, path, document_root=None, show_indexes=False):
+    """django.views.static.serve with far-future caching for hashed variants"""
+    response = serve(request, path, document_root, show_indexes)
+    if HASHED_NAME_RE.search(path):
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
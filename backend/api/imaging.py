@@ -0,0 +1,53 @@
+"""
+Image resizing for product image derivatives.
+
+This module deliberately has no Django imports: render_derivatives() runs in
+worker processes of a process pool and only deals with bytes.
+"""
+import hashlib
+from io import BytesIO
+from PIL import Image, ImageOps
+
+# name -> bounding box; images are scaled down to fit, never up
+VARIANTS = {
+    'thumbnail': (160, 160),
+    'card': (480, 480),
+    'detail': (1200, 1200),
+}
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def _flatten(image):
+    """Drop alpha onto a white background so the image can be saved as JPEG"""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def render_derivatives(data):
+    """
+    Resize and recompress an original image.
+    Returns a list of (variant, format, width, height, digest, bytes)
+    """
+    with Image.open(BytesIO(data)) as original:
+        original = _flatten(ImageOps.exif_transpose(original))
+        results = []
+        for variant, box in VARIANTS.items():
+            image = original.copy()
+            image.thumbnail(box, Image.LANCZOS)
+            for fmt, (pil_format, options) in FORMATS.items():
+                buffer = BytesIO()
+                image.save(buffer, pil_format, **options)
+                content = buffer.getvalue()
+                digest = hashlib.sha256(content).hexdigest()[:12]
+                results.append(
+                    (variant, fmt, image.width, image.height, digest, content)
+                )
+        return results
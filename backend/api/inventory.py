@@ -0,0 +1,136 @@
+"""
+Stock movement ledger maintenance.
+
+Every change to Product.stock appends a StockMovement. compact_ledger() folds
+movements into one StockBalance per product, so the stock implied by the
+ledger is always balance + movements after its position, however long the
+history. reconcile() compares that with Product.stock to detect drift from
+writes that bypassed the ledger.
+"""
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.utils import timezone
+from .models import Product, StockBalance, StockMovement
+
+# Movements younger than this are left for the next run, so a transaction
+# that allocated a lower id but committed late is not skipped
+COMPACTION_GRACE = timedelta(minutes=1)
+
+
+def _unfolded(product_ids=None):
+    movements = StockMovement.objects.filter(
+        Q(product__stock_balance__isnull=True) |
+        Q(id__gt=F('product__stock_balance__position'))
+    )
+    if product_ids is not None:
+        movements = movements.filter(product_id__in=product_ids)
+    return movements
+
+
+@transaction.atomic
+def compact_ledger(prune_before=None, now=None):
+    """
+    Fold settled movements into StockBalance.
+    prune_before: also delete folded movements created before this time
+    Returns (movements folded, movements deleted)
+    """
+    now = now or timezone.now()
+    cutoff = StockMovement.objects.filter(
+        created_at__lte=now - COMPACTION_GRACE
+    ).aggregate(position=Max('id'))['position']
+    folded = 0
+    if cutoff is not None:
+        deltas = _unfolded().filter(id__lte=cutoff).values('product_id').annotate(
+            change=Sum('quantity'), movements=Count('id')
+        ).order_by()
+        deltas = {row['product_id']: row for row in deltas}
+        balances = StockBalance.objects.select_for_update().in_bulk(
+            list(deltas), field_name='product_id'
+        )
+        to_create = []
+        for product_id, row in deltas.items():
+            balance = balances.get(product_id)
+            if balance is None:
+                to_create.append(StockBalance(
+                    product_id=product_id, quantity=row['change'], position=cutoff
+                ))
+            else:
+                balance.quantity += row['change']
+                balance.position = cutoff
+                # bulk_update does not apply auto_now
+                balance.updated_at = now
+            folded += row['movements']
+        StockBalance.objects.bulk_create(to_create)
+        StockBalance.objects.bulk_update(
+            list(balances.values()), ['quantity', 'position', 'updated_at']
+        )
+
+    deleted = 0
+    if prune_before is not None:
+        deleted, _ = StockMovement.objects.filter(
+            created_at__lt=prune_before,
+            id__lte=F('product__stock_balance__position')
+        ).delete()
+    return folded, deleted
+
+
+def ledger_levels(product_ids):
+    """Stock implied by the ledger for each product: {product_id: quantity}"""
+    levels = dict(StockBalance.objects.filter(
+        product_id__in=product_ids
+    ).values_list('product_id', 'quantity'))
+    changes = _unfolded(product_ids).values('product_id').annotate(
+        change=Sum('quantity')
+    ).order_by().values_list('product_id', 'change')
+    for product_id, change in changes:
+        levels[product_id] = levels.get(product_id, 0) + change
+    return levels
+
+
+def _drift(stock):
+    levels = ledger_levels(list(stock))
+    return [
+        (product_id, quantity, levels.get(product_id, 0))
+        for product_id, quantity in stock.items()
+        if quantity != levels.get(product_id, 0)
+    ]
+
+
+def reconcile(batch_size=1000, fix=False):
+    """
+    Compare Product.stock with the ledger.
+    Yields (product_id, stock, ledger quantity) for every product that drifted.
+    fix: record an adjustment movement so the ledger matches Product.stock
+    """
+    last_id = 0
+    while True:
+        stock = dict(
+            Product.objects.filter(id__gt=last_id).order_by('id').values_list(
+                'id', 'stock'
+            )[:batch_size]
+        )
+        if not stock:
+            return
+        last_id = max(stock)
+        drifted = _drift(stock)
+        if not drifted:
+            continue
+        with transaction.atomic():
+            # Check again with the rows locked, as checkouts do, so a
+            # checkout committing between the two reads is not reported
+            stock = dict(
+                Product.objects.select_for_update().filter(
+                    id__in=[product_id for product_id, _, _ in drifted]
+                ).order_by('id').values_list('id', 'stock')
+            )
+            drifted = _drift(stock)
+            if fix:
+                StockMovement.objects.bulk_create([
+                    StockMovement(
+                        product_id=product_id, kind=StockMovement.KIND_ADJUSTMENT,
+                        quantity=quantity - ledger, note='Reconciliation'
+                    )
+                    for product_id, quantity, ledger in drifted
+                ])
+        yield from drifted
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from api.models import Product, ProductReview
+
+RATING_FIELDS = [
+    'rating_sum', 'rating_count',
+    'rating_1_count', 'rating_2_count', 'rating_3_count',
+    'rating_4_count', 'rating_5_count',
+]
+
+class Command(BaseCommand):
+    help = 'Recompute the stored rating aggregates on Product from ProductReview'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        counts = {}
+        rows = ProductReview.objects.values('product_id', 'rating').annotate(
+            total=Count('id')
+        ).order_by()
+        for row in rows:
+            counts.setdefault(row['product_id'], {})[row['rating']] = row['total']
+
+        products = []
+        for product in Product.objects.select_for_update().only('id', *RATING_FIELDS):
+            histogram = counts.get(product.id, {})
+            product.rating_count = sum(histogram.values())
+            product.rating_sum = sum(star * n for star, n in histogram.items())
+            for star in range(1, 6):
+                setattr(product, f'rating_{star}_count', histogram.get(star, 0))
+            products.append(product)
+
+        Product.objects.bulk_update(
+            products, RATING_FIELDS, batch_size=options['batch_size']
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Updated rating aggregates for {len(products)} products'
+        ))
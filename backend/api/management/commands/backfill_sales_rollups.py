@@ -0,0 +1,32 @@
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from api.models import DailySalesRollup, Order
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily sales rollups from completed orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', help='First day (YYYY-MM-DD), default the first order')
+        parser.add_argument('--to', dest='end', help='Last day (YYYY-MM-DD), default today')
+        parser.add_argument('--chunk-days', type=int, default=31)
+
+    def handle(self, *args, **options):
+        try:
+            start = date.fromisoformat(options['start']) if options['start'] else None
+            end = date.fromisoformat(options['end']) if options['end'] else timezone.localdate()
+        except ValueError as e:
+            raise CommandError(e)
+        if start is None:
+            first = Order.objects.order_by('created_at').values_list('created_at', flat=True).first()
+            if first is None:
+                self.stdout.write('No orders')
+                return
+            start = timezone.localtime(first).date()
+
+        rows = 0
+        while start <= end:
+            chunk_end = min(start + timedelta(days=options['chunk_days'] - 1), end)
+            rows += DailySalesRollup.rebuild(start, chunk_end)
+            start = chunk_end + timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {rows} rollup rows'))
@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+BACKENDS = [
+    ('locmem', 'django.core.cache.backends.locmem.LocMemCache'),
+    ('filebased', 'django.core.cache.backends.filebased.FileBasedCache'),
+    ('sqlite', 'api.cache_backends.SQLiteCache'),
+    ('tiered', 'api.cache_backends.TieredCache'),
+]
+
+def make_cache(backend, location, max_entries):
+    return import_string(backend)(location, {
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': max_entries},
+    })
+
+def incr_worker(backend, location, max_entries, count):
+    cache = make_cache(backend, location, max_entries)
+    for _ in range(count):
+        cache.incr('counter')
+
+class Command(BaseCommand):
+    help = 'Benchmark the cache backends against each other'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ops', type=int, default=5000)
+        parser.add_argument('--keys', type=int, default=1000)
+        parser.add_argument('--value-size', type=int, default=2048)
+        parser.add_argument('--processes', type=int, default=4)
+
+    def handle(self, *args, **options):
+        ops = options['ops']
+        keys = [f'key:{i}' for i in range(options['keys'])]
+        value = {'data': 'x' * options['value_size']}
+        max_entries = len(keys) * 2
+        workdir = tempfile.mkdtemp(prefix='cache-bench-')
+
+        self.stdout.write(
+            f'{"backend":<10} {"set/s":>10} {"get/s":>10} {"get_many/s":>11} '
+            f'{"incr/s":>10} {"shared incr":>14}'
+        )
+        try:
+            for name, backend in BACKENDS:
+                location = os.path.join(workdir, name)
+                cache = make_cache(backend, location, max_entries)
+
+                set_rate = self.rate(ops, lambda i: cache.set(keys[i % len(keys)], value))
+                get_rate = self.rate(ops, lambda i: cache.get(keys[i % len(keys)]))
+                get_many_rate = self.rate(
+                    ops // 10, lambda i: cache.get_many(keys[i % len(keys):][:10])
+                )
+                cache.set('counter', 0)
+                incr_rate = self.rate(ops, lambda i: cache.incr('counter'))
+
+                shared = self.shared_incr(
+                    cache, backend, location, max_entries, options['processes'], ops
+                )
+                self.stdout.write(
+                    f'{name:<10} {set_rate:>10.0f} {get_rate:>10.0f} '
+                    f'{get_many_rate:>11.0f} {incr_rate:>10.0f} {shared:>14}'
+                )
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def rate(self, count, operation):
+        start = time.perf_counter()
+        for i in range(count):
+            operation(i)
+        return count / (time.perf_counter() - start)
+
+    def shared_incr(self, cache, backend, location, max_entries, processes, ops):
+        """Increment one counter from several processes and report how many
+        increments every process can see afterwards"""
+        per_process = max(ops // processes, 1)
+        cache.set('counter', 0)
+        context = multiprocessing.get_context('fork')
+        workers = [
+            context.Process(
+                target=incr_worker,
+                args=(backend, location, max_entries, per_process)
+            )
+            for _ in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seen = make_cache(backend, location, max_entries).get('counter')
+        return f'{seen}/{per_process * processes}'
@@ -0,0 +1,91 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connections
+from rest_framework.test import APIRequestFactory, force_authenticate
+from api import payments
+from api.models import Category, Order, Product, User
+from api.views import OrderViewSet
+
+class Command(BaseCommand):
+    help = 'Measure checkout throughput against the in-process fake payment gateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=200)
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help='Mean gateway latency in seconds')
+        parser.add_argument('--failure-rate', type=float, default=0.0)
+        parser.add_argument('--items', type=int, default=3,
+                            help='Order lines per checkout')
+
+    def handle(self, *args, **options):
+        gateway = payments.FakeGateway(
+            latency=options['latency'], failure_rate=options['failure_rate']
+        )
+        previous = payments.set_gateway(gateway)
+        run = uuid.uuid4().hex[:8]
+        category = Category.objects.create(name=f'Benchmark {run}', slug=f'benchmark-{run}')
+        products = [
+            Product.objects.create(
+                category=category, name=f'Benchmark {run} {i}', slug=f'benchmark-{run}-{i}',
+                price=10, stock=options['orders'] * 10
+            )
+            for i in range(options['items'])
+        ]
+        user = User.objects.create(username=f'benchmark-{run}', email=f'benchmark-{run}@example.com')
+        view = OrderViewSet.as_view({'post': 'create'})
+        factory = APIRequestFactory()
+        errors = []
+        body = {'items': [{'product_id': product.id, 'quantity': 1} for product in products]}
+
+        def checkout(_):
+            request = factory.post('/api/orders/', body, format='json')
+            force_authenticate(request, user)
+            start = time.perf_counter()
+            try:
+                status_code = view(request).status_code
+            except Exception as e:
+                # e.g. lock timeouts when the database cannot take the concurrency
+                errors.append(e)
+                status_code = None
+            finally:
+                connections.close_all()
+            return status_code, time.perf_counter() - start
+
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+                results = list(executor.map(checkout, range(options['orders'])))
+            elapsed = time.perf_counter() - start
+        finally:
+            payments.set_gateway(previous)
+            Order.objects.filter(user=user).delete()
+            user.delete()
+            Product.objects.filter(category=category).delete()
+            category.delete()
+
+        durations = sorted(duration for _, duration in results)
+        succeeded = sum(1 for status_code, _ in results if status_code == 201)
+
+        def percentile(fraction):
+            return durations[min(int(fraction * len(durations)), len(durations) - 1)] * 1000
+
+        self.stdout.write(
+            f'{len(results)} checkouts in {elapsed:.2f}s: {len(results) / elapsed:.1f}/s, '
+            f'{succeeded} succeeded, {len(results) - succeeded - len(errors)} declined, '
+            f'{len(errors)} errors'
+        )
+        if errors:
+            self.stdout.write(self.style.WARNING(f'first error: {errors[0]!r}'))
+        self.stdout.write(
+            f'checkout latency ms: p50 {percentile(0.5):.1f}  '
+            f'p95 {percentile(0.95):.1f}  p99 {percentile(0.99):.1f}'
+        )
+        gateway_latency = gateway.metrics()['latency'].get('create_payment_intent')
+        if gateway_latency:
+            self.stdout.write(
+                f'gateway latency s: p50 <= {gateway_latency["p50"]}  '
+                f'p95 <= {gateway_latency["p95"]}  p99 <= {gateway_latency["p99"]}'
+            )
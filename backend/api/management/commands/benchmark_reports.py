@@ -0,0 +1,75 @@
+import time
+from datetime import timedelta
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api import reports
+
+class Command(BaseCommand):
+    help = 'Time the vectorized sales reports on synthetic in-memory orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=3000000)
+        parser.add_argument('--customers', type=int, default=300000)
+        parser.add_argument('--products', type=int, default=5000)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--days', type=int, default=730, help='Days of history')
+        parser.add_argument('--items', type=float, default=2.5,
+                            help='Mean order lines per order')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def synthetic_columns(self, options):
+        rng = np.random.default_rng(options['seed'])
+        count = options['orders']
+        today = reports.day_number(timezone.localdate())
+        # Skewed customers, so some order often and most once or twice
+        users = rng.zipf(1.3, count) % options['customers'] + 1
+        days = np.sort(rng.integers(today - options['days'] + 1, today + 1, count))
+        lines = rng.poisson(options['items'] - 1, count) + 1
+        item_count = int(lines.sum())
+        item_orders = np.repeat(np.arange(1, count + 1), lines)
+        products = rng.integers(1, options['products'] + 1, item_count)
+        quantities = rng.integers(1, 4, item_count)
+        prices = rng.integers(500, 20000, options['products'] + 1)
+        amounts = prices[products] * quantities
+        totals = np.bincount(item_orders, weights=amounts, minlength=count + 1)[1:].astype(np.int64)
+        orders = {'id': np.arange(1, count + 1), 'user': users, 'day': days, 'total': totals}
+        items = {
+            'order': item_orders, 'day': days[item_orders - 1], 'product': products,
+            'category': products % options['categories'] + 1,
+            'quantity': quantities, 'amount': amounts,
+        }
+        return reports.OrderColumns(
+            {name: orders[name].astype(dtype) for name, dtype in reports.ORDER_COLUMNS.items()},
+            {name: items[name].astype(dtype) for name, dtype in reports.ITEM_COLUMNS.items()},
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        columns = self.synthetic_columns(options)
+        self.stdout.write(
+            f'{options["orders"]} orders, {len(columns.items["order"])} lines, '
+            f'{columns.nbytes / 2 ** 20:.0f} MiB of columns, '
+            f'generated in {time.perf_counter() - start:.2f}s'
+        )
+        today = timezone.localdate()
+        year_ago = today - timedelta(days=365)
+        benchmarks = [
+            ('customer index (once per refresh)', columns.customers, ()),
+            ('order value by day, 30 days', columns.average_order_value,
+             (today - timedelta(days=30), today, 'day')),
+            ('order value by week, 1 year', columns.average_order_value,
+             (year_ago, today, 'week')),
+            ('repeat purchases, 90 days', columns.repeat_purchases,
+             (today - timedelta(days=90), today)),
+            ('monthly cohorts, 1 year', columns.cohort_retention,
+             (year_ago, today, 'month', 12)),
+            ('weekly cohorts, 1 year', columns.cohort_retention,
+             (year_ago, today, 'week', 12)),
+            ('category mix by month, 1 year', columns.category_mix,
+             (year_ago, today, 'month')),
+        ]
+        for name, report, arguments in benchmarks:
+            start = time.perf_counter()
+            report(*arguments)
+            self.stdout.write(f'{name:<34} {(time.perf_counter() - start) * 1000:>9.1f} ms')
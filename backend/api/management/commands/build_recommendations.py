@@ -0,0 +1,33 @@
+import time
+from django.core.management.base import BaseCommand
+from api import recommendations
+from api.models import CoPurchase
+
+class Command(BaseCommand):
+    help = 'Build "frequently bought together" recommendations from completed orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Recount all orders instead of adding the ones since the last run'
+        )
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep running, adding new orders every --interval seconds'
+        )
+        parser.add_argument('--interval', type=float, default=600)
+
+    def handle(self, *args, **options):
+        if options['full'] or not CoPurchase.objects.exists():
+            pairs = recommendations.build()
+            self.stdout.write(self.style.SUCCESS(f'Counted {pairs} product pairs'))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
+
+        while True:
+            pairs = recommendations.update()
+            self.stdout.write(self.style.SUCCESS(f'Updated {pairs} product pairs'))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,22 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api import inventory
+
+class Command(BaseCommand):
+    help = 'Fold stock movements into per-product balances'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--prune-days', type=int, default=None,
+            help='Also delete folded movements older than this many days'
+        )
+
+    def handle(self, *args, **options):
+        prune_before = None
+        if options['prune_days'] is not None:
+            prune_before = timezone.now() - timedelta(days=options['prune_days'])
+        folded, deleted = inventory.compact_ledger(prune_before=prune_before)
+        self.stdout.write(self.style.SUCCESS(
+            f'Folded {folded} stock movements, deleted {deleted}'
+        ))
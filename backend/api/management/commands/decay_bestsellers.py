@@ -0,0 +1,21 @@
+import time
+from django.core.management.base import BaseCommand
+from api.models import BestsellerCounter
+
+class Command(BaseCommand):
+    help = 'Recompute the rolling best-seller counters, dropping sales that have left each window'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep running, recomputing again every --interval seconds'
+        )
+        parser.add_argument('--interval', type=float, default=3600)
+
+    def handle(self, *args, **options):
+        while True:
+            counters = BestsellerCounter.recompute()
+            self.stdout.write(self.style.SUCCESS(f'Recomputed {counters} best-seller counters'))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
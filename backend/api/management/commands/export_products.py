@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from api import catalog_io
+
+class Command(BaseCommand):
+    help = 'Stream the product catalog as CSV or NDJSON to a file or stdout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', default='-')
+        parser.add_argument('--format', choices=catalog_io.FORMATS)
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['output']
+        fmt = options['format'] or catalog_io.detect_format(path)
+        lines = catalog_io.export_lines(fmt, chunk_size=options['chunk_size'])
+        if path == '-':
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        with open(path, 'w', encoding='utf-8', newline='') as stream:
+            stream.writelines(lines)
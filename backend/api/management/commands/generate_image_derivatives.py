@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.core.files.storage import default_storage
+from api.images import get_executor, store_derivatives
+from api.imaging import render_derivatives
+from api.models import Product
+
+def read_image(name):
+    with default_storage.open(name, 'rb') as original:
+        return original.read()
+
+class Command(BaseCommand):
+    help = 'Render resized image variants for products that are missing them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Regenerate variants for every product with an image'
+        )
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').only('id', 'image', 'image_variants')
+        pending = [
+            product for product in products.iterator()
+            if options['all'] or product.image_variants.get('source') != product.image.name
+        ]
+        executor = get_executor()
+        futures = []
+        for product in pending:
+            try:
+                data = read_image(product.image.name)
+            except OSError as e:
+                self.stderr.write(f'Skipping {product.image.name}: {e}')
+                continue
+            futures.append((product, executor.submit(render_derivatives, data)))
+
+        done = 0
+        for product, future in futures:
+            try:
+                store_derivatives(product.pk, product.image.name, future.result())
+                done += 1
+            except Exception as e:
+                self.stderr.write(f'Failed for product {product.pk}: {e}')
+        self.stdout.write(self.style.SUCCESS(f'Generated variants for {done} products'))
@@ -0,0 +1,44 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from api import catalog_io
+
+class Command(BaseCommand):
+    help = 'Upsert products by slug from a CSV or NDJSON file (use - for stdin)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=catalog_io.FORMATS)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or catalog_io.detect_format(path)
+        if path == '-':
+            stream = sys.stdin
+        else:
+            try:
+                stream = open(path, encoding='utf-8-sig', newline='')
+            except OSError as e:
+                raise CommandError(str(e))
+        try:
+            result = catalog_io.import_products(
+                catalog_io.read_rows(stream, fmt),
+                batch_size=options['batch_size'],
+                dry_run=options['dry_run'],
+            )
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        for warning in result.warnings:
+            self.stderr.write(f'line {warning["line"]}: {warning["warning"]}')
+        for error in result.errors:
+            self.stderr.write(f'line {error["line"]}: {error["error"]}')
+        if result.error_count > len(result.errors):
+            self.stderr.write(f'... and {result.error_count - len(result.errors)} more errors')
+        prefix = 'Dry run: would have ' if result.dry_run else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}created {result.created}, updated {result.updated}, '
+            f'{result.error_count} rows with errors'
+        ))
@@ -0,0 +1,39 @@
+import time
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from api.models import Analytics
+
+class Command(BaseCommand):
+    help = 'Compute daily analytics snapshots since the last one, or for a range of days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start',
+                            help='Backfill from this day (YYYY-MM-DD); "first" for the first recorded activity')
+        parser.add_argument('--to', dest='end', help='Last day to backfill, default today')
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep running, materializing again every --interval seconds'
+        )
+        parser.add_argument('--interval', type=float, default=300)
+
+    def handle(self, *args, **options):
+        if options['start']:
+            try:
+                start = (
+                    Analytics.first_activity_date() if options['start'] == 'first'
+                    else date.fromisoformat(options['start'])
+                )
+                end = date.fromisoformat(options['end']) if options['end'] else timezone.localdate()
+            except ValueError as e:
+                raise CommandError(e)
+            days = Analytics.materialize(start, end)
+            self.stdout.write(self.style.SUCCESS(f'Materialized {days} days'))
+            return
+
+        while True:
+            days = Analytics.materialize_pending()
+            self.stdout.write(f'Materialized {days} days')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,32 @@
+import time
+from django.core.management.base import BaseCommand
+from api import webhooks
+
+class Command(BaseCommand):
+    help = 'Apply payment webhook events waiting in the inbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep polling for new events instead of exiting once the inbox is empty'
+        )
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait between polls with --loop')
+        parser.add_argument('--stats', action='store_true',
+                            help='Only print backlog depth and processing lag')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for name, value in webhooks.backlog_stats().items():
+                self.stdout.write(f'{name}: {value}')
+            return
+
+        while True:
+            processed = webhooks.process_pending(batch_size=options['batch_size'])
+            if processed:
+                self.stdout.write(f'Processed {processed} webhook events')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS('Webhook inbox drained'))
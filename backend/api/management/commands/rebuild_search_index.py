@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api.models import Product
+from api import search
+
+class Command(BaseCommand):
+    help = 'Rebuild the product full-text search index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        if not search.is_enabled():
+            self.stdout.write(self.style.WARNING(
+                'Full-text search is not supported on this database, nothing to do'
+            ))
+            return
+        total = search.rebuild_index(
+            Product.objects.all(), batch_size=options['batch_size']
+        )
+        self.stdout.write(self.style.SUCCESS(f'Indexed {total} products'))
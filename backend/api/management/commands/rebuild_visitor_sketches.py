@@ -0,0 +1,32 @@
+from datetime import date, timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from api import visitors
+
+class Command(BaseCommand):
+    help = 'Recompute unique visitor sketches from the raw product views still retained'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start',
+                            help='First day (YYYY-MM-DD), default the oldest day with all raw views retained')
+        parser.add_argument('--to', dest='end', help='Last day, default today')
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        # Raw views of the oldest retained day may already be partly deleted
+        oldest = today - timedelta(days=settings.PRODUCT_VIEW_RETENTION_DAYS - 1)
+        try:
+            start = date.fromisoformat(options['start']) if options['start'] else oldest
+            end = date.fromisoformat(options['end']) if options['end'] else today
+        except ValueError as e:
+            raise CommandError(e)
+        if start < oldest:
+            raise CommandError(
+                f'Raw views before {oldest} are no longer complete; '
+                'rebuilding would lose visitors'
+            )
+        visitors.rebuild(start, end)
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt visitor sketches for {(end - start).days + 1} days'
+        ))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from api import inventory
+
+class Command(BaseCommand):
+    help = 'Compare product stock with the stock movement ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--fix', action='store_true',
+            help='Record adjustments so the ledger matches the current stock'
+        )
+
+    def handle(self, *args, **options):
+        drifted = 0
+        for product_id, stock, ledger in inventory.reconcile(
+            batch_size=options['batch_size'], fix=options['fix']
+        ):
+            drifted += 1
+            self.stdout.write(
+                f'Product {product_id}: stock {stock}, ledger {ledger} ({stock - ledger:+d})'
+            )
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS('Stock matches the ledger'))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f'Recorded adjustments for {drifted} products'))
+        else:
+            self.stdout.write(self.style.WARNING(f'{drifted} products drifted from the ledger'))
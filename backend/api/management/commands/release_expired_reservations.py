@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from api.models import StockReservation
+
+class Command(BaseCommand):
+    help = 'Return stock held by unpaid orders whose reservation has expired'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        released = StockReservation.release_expired(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Released {released} expired reservations'))
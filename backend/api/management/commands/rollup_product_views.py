@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand
+from api import view_rollups
+
+class Command(BaseCommand):
+    help = 'Roll raw product views up into hourly and daily counts and delete views past retention'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-prune', action='store_true',
+                            help='Only roll up, keep raw views and hourly rollups')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Rows deleted per statement, default PRODUCT_VIEW_PRUNE_BATCH_SIZE')
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep running, rolling up again every --interval seconds'
+        )
+        parser.add_argument('--interval', type=float, default=300)
+
+    def handle(self, *args, **options):
+        while True:
+            rows = view_rollups.rollup()
+            message = f'Rolled up {rows} product hours'
+            if not options['no_prune']:
+                views, hourly = view_rollups.prune(batch_size=options['batch_size'])
+                message += f', deleted {views} views and {hourly} hourly rollups'
+            self.stdout.write(self.style.SUCCESS(message))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
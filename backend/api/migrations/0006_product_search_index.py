@@ -0,0 +1,23 @@
+from django.db import migrations
+from api import search
+
+
+def create_search_index(apps, schema_editor):
+    Product = apps.get_model('api', 'Product')
+    search.create_index(schema_editor)
+    search.rebuild_index(Product.objects.all(), conn=schema_editor.connection)
+
+
+def drop_search_index(apps, schema_editor):
+    search.drop_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_product_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:18
+
+from django.db import migrations, models
+
+
+def snapshot_existing_items(apps, schema_editor):
+    """Fill the snapshot of past order lines from the current products"""
+    OrderItem = apps.get_model('api', 'OrderItem')
+    Product = apps.get_model('api', 'Product')
+    products = Product.objects.filter(
+        id__in=OrderItem.objects.values('product_id')
+    ).only('id', 'name', 'slug', 'image', 'image_variants')
+    for product in products.iterator(chunk_size=500):
+        thumbnail = (product.image_variants or {}).get('thumbnail', {}).get('jpeg')
+        OrderItem.objects.filter(product_id=product.id).update(
+            product_name=product.name,
+            product_slug=product.slug,
+            product_thumbnail=thumbnail or product.image.name or ''
+        )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='product_name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='product_slug',
+            field=models.SlugField(blank=True, db_index=False),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='product_thumbnail',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.RunPython(snapshot_existing_items, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+
+
+def backfill_rollups(apps, schema_editor):
+    Category = apps.get_model('api', 'Category')
+    OrderItem = apps.get_model('api', 'OrderItem')
+    DailySalesRollup = apps.get_model('api', 'DailySalesRollup')
+    # Past lines are attributed to the category their product is in now
+    for category_id in Category.objects.values_list('id', flat=True).iterator():
+        OrderItem.objects.filter(product__category_id=category_id).update(
+            product_category_id=category_id
+        )
+    # Completed lines grouped by order day, category and product
+    rows = OrderItem.objects.filter(order__payment_status='C').values(
+        'product_id', 'product_category_id', day=TruncDate('order__created_at')
+    ).annotate(
+        units=Sum('quantity'),
+        revenue=Sum(F('quantity') * F('price'), output_field=models.DecimalField()),
+        orders=Count('order_id', distinct=True)
+    ).order_by()
+    DailySalesRollup.objects.bulk_create([
+        DailySalesRollup(
+            day=row['day'], category_id=row['product_category_id'],
+            product_id=row['product_id'], units=row['units'],
+            revenue=row['revenue'], orders=row['orders']
+        )
+        for row in rows.iterator()
+    ], batch_size=1000)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('units', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('orders', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='product_category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.category'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['payment_status', 'created_at'], name='api_order_payment_ec0e65_idx'),
+        ),
+        migrations.AddField(
+            model_name='dailysalesrollup',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sales_rollups', to='api.category'),
+        ),
+        migrations.AddField(
+            model_name='dailysalesrollup',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sales_rollups', to='api.product'),
+        ),
+        migrations.AddIndex(
+            model_name='dailysalesrollup',
+            index=models.Index(fields=['product', 'day'], name='api_dailysa_product_9b8a44_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailysalesrollup',
+            unique_together={('day', 'category', 'product')},
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:23
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def drop_duplicate_snapshots(apps, schema_editor):
+    """Keep the newest row per date before the date becomes unique"""
+    Analytics = apps.get_model('api', 'Analytics')
+    latest = Analytics.objects.values('date').annotate(keep=models.Max('id')).values('keep')
+    Analytics.objects.exclude(id__in=latest).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_dailysalesrollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_snapshots, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='analytics',
+            name='api_analyti_date_dbedc7_idx',
+        ),
+        migrations.AddField(
+            model_name='analytics',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AlterField(
+            model_name='analytics',
+            name='date',
+            field=models.DateField(default=django.utils.timezone.localdate, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['date_joined'], name='api_user_date_jo_3c02bd_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_analytics_snapshots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductViewRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('H', 'Hour'), ('D', 'Day')], max_length=1)),
+                ('period', models.DateTimeField()),
+                ('views', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='productview',
+            name='viewed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='productview',
+            index=models.Index(fields=['viewed_at'], name='api_product_viewed__076950_idx'),
+        ),
+        migrations.AddField(
+            model_name='productviewrollup',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='view_rollups', to='api.product'),
+        ),
+        migrations.AddIndex(
+            model_name='productviewrollup',
+            index=models.Index(fields=['granularity', 'period'], name='api_product_granula_087b60_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='productviewrollup',
+            unique_together={('granularity', 'product', 'period')},
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:30
+
+from datetime import timedelta
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+from django.db.models import Sum
+
+
+def backfill_counters(apps, schema_editor):
+    DailySalesRollup = apps.get_model('api', 'DailySalesRollup')
+    BestsellerCounter = apps.get_model('api', 'BestsellerCounter')
+    today = timezone.localdate()
+    for window in (7, 30, 90):
+        # Summed per product under its current category
+        rows = DailySalesRollup.objects.filter(
+            day__gte=today - timedelta(days=window - 1)
+        ).values('product_id', 'product__category_id').annotate(
+            units=Sum('units'), revenue=Sum('revenue')
+        ).order_by()
+        BestsellerCounter.objects.bulk_create([
+            BestsellerCounter(
+                product_id=row['product_id'], category_id=row['product__category_id'],
+                window=window, units=row['units'], revenue=row['revenue']
+            )
+            for row in rows if row['units'] > 0
+        ], batch_size=1000)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_visitor_sketches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BestsellerCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('window', models.PositiveSmallIntegerField()),
+                ('units', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.category')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bestseller_counters', to='api.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['window', '-units'], name='api_bestsel_window_a0dc8a_idx'), models.Index(fields=['window', 'category', '-units'], name='api_bestsel_window_44ce50_idx')],
+                'unique_together': {('product', 'window')},
+            },
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
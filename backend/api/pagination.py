@@ -0,0 +1,126 @@
+import base64
+import json
+from collections import OrderedDict
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+class KeysetPagination(PageNumberPagination):
+    """
+    Page number pagination with an opt-in keyset (cursor) mode.
+
+    Passing ?cursor= (empty for the first page) switches to keyset mode: rows
+    are ordered by (field, id) and each page seeks past the last row of the
+    previous one, so there is no COUNT(*) and no OFFSET however deep the
+    client pages. Subclasses list the fields that have a matching
+    (field, id) index in `cursor_ordering_fields`.
+
+    Search results are ranked by relevance, which has no such index, so a
+    cursor combined with one of `search_query_params` is rejected with a 400
+    unless an explicit cursor ordering is asked for.
+    """
+    cursor_query_param = 'cursor'
+    cursor_ordering_fields = ('created_at',)
+    default_cursor_ordering = '-created_at'
+    search_query_params = ()
+    invalid_cursor_message = 'Invalid cursor'
+    ranked_cursor_message = (
+        'Cursor pagination cannot keep search results in relevance order; '
+        'pass ?ordering= or page without ?cursor='
+    )
+
+    keyset = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_cursor_ordering(request)
+        if self.ordering is None:
+            raise ParseError(self.ranked_cursor_message)
+        field = self.ordering.lstrip('-')
+        descending = self.ordering.startswith('-')
+        direction = '-' if descending else ''
+        queryset = queryset.order_by(self.ordering, f'{direction}id')
+
+        cursor = self.decode_cursor(
+            request.query_params[self.cursor_query_param], queryset.model._meta.get_field(field)
+        )
+        if cursor is not None:
+            value, pk = cursor
+            op = 'lt' if descending else 'gt'
+            # The first condition bounds the index range, the second breaks ties on id
+            queryset = queryset.filter(**{f'{field}__{op}e': value}).filter(
+                Q(**{f'{field}__{op}': value}) | Q(**{field: value, f'id__{op}': pk})
+            )
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page_rows = rows[:self.page_size]
+        return self.page_rows
+
+    def get_cursor_ordering(self, request):
+        ordering = request.query_params.get('ordering', '').split(',')[0].strip()
+        if ordering.lstrip('-') in self.cursor_ordering_fields:
+            return ordering
+        if any(request.query_params.get(param, '').strip() for param in self.search_query_params):
+            # Falling back would silently drop the relevance ranking
+            return None
+        return self.default_cursor_ordering
+
+    def encode_cursor(self, obj):
+        value = getattr(obj, self.ordering.lstrip('-'))
+        payload = json.dumps([str(value), obj.pk]).encode()
+        return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+    def decode_cursor(self, encoded, model_field):
+        """(value, pk) of a cursor, with value converted by the ordering's model field"""
+        if not encoded:
+            return None
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            value, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            value = model_field.to_python(value)
+            if value is None:
+                raise ValueError('empty cursor value')
+            return value, int(pk)
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.page_rows[-1])
+        )
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+
+class ProductPagination(KeysetPagination):
+    cursor_ordering_fields = ('price', 'created_at', 'name')
+    search_query_params = ('q', 'search')
+
+
+class OrderPagination(KeysetPagination):
+    pass
+
+
+class ReviewPagination(KeysetPagination):
+    pass
@@ -0,0 +1,237 @@
+"""
+Payment gateway client.
+
+Views talk to get_gateway() rather than to the Stripe library directly.
+StripeGateway sends every request through its own pooled requests session
+with explicit connect/read timeouts, leaving the stripe module's global
+client settings alone. FakeGateway answers in-process with a
+configurable latency and failure rate, so checkout can be exercised and
+benchmarked without network access (PAYMENT_GATEWAY = 'fake').
+Each gateway call is timed into an in-process latency histogram.
+"""
+import bisect
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from django.conf import settings
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class PaymentError(Exception):
+    pass
+
+
+class PaymentIntent:
+    def __init__(self, id, client_secret):
+        self.id = id
+        self.client_secret = client_secret
+
+
+class LatencyHistogram:
+    """Thread-safe fixed-bucket histogram of call durations"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.errors = 0
+            self.total = 0.0
+
+    def observe(self, seconds, error=False):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.errors += error
+            self.total += seconds
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of calls"""
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip((*self.buckets, float('inf')), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+            return {
+                'count': self.count,
+                'errors': self.errors,
+                'average': self.total / self.count if self.count else None,
+                'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95),
+                'p99': self.percentile(0.99),
+                'buckets': dict(zip(bounds, self.counts)),
+            }
+
+
+class Gateway:
+    name = None
+
+    def __init__(self):
+        self.latency = {}
+        self.latency_lock = threading.Lock()
+
+    def histogram(self, operation):
+        with self.latency_lock:
+            if operation not in self.latency:
+                self.latency[operation] = LatencyHistogram()
+            return self.latency[operation]
+
+    def timed(self, operation, call, *args, **kwargs):
+        start = time.perf_counter()
+        error = False
+        try:
+            return call(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.histogram(operation).observe(time.perf_counter() - start, error)
+
+    def metrics(self):
+        with self.latency_lock:
+            operations = dict(self.latency)
+        return {
+            'gateway': self.name,
+            'latency': {
+                operation: histogram.snapshot()
+                for operation, histogram in operations.items()
+            },
+        }
+
+    def create_payment_intent(self, amount, currency, metadata, idempotency_key=None):
+        """
+        Create a payment for amount (in cents).
+        Returns a PaymentIntent, raises PaymentError.
+        """
+        return self.timed(
+            'create_payment_intent', self._create_payment_intent,
+            amount, currency, metadata, idempotency_key
+        )
+
+    def _create_payment_intent(self, amount, currency, metadata, idempotency_key):
+        raise NotImplementedError
+
+
+class StripeGateway(Gateway):
+    name = 'stripe'
+
+    def __init__(self, api_key, connect_timeout, read_timeout, pool_size, max_retries=0):
+        super().__init__()
+        import requests
+        import stripe
+        from requests.adapters import HTTPAdapter
+
+        class Client(stripe.http_client.RequestsClient):
+            # The library reads stripe.max_network_retries here by default
+            def _max_network_retries(self):
+                return max_retries
+
+        self.stripe = stripe
+        self.api_key = api_key
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        session.mount('https://', adapter)
+        # Passed to each request rather than set as stripe.default_http_client,
+        # so other Stripe calls in the process keep the library defaults
+        self.client = Client(timeout=(connect_timeout, read_timeout), session=session)
+
+    def _create_payment_intent(self, amount, currency, metadata, idempotency_key):
+        stripe = self.stripe
+        requestor = stripe.api_requestor.APIRequestor(key=self.api_key, client=self.client)
+        headers = stripe.util.populate_headers(idempotency_key) if idempotency_key else None
+        try:
+            response, api_key = requestor.request(
+                'post', stripe.PaymentIntent.class_url(),
+                {'amount': amount, 'currency': currency, 'metadata': metadata}, headers
+            )
+        except stripe.error.StripeError as e:
+            raise PaymentError(e.user_message or str(e)) from e
+        intent = stripe.util.convert_to_stripe_object(response, api_key)
+        return PaymentIntent(intent.id, intent.client_secret)
+
+
+class FakeGateway(Gateway):
+    """In-process gateway for offline testing and load tests"""
+    name = 'fake'
+    # Intents remembered for idempotent retries, oldest forgotten first
+    max_intents = 10000
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None):
+        super().__init__()
+        self.latency_seconds = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.intents = OrderedDict()
+        self.intents_lock = threading.Lock()
+
+    def _create_payment_intent(self, amount, currency, metadata, idempotency_key):
+        if idempotency_key and idempotency_key in self.intents:
+            return self.intents[idempotency_key]
+        with self.random_lock:
+            # Exponential latency around the configured mean
+            delay = self.random.expovariate(1 / self.latency_seconds) if self.latency_seconds else 0
+            failed = self.random.random() < self.failure_rate
+        time.sleep(delay)
+        if failed:
+            raise PaymentError('Your card was declined.')
+        token = uuid.uuid4().hex
+        intent = PaymentIntent(f'pi_fake_{token[:24]}', f'pi_fake_{token[:24]}_secret_{token[24:]}')
+        if idempotency_key:
+            with self.intents_lock:
+                self.intents[idempotency_key] = intent
+                while len(self.intents) > self.max_intents:
+                    self.intents.popitem(last=False)
+        return intent
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def build_gateway(name=None):
+    name = name or settings.PAYMENT_GATEWAY
+    if name == 'stripe':
+        return StripeGateway(
+            api_key=settings.STRIPE_SECRET_KEY,
+            connect_timeout=settings.PAYMENT_CONNECT_TIMEOUT,
+            read_timeout=settings.PAYMENT_READ_TIMEOUT,
+            pool_size=settings.PAYMENT_POOL_SIZE,
+            max_retries=settings.PAYMENT_MAX_RETRIES,
+        )
+    if name == 'fake':
+        return FakeGateway(
+            latency=settings.PAYMENT_FAKE_LATENCY,
+            failure_rate=settings.PAYMENT_FAKE_FAILURE_RATE,
+        )
+    raise ValueError(f'Unknown payment gateway {name!r}')
+
+
+def get_gateway():
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = build_gateway()
+        return _gateway
+
+
+def set_gateway(gateway):
+    """Swap the process-wide gateway, e.g. for a benchmark. Returns the old one."""
+    global _gateway
+    with _gateway_lock:
+        previous, _gateway = _gateway, gateway
+        return previous
@@ -0,0 +1,202 @@
+"""
+"Frequently bought together" recommendations.
+
+CoPurchase is a sparse product x product matrix: the number of completed
+orders containing each pair of products. build() fills it from all orders;
+update() adds only orders placed since the last run. Either way the
+neighbours of every product whose pairs changed are then recomputed into
+ProductRecommendation: pairs bought together in at least
+RECOMMENDATION_MIN_SUPPORT orders, with a lift (how much more often than
+chance they are bought together) above RECOMMENDATION_MIN_LIFT, best lift
+first. Requests only read that table, falling back to the category's best
+sellers when a product has too few neighbours.
+"""
+from datetime import timedelta
+from itertools import combinations
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Min, Q, Sum
+from django.utils import timezone
+from . import caching
+from .models import BestsellerCounter, CoPurchase, DailySalesRollup, Order, OrderItem, ProductRecommendation
+
+CHUNK_SIZE = 10000
+BATCH_SIZE = 1000
+# Best sellers over this many days fill in for products with few co-purchases
+FALLBACK_WINDOW = 30
+# Pending orders are waited for this long past their stock hold
+PENDING_GRACE = timedelta(minutes=5)
+
+
+def _baskets(orders):
+    """(order id, product ids) for each order, from one streamed query"""
+    rows = OrderItem.objects.filter(order__in=orders).values_list(
+        'order_id', 'product_id'
+    ).order_by('order_id').iterator(chunk_size=CHUNK_SIZE)
+    current, products = None, set()
+    for order_id, product_id in rows:
+        if order_id != current:
+            if products:
+                yield current, products
+            current, products = order_id, set()
+        products.add(product_id)
+    if products:
+        yield current, products
+
+
+def count_pairs(orders):
+    """{(product, other): [orders, last order id]} for the orders of a queryset"""
+    pairs = {}
+    for order_id, products in _baskets(orders):
+        if len(products) > settings.RECOMMENDATION_MAX_BASKET:
+            continue
+        for pair in combinations(sorted(products), 2):
+            entry = pairs.setdefault(pair, [0, 0])
+            entry[0] += 1
+            entry[1] = max(entry[1], order_id)
+    return pairs
+
+
+def _completed():
+    return Order.objects.filter(payment_status=Order.PAYMENT_STATUS_COMPLETED)
+
+
+def settled_order_id():
+    """
+    Highest order id below which every order is settled. Pending orders
+    may still complete, so incremental updates stop short of the oldest one
+    whose stock hold has not run out. Older pending orders (the hold expired,
+    or orders placed before holds existed) no longer hold updates back; if
+    one is paid after all, the next full build counts it.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.STOCK_RESERVATION_TTL) - PENDING_GRACE
+    pending = Order.objects.filter(
+        payment_status=Order.PAYMENT_STATUS_PENDING, created_at__gt=cutoff
+    ).aggregate(first=Min('id'))['first']
+    if pending is not None:
+        return pending - 1
+    return Order.objects.aggregate(last=Max('id'))['last'] or 0
+
+
+@transaction.atomic
+def build():
+    """Recount every pair from all completed orders. Returns the number of pairs."""
+    pairs = count_pairs(_completed())
+    CoPurchase.objects.all().delete()
+    CoPurchase.objects.bulk_create([
+        CoPurchase(product_id=product, other_id=other, orders=orders, last_order_id=last)
+        for (product, other), (orders, last) in pairs.items()
+    ], batch_size=BATCH_SIZE)
+    ProductRecommendation.objects.all().delete()
+    refresh_neighbours({product for pair in pairs for product in pair})
+    return len(pairs)
+
+
+@transaction.atomic
+def update():
+    """
+    Add the orders completed since the last run. Returns the number of
+    pairs changed. Refunds are only taken out by build().
+    """
+    watermark = CoPurchase.objects.aggregate(last=Max('last_order_id'))['last'] or 0
+    pairs = count_pairs(_completed().filter(id__gt=watermark, id__lte=settled_order_id()))
+    if not pairs:
+        return 0
+    existing = {
+        (row.product_id, row.other_id): row
+        for row in CoPurchase.objects.select_for_update().filter(
+            product_id__in={product for product, _ in pairs},
+            other_id__in={other for _, other in pairs}
+        )
+    }
+    to_create = []
+    for key, (orders, last) in pairs.items():
+        row = existing.get(key)
+        if row is None:
+            to_create.append(CoPurchase(
+                product_id=key[0], other_id=key[1], orders=orders, last_order_id=last
+            ))
+        else:
+            row.orders += orders
+            row.last_order_id = max(row.last_order_id, last)
+    CoPurchase.objects.bulk_create(to_create, batch_size=BATCH_SIZE)
+    CoPurchase.objects.bulk_update(
+        [row for key, row in existing.items() if key in pairs],
+        ['orders', 'last_order_id'], batch_size=BATCH_SIZE
+    )
+    refresh_neighbours({product for pair in pairs for product in pair})
+    return len(pairs)
+
+
+def refresh_neighbours(product_ids):
+    """Recompute the stored recommendations of product_ids from CoPurchase"""
+    product_ids = list(product_ids)
+    for start in range(0, len(product_ids), BATCH_SIZE):
+        _refresh_neighbours(product_ids[start:start + BATCH_SIZE])
+    caching.invalidate(caching.RECOMMENDATIONS)
+
+
+def _refresh_neighbours(product_ids):
+    wanted = set(product_ids)
+    neighbours = {product_id: [] for product_id in product_ids}
+    pairs = CoPurchase.objects.filter(
+        Q(product_id__in=product_ids) | Q(other_id__in=product_ids),
+        orders__gte=settings.RECOMMENDATION_MIN_SUPPORT
+    ).values_list('product_id', 'other_id', 'orders')
+    for product, other, orders in pairs:
+        if product in wanted:
+            neighbours[product].append((other, orders))
+        if other in wanted:
+            neighbours[other].append((product, orders))
+
+    involved = wanted | {other for found in neighbours.values() for other, _ in found}
+    # Orders containing each product, and all orders, for the lift
+    bought = dict(DailySalesRollup.objects.filter(product_id__in=involved).values(
+        'product_id'
+    ).annotate(orders=Sum('orders')).order_by().values_list('product_id', 'orders'))
+    total = _completed().count()
+
+    recommendations = []
+    for product_id, found in neighbours.items():
+        scored = []
+        for other, orders in found:
+            expected = bought.get(product_id, 0) * bought.get(other, 0)
+            lift = orders * total / expected if expected else 0
+            if lift > settings.RECOMMENDATION_MIN_LIFT:
+                scored.append((lift, orders, other))
+        scored.sort(key=lambda entry: (-entry[0], -entry[1], entry[2]))
+        recommendations.extend(
+            ProductRecommendation(
+                product_id=product_id, recommended_id=other,
+                rank=rank, orders=orders, lift=round(lift, 4)
+            )
+            for rank, (lift, orders, other) in enumerate(
+                scored[:settings.RECOMMENDATION_NEIGHBOURS], start=1
+            )
+        )
+    ProductRecommendation.objects.filter(product_id__in=product_ids).delete()
+    ProductRecommendation.objects.bulk_create(recommendations, batch_size=BATCH_SIZE)
+
+
+def related(product, limit):
+    """
+    [(product_id, details)] to show with product: its stored recommendations,
+    topped up with best sellers of its category when there are too few
+    """
+    rows = [
+        (recommended, {'reason': 'bought_together', 'orders': orders, 'lift': lift})
+        for recommended, orders, lift in product.recommendations.order_by('rank').values_list(
+            'recommended_id', 'orders', 'lift'
+        )[:limit]
+    ]
+    if len(rows) < limit:
+        seen = {product.id, *(product_id for product_id, _ in rows)}
+        bestsellers = BestsellerCounter.top(
+            FALLBACK_WINDOW, category_id=product.category_id, limit=limit + len(seen)
+        )
+        for product_id, _, _ in bestsellers:
+            if product_id not in seen:
+                rows.append((product_id, {'reason': 'bestseller'}))
+            if len(rows) == limit:
+                break
+    return rows
@@ -0,0 +1,313 @@
+"""
+Vectorized sales reports.
+
+Completed orders and their lines are loaded once into NumPy column arrays
+(one streamed pass over each table) and kept per process. Later requests
+only reload the orders whose updated_at moved since the last refresh, so
+payments completing or refunds land in the columns without a full reload;
+a full reload every REPORTS_FULL_RELOAD_INTERVAL seconds also drops deleted
+orders. Every report is then a handful of array group-bys (bincount,
+unique, lexsort) with no further queries.
+
+Days are stored as the number of days since 1970-01-01 in the current time
+zone and money as integer cents.
+"""
+import threading
+from array import array
+from datetime import date, timedelta
+import numpy as np
+from django.conf import settings
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import Category, Order, OrderItem
+
+EPOCH = date(1970, 1, 1)
+CHUNK_SIZE = 10000
+# Orders updated this long before the last refresh are checked again, for
+# transactions that committed after it with an earlier updated_at
+REFRESH_OVERLAP = timedelta(minutes=5)
+
+# Column name -> dtype; ids and money are 64-bit, small numbers 32-bit
+ORDER_COLUMNS = {'id': np.int64, 'user': np.int64, 'day': np.int32, 'total': np.int64}
+ITEM_COLUMNS = {
+    'order': np.int64, 'day': np.int32, 'product': np.int32,
+    'category': np.int32, 'quantity': np.int32, 'amount': np.int64,
+}
+
+
+def day_number(day):
+    return (day - EPOCH).days
+
+
+def to_periods(days, granularity):
+    """Period number of each day: the day itself, Monday-based weeks or months"""
+    days = days.astype(np.int64, copy=False)
+    if granularity == 'week':
+        # 1970-01-01 was a Thursday
+        return (days + 3) // 7
+    if granularity == 'month':
+        return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    return days
+
+
+def period_of(day, granularity):
+    """Period number of a date"""
+    return int(to_periods(np.array([day_number(day)]), granularity)[0])
+
+
+def period_date(period, granularity):
+    """First day of a period number"""
+    period = int(period)
+    if granularity == 'week':
+        return EPOCH + timedelta(days=period * 7 - 3)
+    if granularity == 'month':
+        return date(1970 + period // 12, period % 12 + 1, 1)
+    return EPOCH + timedelta(days=period)
+
+
+def _cents(value):
+    return int(value * 100)
+
+
+def _arrays(columns, dtypes):
+    return {
+        name: np.asarray(column, dtype=np.int64).astype(dtype, copy=False)
+        for column, (name, dtype) in zip(columns, dtypes.items())
+    }
+
+
+class OrderColumns:
+    """Completed orders and order lines as column arrays, orders sorted by id"""
+
+    def __init__(self, orders, items):
+        self.orders = orders
+        self.items = items
+        self.loaded_at = None
+        self.reloaded_at = None
+        self._customers = None
+
+    @classmethod
+    def empty(cls):
+        return cls(
+            {name: np.zeros(0, dtype=dtype) for name, dtype in ORDER_COLUMNS.items()},
+            {name: np.zeros(0, dtype=dtype) for name, dtype in ITEM_COLUMNS.items()},
+        )
+
+    @classmethod
+    def load(cls):
+        columns = cls.empty()
+        columns.reload()
+        return columns
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in (*self.orders.values(), *self.items.values()))
+
+    def _fetch(self, order_ids=None):
+        """Columns of the completed orders among order_ids (all if None)"""
+        orders = Order.objects.filter(payment_status=Order.PAYMENT_STATUS_COMPLETED)
+        items = OrderItem.objects.filter(order__payment_status=Order.PAYMENT_STATUS_COMPLETED)
+        if order_ids is not None:
+            orders = orders.filter(id__in=order_ids)
+            items = items.filter(order_id__in=order_ids)
+
+        order_columns = [array('q') for _ in ORDER_COLUMNS]
+        rows = orders.annotate(day=TruncDate('created_at')).values_list(
+            'id', 'user_id', 'day', 'total_price'
+        ).order_by('id').iterator(chunk_size=CHUNK_SIZE)
+        for order_id, user_id, day, total in rows:
+            for column, value in zip(order_columns, (order_id, user_id, day_number(day), _cents(total))):
+                column.append(value)
+        fetched_orders = _arrays(order_columns, ORDER_COLUMNS)
+
+        item_columns = [array('q') for _ in ITEM_COLUMNS]
+        rows = items.values_list(
+            'order_id', 'product_id', 'product__category_id', 'quantity', 'price'
+        ).iterator(chunk_size=CHUNK_SIZE)
+        for order_id, product_id, category_id, quantity, price in rows:
+            values = (order_id, 0, product_id, category_id, quantity, _cents(price) * quantity)
+            for column, value in zip(item_columns, values):
+                column.append(value)
+        fetched_items = _arrays(item_columns, ITEM_COLUMNS)
+        # Lines of an order completing between the two queries have no order row yet
+        positions = np.searchsorted(fetched_orders['id'], fetched_items['order'])
+        positions = np.minimum(positions, max(len(fetched_orders['id']) - 1, 0))
+        known = (
+            fetched_orders['id'][positions] == fetched_items['order']
+            if len(fetched_orders['id']) else np.zeros(len(positions), dtype=bool)
+        )
+        fetched_items = {name: column[known] for name, column in fetched_items.items()}
+        fetched_items['day'] = fetched_orders['day'][positions[known]]
+        return fetched_orders, fetched_items
+
+    def reload(self):
+        started = timezone.now()
+        self.orders, self.items = self._fetch()
+        self.loaded_at = self.reloaded_at = started
+        self._customers = None
+
+    def refresh(self):
+        """Reload the orders updated since the last refresh"""
+        started = timezone.now()
+        changed = np.fromiter(
+            Order.objects.filter(
+                updated_at__gte=self.loaded_at - REFRESH_OVERLAP
+            ).values_list('id', flat=True).iterator(chunk_size=CHUNK_SIZE),
+            dtype=np.int64
+        )
+        if len(changed):
+            orders, items = self._fetch(changed.tolist())
+            keep = ~np.isin(self.orders['id'], changed)
+            merged = {
+                name: np.concatenate([self.orders[name][keep], orders[name]])
+                for name in ORDER_COLUMNS
+            }
+            order = np.argsort(merged['id'], kind='stable')
+            self.orders = {name: column[order] for name, column in merged.items()}
+            keep = ~np.isin(self.items['order'], changed)
+            self.items = {
+                name: np.concatenate([self.items[name][keep], items[name]])
+                for name in ITEM_COLUMNS
+            }
+            self._customers = None
+        self.loaded_at = started
+        return len(changed)
+
+    def _in_range(self, table, start, end):
+        days = table['day']
+        return (days >= day_number(start)) & (days <= day_number(end))
+
+    def average_order_value(self, start, end, granularity='day'):
+        """Orders, revenue and average order value per period"""
+        mask = self._in_range(self.orders, start, end)
+        first, last = period_of(start, granularity), period_of(end, granularity)
+        index = to_periods(self.orders['day'][mask], granularity) - first
+        length = last - first + 1
+        orders = np.bincount(index, minlength=length)
+        revenue = np.bincount(index, weights=self.orders['total'][mask], minlength=length)
+        return [
+            {
+                'date': period_date(first + i, granularity),
+                'orders': int(orders[i]),
+                'revenue': round(revenue[i] / 100, 2),
+                'average_order_value': round(revenue[i] / orders[i] / 100, 2) if orders[i] else None,
+            }
+            for i in range(length)
+        ]
+
+    def customers(self):
+        """
+        (customer ids, day of each customer's first completed order, index
+        into those arrays of each order's customer), kept until the columns change
+        """
+        if self._customers is None:
+            users, customer = np.unique(self.orders['user'], return_inverse=True)
+            first_days = np.full(len(users), np.iinfo(np.int32).max, dtype=np.int32)
+            np.minimum.at(first_days, customer.reshape(-1), self.orders['day'])
+            self._customers = users, first_days, customer.reshape(-1)
+        return self._customers
+
+    def repeat_purchases(self, start, end):
+        """How many customers ordered more than once, and how many had ordered before"""
+        mask = self._in_range(self.orders, start, end)
+        customers, counts = np.unique(self.orders['user'][mask], return_counts=True)
+        users, first_days, _ = self.customers()
+        first = first_days[np.searchsorted(users, customers)]
+        total = len(customers)
+        repeat = int((counts > 1).sum())
+        return {
+            'from': start,
+            'to': end,
+            'customers': total,
+            'orders': int(counts.sum()),
+            'repeat_customers': repeat,
+            'repeat_purchase_rate': round(repeat / total, 4) if total else None,
+            'returning_customers': int((first < day_number(start)).sum()),
+            'orders_per_customer': round(counts.sum() / total, 4) if total else None,
+        }
+
+    def cohort_retention(self, start, end, granularity='month', periods=12):
+        """
+        Customers grouped by the period of their first completed order, with
+        the share of each cohort ordering again 0..periods periods later
+        """
+        _, first_days, customer = self.customers()
+        first_periods = to_periods(first_days, granularity)
+        offset = to_periods(self.orders['day'], granularity) - first_periods[customer]
+        cohort_first, cohort_last = period_of(start, granularity), period_of(end, granularity)
+        cohort = first_periods[customer] - cohort_first
+        cohorts = cohort_last - cohort_first + 1
+        mask = (cohort >= 0) & (cohort < cohorts) & (offset <= periods)
+        # Each customer counts once per period they ordered in
+        active = np.unique(customer[mask] * (periods + 1) + offset[mask])
+        active_cohort = first_periods[active // (periods + 1)] - cohort_first
+        matrix = np.bincount(
+            active_cohort * (periods + 1) + active % (periods + 1),
+            minlength=cohorts * (periods + 1)
+        ).reshape(cohorts, periods + 1)
+        current = period_of(timezone.localdate(), granularity)
+        report = []
+        for i in range(cohorts):
+            size = int(matrix[i, 0])
+            if not size:
+                continue
+            # Periods that have not started yet are left out, not reported as 0
+            elapsed = min(periods, current - (cohort_first + i))
+            report.append({
+                'cohort': period_date(cohort_first + i, granularity),
+                'customers': size,
+                'retention': [round(count / size, 4) for count in matrix[i, :elapsed + 1].tolist()],
+            })
+        return report
+
+    def category_mix(self, start, end, granularity='month'):
+        """Revenue per period and each category's share of it"""
+        mask = self._in_range(self.items, start, end)
+        first, last = period_of(start, granularity), period_of(end, granularity)
+        length = last - first + 1
+        index = to_periods(self.items['day'][mask], granularity) - first
+        # Category ids are small, so group on them directly
+        category = self.items['category'][mask]
+        width = int(category.max()) + 1 if len(category) else 1
+        revenue = np.bincount(
+            index * width + category,
+            weights=self.items['amount'][mask],
+            minlength=length * width
+        ).reshape(length, width)
+        category_ids = np.flatnonzero(revenue.sum(axis=0))
+        revenue = revenue[:, category_ids]
+        names = dict(Category.objects.filter(
+            id__in=category_ids.tolist()
+        ).values_list('id', 'name'))
+        totals = revenue.sum(axis=1)
+        return [
+            {
+                'date': period_date(first + i, granularity),
+                'revenue': round(totals[i] / 100, 2),
+                'categories': {
+                    names.get(category_id, str(category_id)): round(revenue[i, j] / totals[i], 4)
+                    for j, category_id in enumerate(category_ids.tolist())
+                    if revenue[i, j]
+                },
+            }
+            for i in range(length)
+        ]
+
+
+_columns = None
+_columns_lock = threading.Lock()
+
+
+def get_columns():
+    """This process's columns, refreshed with the orders changed since last time"""
+    global _columns
+    with _columns_lock:
+        now = timezone.now()
+        if _columns is None:
+            _columns = OrderColumns.load()
+        elif (now - _columns.reloaded_at).total_seconds() >= settings.REPORTS_FULL_RELOAD_INTERVAL:
+            _columns.reload()
+        else:
+            _columns.refresh()
+        return _columns
+
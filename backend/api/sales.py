@@ -0,0 +1,98 @@
+"""
+Sales reporting from DailySalesRollup.
+
+The rollups are kept up to date as orders complete (Order.confirm_payments)
+and are refunded, so reports over any date range read a bounded number of
+pre-aggregated rows instead of scanning order history.
+"""
+from datetime import date, timedelta
+from django.db.models import Sum
+from django.db.models.functions import TruncDay, TruncMonth, TruncWeek
+from django.utils import timezone
+from .models import DailySalesRollup
+
+GRANULARITIES = {
+    'day': TruncDay,
+    'week': TruncWeek,
+    'month': TruncMonth,
+}
+# Longest ?from=&to= span, so one request cannot ask for centuries of periods
+MAX_RANGE_DAYS = 5 * 366
+
+
+def parse_range(params, default_days=30):
+    """
+    (start, end, granularity) from ?from=&to=&granularity= query parameters.
+    Raises ValueError for invalid values.
+    """
+    today = timezone.localdate()
+    end = date.fromisoformat(params['to']) if params.get('to') else today
+    start = (
+        date.fromisoformat(params['from']) if params.get('from')
+        else end - timedelta(days=default_days)
+    )
+    if start > end:
+        raise ValueError('from must not be after to')
+    if (end - start).days >= MAX_RANGE_DAYS:
+        raise ValueError(f'from and to must be less than {MAX_RANGE_DAYS} days apart')
+    granularity = params.get('granularity') or 'day'
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'granularity must be one of {", ".join(GRANULARITIES)}')
+    return start, end, granularity
+
+
+def period_start(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _periods(start, end, granularity):
+    current = period_start(start, granularity)
+    while current <= end:
+        yield current
+        if granularity == 'month':
+            current = (current.replace(day=28) + timedelta(days=4)).replace(day=1)
+        else:
+            current += timedelta(days=7 if granularity == 'week' else 1)
+
+
+def rollups(start, end):
+    return DailySalesRollup.objects.filter(day__range=(start, end))
+
+
+def revenue_series(start, end, granularity='day'):
+    """Revenue and units per period, with empty periods filled in"""
+    rows = rollups(start, end).annotate(
+        period=GRANULARITIES[granularity]('day')
+    ).values('period').annotate(
+        revenue=Sum('revenue'), units=Sum('units')
+    ).order_by('period')
+    totals = {row['period']: row for row in rows}
+    return [
+        {
+            'date': period,
+            'revenue': totals[period]['revenue'] if period in totals else 0,
+            'units': totals[period]['units'] if period in totals else 0,
+        }
+        for period in _periods(start, end, granularity)
+    ]
+
+
+def sales_by_category(start, end):
+    """{category name: revenue}, highest first"""
+    rows = rollups(start, end).values('category__name').annotate(
+        total=Sum('revenue')
+    ).order_by('-total').values_list('category__name', 'total')
+    return dict(rows)
+
+
+def top_product_ids(start, end, limit=5):
+    """Ids of the best selling products by units, best first"""
+    return list(
+        rollups(start, end).values('product_id').annotate(
+            sold=Sum('units')
+        ).order_by('-sold', 'product_id').values_list('product_id', flat=True)[:limit]
+    )
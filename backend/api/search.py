@@ -0,0 +1,185 @@
+"""
+Full-text search index for the product catalog.
+
+SQLite deployments keep an FTS5 virtual table, PostgreSQL deployments keep a
+weighted tsvector table with a GIN index. Both are keyed by product id and are
+kept in sync by the signals in api/signals.py. Other database backends fall
+back to plain icontains filtering.
+"""
+import re
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+SQLITE_TABLE = 'api_product_fts'
+POSTGRES_TABLE = 'api_product_search'
+POSTGRES_CONFIG = 'english'
+
+# Relative column weights for name, description and category name
+WEIGHTS = (10.0, 1.0, 3.0)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def is_enabled(conn=None):
+    return (conn or connection).vendor in ('sqlite', 'postgresql')
+
+
+def create_index(schema_editor):
+    """Create the search table for the current database vendor"""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_TABLE} USING fts5("
+            "name, description, category_name, "
+            "tokenize = 'porter unicode61 remove_diacritics 2')"
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            f"CREATE TABLE IF NOT EXISTS {POSTGRES_TABLE} ("
+            "product_id bigint PRIMARY KEY "
+            "REFERENCES api_product(id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            "document tsvector NOT NULL)"
+        )
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS {POSTGRES_TABLE}_document_idx "
+            f"ON {POSTGRES_TABLE} USING GIN (document)"
+        )
+
+
+def drop_index(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {SQLITE_TABLE}')
+    elif vendor == 'postgresql':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {POSTGRES_TABLE}')
+
+
+def _documents(products):
+    return [
+        (product.pk, product.name, product.description, product.category.name)
+        for product in products
+    ]
+
+
+def index_products(products, conn=None):
+    """Add or refresh the index entries for the given products"""
+    conn = conn or connection
+    if not is_enabled(conn):
+        return
+    documents = _documents(products)
+    if not documents:
+        return
+    with conn.cursor() as cursor:
+        if conn.vendor == 'sqlite':
+            cursor.executemany(
+                f'DELETE FROM {SQLITE_TABLE} WHERE rowid = %s',
+                [(doc[0],) for doc in documents]
+            )
+            cursor.executemany(
+                f'INSERT INTO {SQLITE_TABLE} (rowid, name, description, category_name) '
+                'VALUES (%s, %s, %s, %s)',
+                documents
+            )
+        else:
+            cursor.executemany(
+                f'INSERT INTO {POSTGRES_TABLE} (product_id, document) VALUES (%s, '
+                f"setweight(to_tsvector('{POSTGRES_CONFIG}', %s), 'A') || "
+                f"setweight(to_tsvector('{POSTGRES_CONFIG}', %s), 'C') || "
+                f"setweight(to_tsvector('{POSTGRES_CONFIG}', %s), 'B')) "
+                'ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document',
+                documents
+            )
+
+
+def remove_products(product_ids, conn=None):
+    """Drop the index entries for the given product ids"""
+    conn = conn or connection
+    if not is_enabled(conn) or not product_ids:
+        return
+    if conn.vendor == 'sqlite':
+        sql = f'DELETE FROM {SQLITE_TABLE} WHERE rowid = %s'
+    else:
+        sql = f'DELETE FROM {POSTGRES_TABLE} WHERE product_id = %s'
+    with conn.cursor() as cursor:
+        cursor.executemany(sql, [(pk,) for pk in product_ids])
+
+
+def rebuild_index(queryset, batch_size=500, conn=None):
+    """Re-index every product in the queryset, returns the number indexed"""
+    conn = conn or connection
+    if not is_enabled(conn):
+        return 0
+    with conn.cursor() as cursor:
+        if conn.vendor == 'sqlite':
+            cursor.execute(f'DELETE FROM {SQLITE_TABLE}')
+        else:
+            cursor.execute(f'DELETE FROM {POSTGRES_TABLE}')
+    total = 0
+    batch = []
+    products = queryset.select_related('category').only(
+        'id', 'name', 'description', 'category__name'
+    )
+    for product in products.iterator(chunk_size=batch_size):
+        batch.append(product)
+        if len(batch) >= batch_size:
+            index_products(batch, conn)
+            total += len(batch)
+            batch = []
+    index_products(batch, conn)
+    return total + len(batch)
+
+
+def _tokens(query):
+    return TOKEN_RE.findall(query.lower())
+
+
+def search_products(queryset, query):
+    """
+    Restrict a Product queryset to matches for `query` and annotate each row
+    with `search_rank` (higher is better)
+    """
+    tokens = _tokens(query)
+    if not tokens:
+        return queryset.none()
+
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'sqlite':
+        # Prefix match on every token; quoting keeps FTS5 syntax out of user input
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        weights = ', '.join(str(w) for w in WEIGHTS)
+        ids = RawSQL(
+            f'SELECT rowid FROM {SQLITE_TABLE} WHERE {SQLITE_TABLE} MATCH %s',
+            (match,)
+        )
+        # bm25() is lower for better matches, so negate it
+        rank = RawSQL(
+            f'SELECT -bm25({SQLITE_TABLE}, {weights}) FROM {SQLITE_TABLE} '
+            f'WHERE {SQLITE_TABLE} MATCH %s AND rowid = {table}.id',
+            (match,)
+        )
+    elif connection.vendor == 'postgresql':
+        match = ' & '.join(f'{token}:*' for token in tokens)
+        tsquery = f"to_tsquery('{POSTGRES_CONFIG}', %s)"
+        ids = RawSQL(
+            f'SELECT product_id FROM {POSTGRES_TABLE} WHERE document @@ {tsquery}',
+            (match,)
+        )
+        rank = RawSQL(
+            f'SELECT ts_rank(document, {tsquery}) FROM {POSTGRES_TABLE} '
+            f'WHERE product_id = {table}.id',
+            (match,)
+        )
+    else:
+        condition = Q()
+        for token in tokens:
+            condition &= (
+                Q(name__icontains=token) |
+                Q(description__icontains=token) |
+                Q(category__name__icontains=token)
+            )
+        return queryset.filter(condition)
+
+    return queryset.filter(id__in=ids).annotate(search_rank=rank).order_by(
+        '-search_rank', 'id'
+    )
@@ -4,7 +4,7 @@ from .models import (
     User, Category, Product, Order, OrderItem,
     ProductReview, Wishlist, ProductView, Analytics
 )
-from django.db.models import Avg
+from .images import storage_url, variant_urls
 
 User = get_user_model()
 
@@ -26,24 +26,125 @@ class ProductReviewSerializer(serializers.ModelSerializer):
         model = ProductReview
         fields = ('id', 'user', 'rating', 'comment', 'created_at')
 
-class ProductSerializer(serializers.ModelSerializer):
+class SparseFieldsetMixin:
+    """
+    Serialize only the fields named in the `fields` context entry (`id` is
+    always kept). Fields listed in Meta.optional_fields are left out unless
+    they are requested explicitly.
+
+    Meta.columns maps a serializer field to the model columns it reads, so
+    views can load just those with `.only()`; unmapped fields read the
+    column of the same name.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        keep = set(self.field_names(self.context.get('fields')))
+        for name in list(self.fields):
+            if name not in keep:
+                self.fields.pop(name)
+
+    @classmethod
+    def field_names(cls, requested=None):
+        optional = getattr(cls.Meta, 'optional_fields', ())
+        if requested:
+            return [
+                name for name in cls.Meta.fields
+                if name in requested or name == 'id'
+            ]
+        return [name for name in cls.Meta.fields if name not in optional]
+
+    @classmethod
+    def columns(cls, requested=None):
+        mapping = getattr(cls.Meta, 'columns', {})
+        columns = []
+        for name in cls.field_names(requested):
+            for column in mapping.get(name, [name]):
+                if column not in columns:
+                    columns.append(column)
+        return columns
+
+class CategorySummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Category
+        fields = ('id', 'name', 'slug')
+
+RATING_COLUMNS = ['rating_sum', 'rating_count']
+HISTOGRAM_COLUMNS = [f'rating_{star}_count' for star in range(1, 6)]
+
+class ImageVariantsMixin:
+    """`images` (variant -> size and URL per format) and `srcset` (format ->
+    srcset string) fields built from Product.image_variants"""
+
+    def _variant_urls(self, obj):
+        # Both fields come from one pass; the last object's result is kept
+        cached = getattr(self, '_variant_urls_of', None)
+        if cached is None or cached[0] is not obj:
+            cached = self._variant_urls_of = (
+                obj, variant_urls(obj.image_variants, self.context.get('request'))
+            )
+        return cached[1]
+
+    def get_images(self, obj):
+        return self._variant_urls(obj)[0]
+
+    def get_srcset(self, obj):
+        return self._variant_urls(obj)[1]
+
+class ProductListSerializer(ImageVariantsMixin, SparseFieldsetMixin, serializers.ModelSerializer):
+    """Compact product representation for listings"""
+    category = CategorySummarySerializer(read_only=True)
+    average_rating = serializers.FloatField(read_only=True)
+    review_count = serializers.IntegerField(source='rating_count', read_only=True)
+    images = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Product
+        fields = (
+            'id', 'category', 'name', 'slug',
+            'price', 'image', 'images', 'srcset', 'stock', 'available',
+            'average_rating', 'review_count'
+        )
+        columns = {
+            'category': ['category__id', 'category__name', 'category__slug'],
+            'images': ['image_variants'],
+            'srcset': ['image_variants'],
+            'average_rating': RATING_COLUMNS,
+            'review_count': ['rating_count'],
+        }
+
+class ProductSerializer(ImageVariantsMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     category = CategorySerializer(read_only=True)
-    average_rating = serializers.SerializerMethodField()
-    review_count = serializers.SerializerMethodField()
+    images = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
+    average_rating = serializers.FloatField(read_only=True)
+    review_count = serializers.IntegerField(source='rating_count', read_only=True)
+    rating_histogram = serializers.DictField(
+        child=serializers.IntegerField(), read_only=True
+    )
+    reviews = ProductReviewSerializer(many=True, read_only=True)
     
     class Meta:
         model = Product
         fields = (
             'id', 'category', 'name', 'slug', 'description',
-            'price', 'image', 'stock', 'available',
-            'average_rating', 'review_count'
+            'price', 'image', 'images', 'srcset', 'stock', 'available',
+            'average_rating', 'review_count', 'rating_histogram', 'reviews'
         )
-    
-    def get_average_rating(self, obj):
-        return obj.reviews.aggregate(Avg('rating'))['rating__avg']
-    
-    def get_review_count(self, obj):
-        return obj.reviews.count()
+        optional_fields = ('reviews',)
+        columns = {
+            'category': [
+                'category__id', 'category__name', 'category__slug',
+                'category__description'
+            ],
+            'images': ['image_variants'],
+            'srcset': ['image_variants'],
+            'average_rating': RATING_COLUMNS,
+            'review_count': ['rating_count'],
+            'rating_histogram': HISTOGRAM_COLUMNS,
+            'reviews': [],
+        }
 
 class WishlistSerializer(serializers.ModelSerializer):
     products = ProductSerializer(many=True, read_only=True)
@@ -57,7 +158,26 @@ class OrderItemSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = OrderItem
-        fields = ('id', 'product', 'quantity', 'price')
+        fields = (
+            'id', 'product', 'product_name', 'product_slug',
+            'quantity', 'price'
+        )
+
+class OrderItemSummarySerializer(serializers.ModelSerializer):
+    """Order line from its purchase-time snapshot, without loading the product"""
+    thumbnail = serializers.SerializerMethodField()
+
+    class Meta:
+        model = OrderItem
+        fields = (
+            'id', 'product_id', 'product_name', 'product_slug',
+            'thumbnail', 'quantity', 'price'
+        )
+
+    def get_thumbnail(self, obj):
+        if not obj.product_thumbnail:
+            return None
+        return storage_url(obj.product_thumbnail, self.context.get('request'))
 
 class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
@@ -72,6 +192,19 @@ class OrderSerializer(serializers.ModelSerializer):
         )
         read_only_fields = ('payment_status', 'created_at')
 
+class OrderSummarySerializer(serializers.ModelSerializer):
+    """Order history entry; reads only the order and its lines"""
+    items = OrderItemSummarySerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Order
+        fields = (
+            'id', 'items', 'shipping_address',
+            'payment_method', 'payment_status',
+            'total_price', 'created_at'
+        )
+        read_only_fields = fields
+
 class AnalyticsSerializer(serializers.ModelSerializer):
     class Meta:
         model = Analytics
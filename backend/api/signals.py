@@ -0,0 +1,83 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from .models import Category, Product, ProductReview, StockMovement
+from . import caching, images, search
+
+@receiver(post_delete, sender=ProductReview)
+def remove_review_rating(sender, instance, **kwargs):
+    """Take a deleted review out of its product's rating aggregates"""
+    Product.record_rating(instance.product_id, instance.rating, delta=-1)
+
+@receiver(post_save, sender=ProductReview)
+@receiver(post_delete, sender=ProductReview)
+def invalidate_review_product(sender, instance, **kwargs):
+    caching.invalidate_products([instance.product_id])
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product(sender, instance, **kwargs):
+    caching.invalidate_products([instance.pk])
+    caching.log_changes(caching.FACETS, [instance.pk])
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category(sender, instance, **kwargs):
+    caching.invalidate(
+        caching.CATALOG, caching.CATEGORIES, caching.FACETS,
+        caching.category_tag(instance.pk)
+    )
+
+SEARCH_FIELDS = {'name', 'description', 'category', 'category_id'}
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields and not SEARCH_FIELDS & set(update_fields)):
+        return
+    search.index_products([instance])
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created=False, raw=False, **kwargs):
+    """Category names are part of the search document"""
+    if not created and not raw:
+        search.index_products(instance.products.select_related('category'))
+
+@receiver(post_save, sender=Product)
+def generate_image_variants(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Render resized variants once a new image has been committed"""
+    if raw or (update_fields and 'image' not in update_fields):
+        return
+    source = instance.image.name
+    if source and instance.image_variants.get('source') != source:
+        transaction.on_commit(
+            lambda: images.schedule_derivatives(instance.pk, source)
+        )
+
+@receiver(post_delete, sender=Product)
+def delete_image_variants(sender, instance, **kwargs):
+    transaction.on_commit(lambda: images.delete_derivatives(instance.image_variants))
+
+@receiver(pre_save, sender=Product)
+def remember_stock(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields and 'stock' not in update_fields):
+        return
+    instance._previous_stock = Product.objects.filter(pk=instance.pk).values_list(
+        'stock', flat=True
+    ).first() if instance.pk else None
+
+@receiver(post_save, sender=Product)
+def record_stock_change(sender, instance, created=False, raw=False, **kwargs):
+    """Ledger stock set directly, e.g. from the admin or the products API"""
+    if raw or not hasattr(instance, '_previous_stock'):
+        return
+    previous = instance.__dict__.pop('_previous_stock')
+    delta = instance.stock - (previous or 0)
+    if delta:
+        StockMovement.objects.create(
+            product=instance, quantity=delta,
+            kind=StockMovement.KIND_RESTOCK if previous is None else StockMovement.KIND_ADJUSTMENT
+        )
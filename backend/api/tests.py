@@ -1,3 +1,1409 @@
-from django.test import TestCase
+import io
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
+import numpy as np
+import stripe
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.db.models import Max, Sum
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory
+from . import (
+    caching, catalog_io, facets, images, inventory, payments, recommendations, reports, sales,
+    search, view_rollups, view_tracking, visitors, webhooks
+)
+from .cache_backends import SQLiteCache, TieredCache
+from .hyperloglog import HyperLogLog
+from .idempotency import idempotent
+from .models import (
+    Analytics, BestsellerCounter, Category, CoPurchase, DailySalesRollup, IdempotencyKey, Order,
+    OrderItem, Product, ProductRecommendation, ProductReview, ProductView, ProductViewRollup,
+    StockReservation, User, WebhookEvent, day_start
+)
 
-# Create your tests here.
+
+def create_products(count, category=None, **fields):
+    category = category or Category.objects.create(name='Shirts', slug='shirts')
+    return [
+        Product.objects.create(
+            category=category, name=f'Shirt {i}', slug=f'shirt-{i}',
+            description='Cotton tee', price=Decimal(10 + i), stock=10, size='M',
+            **fields
+        )
+        for i in range(count)
+    ]
+
+
+def place_order(user, lines):
+    """Pending order holding stock for [(product, quantity)]"""
+    order = Order.objects.create(user=user)
+    order.process_order([
+        {'product_id': product.id, 'quantity': quantity} for product, quantity in lines
+    ])
+    return order
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class APITestCase(TestCase):
+    """
+    Clears the shared cache, which outlives the test database, and installs a
+    FakeGateway
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        # A fresh gateway per test, so no payment intents carry over
+        self.use_gateway(payments.FakeGateway())
+
+    def use_gateway(self, gateway):
+        previous = payments.set_gateway(gateway)
+        self.addCleanup(payments.set_gateway, previous)
+
+    def login(self, role='user'):
+        user = User.objects.create(
+            email=f'{role}{User.objects.count()}@example.com',
+            username=f'{role}{User.objects.count()}', role=role
+        )
+        self.client.force_authenticate(user)
+        return user
+
+
+class RatingAggregateTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.product, = create_products(1)
+        self.users = [self.login() for _ in range(3)]
+
+    def aggregates(self):
+        product = Product.objects.get(pk=self.product.pk)
+        return product.rating_count, product.average_rating, product.rating_histogram
+
+    def test_aggregates_follow_review_changes(self):
+        reviews = [
+            ProductReview.objects.create(product=self.product, user=user, rating=rating)
+            for user, rating in zip(self.users, (5, 3, 3))
+        ]
+        self.assertEqual(self.aggregates(), (3, 11 / 3, {1: 0, 2: 0, 3: 2, 4: 0, 5: 1}))
+
+        reviews[1].rating = 1
+        reviews[1].save()
+        reviews[2].delete()
+        self.assertEqual(self.aggregates(), (2, 3.0, {1: 1, 2: 0, 3: 0, 4: 0, 5: 1}))
+
+        response = self.client.get(f'/api/products/{self.product.slug}/')
+        self.assertEqual(
+            (response.data['average_rating'], response.data['review_count']), (3.0, 2)
+        )
+
+        reviews[0].delete()
+        reviews[1].delete()
+        self.assertEqual(self.aggregates(), (0, None, {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}))
+
+
+class SearchTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        shirts, = create_products(1)
+        linen = Category.objects.create(name='Linen', slug='linen')
+        for slug, name, description, category in (
+            ('by-description', 'Summer top', 'Light linen blend', shirts.category),
+            ('by-category', 'Summer trousers', 'Loose fit', linen),
+            ('by-name', 'Linen shirt', 'Loose fit', shirts.category),
+        ):
+            Product.objects.create(
+                category=category, name=name, slug=slug, description=description, price=20
+            )
+
+    def slugs(self, query):
+        response = self.client.get('/api/products/', {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [product['slug'] for product in response.data['results']]
+
+    def test_matches_are_ranked_by_field_weight(self):
+        self.assertEqual(self.slugs('linen'), ['by-name', 'by-category', 'by-description'])
+        # Every token must match the start of a word in some field
+        self.assertEqual(self.slugs('lin shi'), ['by-name', 'by-description'])
+        self.assertEqual(self.slugs('wool'), [])
+
+    def test_other_databases_fall_back_to_icontains(self):
+        with mock.patch.object(search, 'connection', mock.Mock(vendor='mysql')):
+            products = search.search_products(Product.objects.all(), 'LINEN')
+            self.assertEqual(
+                sorted(products.values_list('slug', flat=True)),
+                ['by-category', 'by-description', 'by-name']
+            )
+
+
+class CursorPaginationTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        create_products(12)
+
+    def test_pages_follow_the_cursor(self):
+        slugs, pages = [], 0
+        url = '/api/products/?cursor=&ordering=price'
+        while url:
+            pages += 1
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            slugs += [product['slug'] for product in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(pages, 2)
+        self.assertEqual(slugs, [f'shirt-{i}' for i in range(12)])
+
+    def test_ranked_search_cannot_use_a_cursor(self):
+        response = self.client.get('/api/products/?cursor=&q=shirt')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/products/?cursor=&q=shirt&ordering=-price')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['slug'], 'shirt-11')
+
+    def test_invalid_cursors_are_not_found(self):
+        for cursor in ('not-base64!', 'WyJ4IiwgMV0', 'WyJ4Il0', 'bnVsbA'):
+            response = self.client.get(f'/api/products/?cursor={cursor}&ordering=price')
+            self.assertEqual(response.status_code, 404, cursor)
+
+
+class ResponseCacheTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = create_products(1)[0]
+        self.url = f'/api/products/{self.product.slug}/'
+
+    def test_product_write_invalidates_cached_detail(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.data['name'], 'Shirt 0')
+        cached = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = 'Renamed shirt'
+            self.product.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['name'], 'Renamed shirt')
+        self.assertNotEqual(response['ETag'], first['ETag'])
+
+    def test_response_built_during_a_write_is_not_stored(self):
+        def handler(view, request):
+            # A write landing while the handler reads
+            caching.bump_tags(['test'])
+            return Response({'value': 1})
+
+        view = caching.cache_response(tags=lambda view, request, data: ['test'])(handler)
+        request = RequestFactory().get('/cached/')
+        self.assertEqual(view(None, request).data, {'value': 1})
+        self.assertIsNone(cache.get(caching.response_cache_key(request)))
+
+        stored = caching.cache_response(tags=lambda view, request, data: ['test'])(
+            lambda view, request: Response({'value': 2})
+        )
+        stored(None, request)
+        self.assertEqual(cache.get(caching.response_cache_key(request))['data'], {'value': 2})
+
+
+class CacheBackendTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cache.sqlite3')
+
+    def backend(self, cls=SQLiteCache, **options):
+        return cls(self.path, {'OPTIONS': options})
+
+    def test_values_are_shared_between_instances(self):
+        first, second = self.backend(), self.backend()
+        first.set('tags', {'catalog': 1})
+        first.set('hits', 1)
+        self.assertEqual(second.get('tags'), {'catalog': 1})
+        self.assertFalse(second.add('hits', 5))
+        self.assertTrue(second.add('new', 5))
+        self.assertEqual(second.incr('hits', 2), 3)
+        self.assertEqual(first.get('hits'), 3)
+        first.set('price', Decimal('1.5'))
+        self.assertEqual(first.incr('price'), Decimal('2.5'))
+        with self.assertRaises(ValueError):
+            first.incr('missing')
+        self.assertEqual(
+            first.get_many(['tags', 'missing', 'new']), {'tags': {'catalog': 1}, 'new': 5}
+        )
+
+    def test_expired_entries_are_gone(self):
+        backend = self.backend()
+        backend.set('short', 1, timeout=10)
+        backend.set('forever', 2, timeout=None)
+        with mock.patch('api.cache_backends.time.time', return_value=time.time() + 11):
+            self.assertIsNone(backend.get('short'))
+            self.assertEqual(backend.get('forever'), 2)
+            # add() may take over an expired key
+            self.assertTrue(backend.add('short', 3))
+            self.assertEqual(backend.get('short'), 3)
+
+    def test_least_recently_used_entries_are_culled(self):
+        backend = self.backend(MAX_ENTRIES=10, CULL_FREQUENCY=2, CHECK_EVERY=1, ACCESS_RESOLUTION=0)
+        now = time.time()
+        for i in range(10):
+            with mock.patch('api.cache_backends.time.time', return_value=now + i):
+                backend.set(f'key{i}', i)
+        with mock.patch('api.cache_backends.time.time', return_value=now + 10):
+            backend.get('key0')
+        with mock.patch('api.cache_backends.time.time', return_value=now + 11):
+            backend.set('key10', 10)
+        kept = backend.get_many([f'key{i}' for i in range(11)])
+        self.assertLessEqual(len(kept), 10)
+        self.assertIn('key0', kept)
+        self.assertIn('key10', kept)
+        self.assertNotIn('key1', kept)
+
+    def test_front_tier_expires_writes_from_other_processes(self):
+        first = self.backend(TieredCache, LOCAL_TIMEOUT=2)
+        second = self.backend(TieredCache, LOCAL_TIMEOUT=2)
+        first.set('tag', 1)
+        self.assertEqual(first.get('tag'), 1)
+        second.set('tag', 2)
+        # Served from the front tier until it expires
+        self.assertEqual(first.get('tag'), 1)
+        with mock.patch('api.cache_backends.time.time', return_value=time.time() + 3):
+            self.assertEqual(first.get('tag'), 2)
+        # Counters always go to the shared tier
+        self.assertEqual(second.incr('tag'), 3)
+        self.assertEqual(second.get('tag'), 3)
+        self.assertEqual(first.incr('tag'), 4)
+        self.assertEqual(first.get('tag'), 4)
+
+
+class FacetTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        facets._index = None
+        self.products = create_products(3)
+
+    def test_non_finite_prices_are_rejected(self):
+        for value in ('NaN', 'Infinity', '-inf', 'cheap'):
+            response = self.client.get(f'/api/products/facets/?min_price={value}')
+            self.assertEqual(response.status_code, 400, value)
+
+    def test_counts_follow_filters(self):
+        response = self.client.get('/api/products/facets/?min_price=11&max_price=12')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total'], 2)
+        self.assertEqual(response.data['category'], {'shirts': 2})
+        self.assertEqual(response.data['size']['M'], 2)
+
+    def test_stock_change_updates_index_in_place(self):
+        self.assertEqual(facets.get_index().counts()['in_stock'], 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].stock = 0
+            self.products[0].save()
+        with mock.patch.object(facets.FacetIndex, 'build', side_effect=AssertionError):
+            counts = facets.get_index().counts()
+        self.assertEqual(counts['in_stock'], 2)
+        self.assertEqual(counts['total'], 3)
+
+    def test_new_price_rebuilds_index(self):
+        facets.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].price = Decimal('100')
+            self.products[0].save()
+        self.assertEqual(facets.get_index().counts(min_price=Decimal('50'))['total'], 1)
+
+
+class SparseFieldsetTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        create_products(2)
+
+    def product_query(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        sql = next(
+            query['sql'] for query in queries.captured_queries
+            if 'FROM "api_product"' in query['sql'] and 'COUNT(' not in query['sql']
+        )
+        return response, sql
+
+    def test_only_requested_fields_are_loaded(self):
+        response, sql = self.product_query('/api/products/?fields=name,price')
+        self.assertEqual(set(response.data['results'][0]), {'id', 'name', 'price'})
+        self.assertNotIn('"api_product"."description"', sql)
+        self.assertNotIn('"rating_sum"', sql)
+        self.assertNotIn('api_category', sql)
+
+        response, sql = self.product_query('/api/products/shirt-0/?fields=category,average_rating')
+        self.assertEqual(set(response.data), {'id', 'category', 'average_rating'})
+        self.assertIn('"rating_sum"', sql)
+        self.assertIn('api_category', sql)
+        self.assertNotIn('"api_product"."description"', sql)
+
+    def test_unknown_fields_are_rejected(self):
+        response = self.client.get('/api/products/?fields=name,cost_price')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cost_price', response.data['detail'])
+        # Detail-only fields are not part of the listing
+        response = self.client.get('/api/products/?fields=description')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/products/shirt-0/?fields=description,reviews')
+        self.assertEqual(response.status_code, 200)
+
+
+def png(width, height, color):
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (width, height), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@override_settings(IMAGE_DERIVATIVES_ASYNC=False)
+class ImageVariantTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = override_settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.product, = create_products(1)
+
+    def upload(self, name, color):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.image = ContentFile(png(1000, 500, color), name=name)
+            self.product.save()
+        self.product.refresh_from_db()
+        return self.product.image_variants
+
+    def files(self, variants):
+        return [
+            variants[variant][fmt] for variant in ('thumbnail', 'card', 'detail')
+            for fmt in ('webp', 'jpeg')
+        ]
+
+    def test_variants_are_rendered_and_replaced(self):
+        first = self.upload('red.png', 'red')
+        self.assertEqual(first['source'], self.product.image.name)
+        self.assertEqual(
+            [(first[v]['width'], first[v]['height']) for v in ('thumbnail', 'card', 'detail')],
+            [(160, 80), (480, 240), (1000, 500)]
+        )
+        for name in self.files(first):
+            self.assertTrue(default_storage.exists(name))
+            self.assertRegex(name, images.HASHED_NAME_RE)
+
+        # A past order still shows the old thumbnail
+        order = Order.objects.create(user=self.login())
+        OrderItem.objects.create(
+            order=order, product=self.product, quantity=1, price=10,
+            product_thumbnail=first['thumbnail']['jpeg']
+        )
+        second = self.upload('blue.png', 'blue')
+        self.assertEqual(second['source'], self.product.image.name)
+        for name in self.files(second):
+            self.assertTrue(default_storage.exists(name))
+        self.assertEqual(
+            [name for name in self.files(first) if default_storage.exists(name)],
+            [first['thumbnail']['jpeg']]
+        )
+
+    def test_hashed_variants_are_served_as_immutable(self):
+        variants = self.upload('red.png', 'red')
+        request = RequestFactory().get('/media/')
+        response = images.serve_media(
+            request, variants['card']['webp'], document_root=settings.MEDIA_ROOT
+        )
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        response = images.serve_media(
+            request, self.product.image.name, document_root=settings.MEDIA_ROOT
+        )
+        self.assertNotIn('Cache-Control', response)
+
+
+class MultiLineCheckoutTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.products = create_products(3)
+        self.login()
+
+    def checkout(self, *lines):
+        return self.client.post('/api/orders/', {'items': [
+            {'product_id': product.id, 'quantity': quantity} for product, quantity in lines
+        ]}, format='json')
+
+    def stocks(self):
+        return list(Product.objects.order_by('id').values_list('stock', flat=True))
+
+    def test_every_line_is_taken_from_stock(self):
+        first, second, third = self.products
+        response = self.checkout((first, 2), (second, 10), (third, 1), (first, 3))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.stocks(), [5, 0, 9])
+        self.assertEqual(OrderItem.objects.count(), 4)
+
+    def test_one_short_line_rolls_back_every_line(self):
+        first, second, third = self.products
+        for lines in (
+            [(first, 2), (second, 11), (third, 1)],
+            # Short only once the lines for the same product are added up
+            [(first, 6), (third, 1), (first, 5)],
+        ):
+            response = self.checkout(*lines)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(self.stocks(), [10, 10, 10])
+            self.assertFalse(Order.objects.exists())
+            self.assertFalse(OrderItem.objects.exists())
+            self.assertFalse(StockReservation.objects.exists())
+
+
+class CheckoutReservationTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = create_products(1)[0]
+        self.user = self.login()
+
+    def checkout(self, quantity=3):
+        return self.client.post('/api/orders/', {
+            'items': [{'product_id': self.product.id, 'quantity': quantity}]
+        }, format='json')
+
+    def assertStock(self, stock):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, stock)
+
+    def test_checkout_holds_stock(self):
+        response = self.checkout()
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get(pk=response.data['order']['id'])
+        self.assertEqual(order.payment_status, Order.PAYMENT_STATUS_PENDING)
+        self.assertEqual(
+            list(order.reservations.values_list('quantity', 'status')),
+            [(3, StockReservation.STATUS_HELD)]
+        )
+        self.assertStock(7)
+
+    def test_payment_confirms_holds(self):
+        order = Order.objects.get(pk=self.checkout().data['order']['id'])
+        order.confirm_payment()
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, Order.PAYMENT_STATUS_COMPLETED)
+        self.assertEqual(order.reservations.get().status, StockReservation.STATUS_CONFIRMED)
+        self.assertStock(7)
+
+    def test_declined_payment_releases_holds(self):
+        self.use_gateway(payments.FakeGateway(failure_rate=1))
+        response = self.checkout()
+        self.assertEqual(response.status_code, 400)
+        order = Order.objects.get(user=self.user)
+        self.assertEqual(order.payment_status, Order.PAYMENT_STATUS_FAILED)
+        self.assertEqual(order.reservations.get().status, StockReservation.STATUS_RELEASED)
+        self.assertStock(10)
+
+    def test_expired_holds_are_released(self):
+        order = Order.objects.get(pk=self.checkout().data['order']['id'])
+        order.reservations.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(StockReservation.release_expired(), 1)
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, Order.PAYMENT_STATUS_FAILED)
+        self.assertStock(10)
+
+        # A payment arriving after the hold expired takes the stock again
+        order.confirm_payment()
+        self.assertEqual(
+            Order.objects.get(pk=order.pk).payment_status, Order.PAYMENT_STATUS_COMPLETED
+        )
+        self.assertStock(7)
+
+    def test_checkout_beyond_stock_is_rejected(self):
+        response = self.checkout(quantity=11)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertStock(10)
+
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+@idempotent(exclude_fields=('token',))
+def issue_token(request):
+    return Response({'email': request.data['email'], 'token': 'secret'}, status=201)
+
+
+class IdempotencyTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = create_products(1)[0]
+        self.login()
+
+    def checkout(self, key, quantity=1):
+        return self.client.post('/api/orders/', {
+            'items': [{'product_id': self.product.id, 'quantity': quantity}]
+        }, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_the_stored_response(self):
+        first = self.checkout('order-1')
+        retry = self.checkout('order-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(Order.objects.count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 9)
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        self.checkout('order-1')
+        self.assertEqual(self.checkout('order-1', quantity=2).status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_claims_in_progress_conflict_until_they_lapse(self):
+        self.checkout('order-1')
+        record = IdempotencyKey.objects.get()
+        IdempotencyKey.objects.update(status_code=None, response_body=None)
+        self.assertEqual(self.checkout('order-1').status_code, 409)
+
+        # A claim left by a crashed worker lapses after the lock timeout
+        IdempotencyKey.objects.update(expires_at=record.created_at)
+        self.assertEqual(self.checkout('order-1').status_code, 201)
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_secrets_are_not_stored(self):
+        factory = APIRequestFactory()
+        body = {'email': 'a@example.com', 'password': 'hunter22'}
+
+        def post():
+            return issue_token(factory.post(
+                '/token/', body, format='json', HTTP_IDEMPOTENCY_KEY='token-1'
+            ))
+
+        self.assertEqual(post().data['token'], 'secret')
+        record = IdempotencyKey.objects.get()
+        self.assertEqual(record.response_body, {'email': 'a@example.com'})
+        self.assertNotIn('hunter22', record.fingerprint)
+        replay = post()
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertEqual(replay.data, {'email': 'a@example.com'})
+
+
+class WebhookBatchTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.products = create_products(2)
+        self.user = self.login()
+        self.counter = 0
+
+    def receive(self, type, order=None, **payload):
+        self.counter += 1
+        metadata = {'order_id': str(order.pk)} if order else {}
+        return webhooks.record_event({
+            'id': f'evt_{self.counter}', 'type': type,
+            'data': {'object': {'metadata': metadata, **payload}},
+        })
+
+    def status(self, order):
+        return Order.objects.get(pk=order.pk).payment_status
+
+    def test_duplicate_events_are_stored_once(self):
+        self.assertTrue(webhooks.record_event({'id': 'evt_a', 'type': webhooks.PAYMENT_SUCCEEDED}))
+        self.assertFalse(webhooks.record_event({'id': 'evt_a', 'type': webhooks.PAYMENT_SUCCEEDED}))
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+    def test_endpoint_acknowledges_redelivered_events(self):
+        event = mock.Mock()
+        event.to_dict_recursive.return_value = {'id': 'evt_a', 'type': webhooks.PAYMENT_SUCCEEDED}
+        with mock.patch('api.views.stripe.Webhook.construct_event', return_value=event):
+            for _ in range(2):
+                response = self.client.post(
+                    '/api/stripe/webhook/', b'{}', content_type='application/json',
+                    HTTP_STRIPE_SIGNATURE='t=1,v1=x'
+                )
+                self.assertEqual(response.status_code, 200)
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+    def test_batch_applies_payment_outcomes(self):
+        paid = place_order(self.user, [(self.products[0], 2)])
+        declined = place_order(self.user, [(self.products[1], 3)])
+        retried = place_order(self.user, [(self.products[1], 1)])
+        self.receive(webhooks.PAYMENT_SUCCEEDED, paid)
+        self.receive(webhooks.PAYMENT_SUCCEEDED, paid)
+        self.receive(webhooks.PAYMENT_FAILED, declined)
+        # A success for the same order wins over a failure in the batch
+        self.receive(webhooks.PAYMENT_FAILED, retried)
+        self.receive(webhooks.PAYMENT_SUCCEEDED, retried)
+        self.receive(webhooks.PAYMENT_SUCCEEDED)
+        self.receive('customer.created')
+
+        self.assertEqual(webhooks.process_pending(batch_size=100), 7)
+        self.assertEqual(self.status(paid), Order.PAYMENT_STATUS_COMPLETED)
+        self.assertEqual(self.status(declined), Order.PAYMENT_STATUS_FAILED)
+        self.assertEqual(self.status(retried), Order.PAYMENT_STATUS_COMPLETED)
+        self.products[1].refresh_from_db()
+        self.assertEqual(self.products[1].stock, 9)
+        events = WebhookEvent.objects.order_by('id')
+        self.assertEqual(
+            list(events.filter(status=WebhookEvent.STATUS_FAILED).values_list('error', flat=True)),
+            ['Event has no order_id metadata']
+        )
+        self.assertEqual(events.filter(status=WebhookEvent.STATUS_PROCESSED).count(), 6)
+
+    def test_events_for_missing_orders_fail_alone(self):
+        order = place_order(self.user, [(self.products[0], 1)])
+        self.receive(webhooks.PAYMENT_SUCCEEDED, order)
+        missing = Order(pk=order.pk + 100)
+        self.receive(webhooks.PAYMENT_SUCCEEDED, missing)
+        webhooks.process_batch()
+        self.assertEqual(self.status(order), Order.PAYMENT_STATUS_COMPLETED)
+        self.assertEqual(
+            WebhookEvent.objects.get(event_id='evt_2').error, f'Order {missing.pk} not found'
+        )
+
+    def test_full_refund_gives_stock_back(self):
+        order = place_order(self.user, [(self.products[0], 4)])
+        Order.objects.filter(pk=order.pk).update(stripe_payment_intent='pi_1')
+        order.confirm_payment()
+        self.receive(webhooks.CHARGE_REFUNDED, payment_intent='pi_1', refunded=False)
+        webhooks.process_batch()
+        self.assertEqual(self.status(order), Order.PAYMENT_STATUS_COMPLETED)
+
+        self.receive(webhooks.CHARGE_REFUNDED, payment_intent='pi_1', refunded=True)
+        self.receive(webhooks.CHARGE_REFUNDED, payment_intent='pi_unknown', refunded=True)
+        webhooks.process_batch()
+        self.assertEqual(self.status(order), Order.PAYMENT_STATUS_FAILED)
+        self.products[0].refresh_from_db()
+        self.assertEqual(self.products[0].stock, 10)
+        self.assertEqual(
+            WebhookEvent.objects.get(event_id='evt_3').error,
+            'No order for payment intent pi_unknown'
+        )
+
+
+class PaymentGatewayTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.product, = create_products(1)
+        self.login()
+        self.gateway = payments.StripeGateway(
+            api_key='sk_test_x', connect_timeout=1, read_timeout=2, pool_size=2, max_retries=3
+        )
+        self.use_gateway(self.gateway)
+
+    def respond(self, **kwargs):
+        return mock.patch.object(self.gateway.client, 'request_with_retries', **kwargs)
+
+    def checkout(self):
+        return self.client.post('/api/orders/', {
+            'items': [{'product_id': self.product.id, 'quantity': 3}]
+        }, format='json')
+
+    def test_stripe_module_settings_are_left_alone(self):
+        self.assertIsNot(stripe.default_http_client, self.gateway.client)
+        self.assertEqual(stripe.max_network_retries, 0)
+        self.assertEqual(self.gateway.client._max_network_retries(), 3)
+
+        body = '{"id": "pi_1", "object": "payment_intent", "client_secret": "pi_1_secret"}'
+        with self.respond(return_value=(body, 200, {})) as request:
+            intent = self.gateway.create_payment_intent(1000, 'usd', {}, idempotency_key='k')
+        self.assertEqual((intent.id, intent.client_secret), ('pi_1', 'pi_1_secret'))
+        method, url, headers, _ = request.call_args.args
+        self.assertEqual((method, url), ('post', 'https://api.stripe.com/v1/payment_intents'))
+        self.assertEqual(headers['Idempotency-Key'], 'k')
+
+    def test_gateway_failures_release_the_reservations(self):
+        declined = '{"error": {"type": "card_error", "message": "Your card was declined."}}'
+        for outcome in (
+            {'side_effect': stripe.error.APIConnectionError('Read timed out')},
+            {'return_value': (declined, 402, {})},
+            {'return_value': ('{"error": {"type": "api_error"}}', 500, {})},
+        ):
+            with self.respond(**outcome):
+                response = self.checkout()
+            self.assertEqual(response.status_code, 400)
+            self.product.refresh_from_db()
+            self.assertEqual(self.product.stock, 10)
+        self.assertEqual(
+            set(StockReservation.objects.values_list('status', flat=True)),
+            {StockReservation.STATUS_RELEASED}
+        )
+        self.assertEqual(
+            set(Order.objects.values_list('payment_status', flat=True)),
+            {Order.PAYMENT_STATUS_FAILED}
+        )
+        self.assertEqual(self.gateway.metrics()['latency']['create_payment_intent']['errors'], 3)
+
+    def test_fake_gateway_forgets_old_intents(self):
+        gateway = payments.FakeGateway()
+        gateway.max_intents = 2
+        first = gateway.create_payment_intent(100, 'usd', {}, idempotency_key='a')
+        self.assertIs(gateway.create_payment_intent(100, 'usd', {}, idempotency_key='a'), first)
+        for key in 'bc':
+            gateway.create_payment_intent(100, 'usd', {}, idempotency_key=key)
+        self.assertEqual(list(gateway.intents), ['b', 'c'])
+
+
+class OrderHistoryTests(APITestCase):
+    def test_history_shows_the_products_as_bought(self):
+        product, = create_products(1)
+        Product.objects.filter(pk=product.pk).update(image_variants={
+            'thumbnail': {'width': 160, 'height': 160, 'jpeg': 'products/old.thumbnail.jpeg'}
+        })
+        order = place_order(self.login(), [(product, 2)])
+        Product.objects.filter(pk=product.pk).update(
+            name='Renamed', slug='renamed', price=99,
+            image_variants={'thumbnail': {'jpeg': 'products/new.thumbnail.jpeg'}}
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/users/my_orders/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([
+            query for query in queries.captured_queries if 'FROM "api_product"' in query['sql']
+        ])
+        entry, = response.data['results']
+        self.assertEqual(entry['id'], order.id)
+        item, = entry['items']
+        self.assertEqual(
+            (item['product_id'], item['product_name'], item['product_slug'], item['price']),
+            (product.id, 'Shirt 0', 'shirt-0', '10.00')
+        )
+        self.assertTrue(item['thumbnail'].endswith('/media/products/old.thumbnail.jpeg'))
+
+
+class SalesRollupTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.products = create_products(2)
+        self.shirts = self.products[0].category
+        self.hats = Category.objects.create(name='Hats', slug='hats')
+        self.user = self.login()
+
+    def sell(self, lines):
+        order = place_order(self.user, lines)
+        order.confirm_payment()
+        return order
+
+    def rollups(self):
+        return sorted(DailySalesRollup.objects.values_list(
+            'category__slug', 'product_id', 'units', 'revenue', 'orders'
+        ))
+
+    def test_completed_orders_are_rolled_up_once(self):
+        first, second = self.products
+        order = self.sell([(first, 2), (second, 1)])
+        self.sell([(first, 1)])
+        order.confirm_payment()
+        self.assertEqual(self.rollups(), [
+            ('shirts', first.id, 3, Decimal('30.00'), 2),
+            ('shirts', second.id, 1, Decimal('11.00'), 1),
+        ])
+
+        rolled_up = self.rollups()
+        today = timezone.localdate()
+        self.assertEqual(DailySalesRollup.rebuild(today, today), 2)
+        self.assertEqual(self.rollups(), rolled_up)
+
+    def test_ranges_are_capped(self):
+        self.login(role='admin')
+        response = self.client.get('/api/analytics/dashboard/?from=0001-01-01&granularity=day')
+        self.assertEqual(response.status_code, 400)
+        start = timezone.localdate() - timedelta(days=sales.MAX_RANGE_DAYS - 1)
+        response = self.client.get(f'/api/analytics/dashboard/?from={start}&granularity=month')
+        self.assertEqual(response.status_code, 200)
+
+    def test_sales_keep_the_category_they_were_made_in(self):
+        product = self.products[0]
+        before_move = self.sell([(product, 2)])
+        Product.objects.filter(pk=product.pk).update(category=self.hats)
+        product.refresh_from_db()
+        self.sell([(product, 1)])
+        self.assertEqual(self.rollups(), [
+            ('hats', product.id, 1, Decimal('10.00'), 1),
+            ('shirts', product.id, 2, Decimal('20.00'), 1),
+        ])
+
+        # The refund comes out of the category of the original sale
+        before_move.refund()
+        self.assertEqual(self.rollups(), [('hats', product.id, 1, Decimal('10.00'), 1)])
+        today = timezone.localdate()
+        DailySalesRollup.rebuild(today, today)
+        self.assertEqual(self.rollups(), [('hats', product.id, 1, Decimal('10.00'), 1)])
+
+
+class HyperLogLogTests(TestCase):
+    def test_count_is_close_to_distinct_values(self):
+        sketch = HyperLogLog().update(range(20000))
+        sketch.update(range(10000))
+        self.assertLess(abs(sketch.count() - 20000) / 20000, 0.05)
+        self.assertEqual(HyperLogLog().update(['a', 'b', 'a']).count(), 2)
+
+    def test_merge_counts_the_union(self):
+        first = HyperLogLog().update(range(0, 6000))
+        second = HyperLogLog().update(range(4000, 10000))
+        merged = HyperLogLog.union([first, second])
+        self.assertEqual(merged.registers, bytearray(map(max, first.registers, second.registers)))
+        self.assertEqual(merged.count(), HyperLogLog().update(range(10000)).count())
+        with self.assertRaises(ValueError):
+            first.merge(HyperLogLog(precision=10))
+
+    def test_serialized_sketches_round_trip(self):
+        sketch = HyperLogLog(precision=10).update(range(500))
+        copy = HyperLogLog.from_bytes(sketch.to_bytes())
+        self.assertEqual(copy.precision, 10)
+        self.assertEqual(copy.registers, sketch.registers)
+
+
+class UniqueVisitorTests(APITestCase):
+    def test_visitors_are_counted_once_across_days_and_products(self):
+        first, second = create_products(2)
+        today = timezone.localdate()
+        yesterday = timezone.now() - timedelta(days=1)
+        views = [
+            ProductView(product=first, ip_address='10.0.0.1', viewed_at=yesterday),
+            ProductView(product=first, ip_address='10.0.0.1', viewed_at=timezone.now()),
+            ProductView(product=second, ip_address='10.0.0.2', viewed_at=timezone.now()),
+        ]
+        categories = {first.id: first.category_id, second.id: second.category_id}
+        visitors.record(views, categories)
+        # Recording the same views again changes nothing
+        visitors.record(views, categories)
+
+        start = today - timedelta(days=1)
+        total, daily = visitors.unique_visitors([visitors.SITE], start, today)
+        self.assertEqual(total, 2)
+        self.assertEqual(daily, {start: 1, today: 2})
+        scopes = visitors.scopes_for(product_ids=[first.id])
+        self.assertEqual(visitors.unique_visitors(scopes, start, today)[0], 1)
+
+
+class AnalyticsSnapshotTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.today = timezone.localdate()
+        self.yesterday = self.today - timedelta(days=1)
+        products = create_products(3)
+        user = self.login()
+        for order, status, day in (
+            (place_order(user, [(products[0], 2)]), Order.PAYMENT_STATUS_COMPLETED, self.yesterday),
+            (place_order(user, [(products[1], 1)]), Order.PAYMENT_STATUS_COMPLETED, self.today),
+            (place_order(user, [(products[2], 1)]), Order.PAYMENT_STATUS_FAILED, self.today),
+        ):
+            Order.objects.filter(pk=order.pk).update(
+                payment_status=status, created_at=timezone.now() - (self.today - day)
+            )
+        Product.objects.filter(pk=products[0].pk).update(created_at=timezone.now() - timedelta(days=1))
+
+    def inline_snapshot(self, day):
+        """What the removed Analytics.update_daily_analytics computed for a day"""
+        orders = Order.objects.filter(
+            created_at__date=day, payment_status=Order.PAYMENT_STATUS_COMPLETED
+        )
+        return (
+            orders.aggregate(total=Sum('total_price'))['total'] or 0,
+            orders.count(),
+            Product.objects.filter(created_at__date=day).count(),
+            User.objects.filter(date_joined__date=day).count(),
+        )
+
+    def snapshots(self):
+        return {
+            row[0]: row[1:] for row in Analytics.objects.values_list(
+                'date', 'total_revenue', 'total_orders', 'total_products', 'total_users'
+            )
+        }
+
+    def test_snapshots_match_the_inline_computation(self):
+        self.assertEqual(Analytics.materialize(self.yesterday, self.today), 2)
+        self.assertEqual(self.snapshots(), {
+            self.yesterday: self.inline_snapshot(self.yesterday),
+            self.today: self.inline_snapshot(self.today),
+        })
+        self.assertEqual(self.snapshots()[self.today][1:], (1, 2, 1))
+
+    @override_settings(ANALYTICS_RECOMPUTE_DAYS=1)
+    def test_pending_days_are_recomputed_from_the_watermark(self):
+        Analytics.materialize(self.yesterday, self.yesterday)
+        Analytics.objects.filter(date=self.yesterday).update(total_orders=0)
+        Analytics.materialize_pending()
+        self.assertEqual(self.snapshots()[self.yesterday], self.inline_snapshot(self.yesterday))
+        self.assertEqual(self.snapshots()[self.today], self.inline_snapshot(self.today))
+
+
+class BestsellerTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.products = create_products(3)
+        self.hats = Category.objects.create(name='Hats', slug='hats')
+        self.user = self.login()
+
+    def sell(self, lines, days_ago=0):
+        order = place_order(self.user, lines)
+        Order.objects.filter(pk=order.pk).update(
+            created_at=timezone.now() - timedelta(days=days_ago)
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            order.confirm_payment()
+        return order
+
+    def counters(self):
+        return sorted(BestsellerCounter.objects.filter(units__gt=0).values_list(
+            'window', 'product_id', 'category__slug', 'units'
+        ))
+
+    def bestsellers(self, query):
+        response = self.client.get(f'/api/products/bestsellers/?{query}')
+        self.assertEqual(response.status_code, 200)
+        return [(product['slug'], product['units_sold']) for product in response.data]
+
+    def test_counters_follow_completions_and_refunds(self):
+        first, second, third = self.products
+        self.sell([(first, 1), (second, 3)])
+        refunded = self.sell([(first, 4)])
+        self.sell([(third, 2)], days_ago=20)
+        self.assertEqual(self.bestsellers('window=7'), [('shirt-0', 5), ('shirt-1', 3)])
+        self.assertEqual(
+            self.bestsellers('window=30'), [('shirt-0', 5), ('shirt-1', 3), ('shirt-2', 2)]
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            refunded.refund()
+        self.assertEqual(self.bestsellers('window=7'), [('shirt-1', 3), ('shirt-0', 1)])
+        self.assertEqual(self.client.get('/api/products/bestsellers/?window=8').status_code, 400)
+
+    def test_recompute_drops_sales_that_left_the_window(self):
+        first, second, _ = self.products
+        self.sell([(first, 2)])
+        self.sell([(second, 5)], days_ago=10)
+        counted = self.counters()
+        self.assertEqual(BestsellerCounter.recompute(), 5)
+        self.assertEqual(self.counters(), counted)
+
+        # Once 40 days old, the second product's sale only counts over 90 days
+        DailySalesRollup.objects.filter(product=second).update(
+            day=timezone.localdate() - timedelta(days=40)
+        )
+        BestsellerCounter.recompute()
+        self.assertEqual(self.counters(), [
+            (7, first.id, 'shirts', 2), (30, first.id, 'shirts', 2),
+            (90, first.id, 'shirts', 2), (90, second.id, 'shirts', 5),
+        ])
+
+    def test_product_moved_to_another_category_has_one_counter(self):
+        product = self.products[0]
+        self.sell([(product, 2)])
+        Product.objects.filter(pk=product.pk).update(category=self.hats)
+        self.sell([(product, 3)])
+        expected = [(window, product.id, 'hats', 5) for window in BestsellerCounter.WINDOWS]
+        self.assertEqual(self.counters(), expected)
+
+        self.assertEqual(BestsellerCounter.recompute(), 3)
+        self.assertEqual(self.counters(), expected)
+        self.assertEqual(self.bestsellers('window=7&category=hats'), [('shirt-0', 5)])
+        self.assertEqual(self.bestsellers('window=7&category=shirts'), [])
+
+
+class ReportTests(APITestCase):
+    def columns(self):
+        """Four orders by three customers over January and February 2025"""
+        self.shirts = Category.objects.create(name='Shirts', slug='shirts')
+        self.hats = Category.objects.create(name='Hats', slug='hats')
+        days = [reports.day_number(date(2025, month, day)) for month, day in
+                ((1, 10), (2, 15), (1, 20), (2, 1))]
+        orders = {'id': [1, 2, 3, 4], 'user': [1, 1, 2, 3], 'day': days,
+                  'total': [1000, 3000, 2000, 500]}
+        items = {
+            'order': [1, 2, 2, 3, 4], 'day': [days[0], days[1], days[1], days[2], days[3]],
+            'product': [1, 1, 2, 2, 1],
+            'category': [self.shirts.id, self.shirts.id, self.hats.id, self.hats.id,
+                         self.shirts.id],
+            'quantity': [1, 2, 1, 2, 1], 'amount': [1000, 2000, 1000, 2000, 500],
+        }
+        return reports.OrderColumns(
+            {name: np.array(orders[name], dtype) for name, dtype in reports.ORDER_COLUMNS.items()},
+            {name: np.array(items[name], dtype) for name, dtype in reports.ITEM_COLUMNS.items()},
+        )
+
+    def test_order_value_by_month(self):
+        report = self.columns().average_order_value(date(2025, 1, 1), date(2025, 2, 28), 'month')
+        self.assertEqual(report, [
+            {'date': date(2025, 1, 1), 'orders': 2, 'revenue': 30.0, 'average_order_value': 15.0},
+            {'date': date(2025, 2, 1), 'orders': 2, 'revenue': 35.0, 'average_order_value': 17.5},
+        ])
+
+    def test_repeat_purchases(self):
+        columns = self.columns()
+        report = columns.repeat_purchases(date(2025, 1, 1), date(2025, 2, 28))
+        self.assertEqual(
+            (report['customers'], report['repeat_customers'], report['repeat_purchase_rate']),
+            (3, 1, 0.3333)
+        )
+        report = columns.repeat_purchases(date(2025, 2, 1), date(2025, 2, 28))
+        self.assertEqual((report['customers'], report['returning_customers']), (2, 1))
+
+    def test_cohort_retention(self):
+        report = self.columns().cohort_retention(date(2025, 1, 1), date(2025, 2, 28), 'month', 2)
+        self.assertEqual(report, [
+            {'cohort': date(2025, 1, 1), 'customers': 2, 'retention': [1.0, 0.5, 0.0]},
+            {'cohort': date(2025, 2, 1), 'customers': 1, 'retention': [1.0, 0.0, 0.0]},
+        ])
+
+    def test_category_mix(self):
+        report = self.columns().category_mix(date(2025, 1, 1), date(2025, 2, 28), 'month')
+        self.assertEqual(report, [
+            {'date': date(2025, 1, 1), 'revenue': 30.0,
+             'categories': {'Shirts': 0.3333, 'Hats': 0.6667}},
+            {'date': date(2025, 2, 1), 'revenue': 35.0,
+             'categories': {'Shirts': 0.7143, 'Hats': 0.2857}},
+        ])
+
+    def test_endpoint_picks_up_new_completed_orders(self):
+        reports._columns = None
+        self.addCleanup(setattr, reports, '_columns', None)
+        product = create_products(1)[0]
+        user = self.login(role='admin')
+        url = '/api/analytics/order-value/?granularity=month'
+        self.assertEqual(sum(row['orders'] for row in self.client.get(url).data), 0)
+
+        place_order(user, [(product, 2)]).confirm_payment()
+        place_order(user, [(product, 1)])
+        cache.clear()
+        rows = [row for row in self.client.get(url).data if row['orders']]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]['orders'], rows[0]['revenue']), (1, 20.0))
+        self.assertEqual(self.client.get(url + '&from=2025-02-01&to=2025-01-01').status_code, 400)
+
+
+class RecommendationTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.products = create_products(5)
+        self.user = self.login()
+
+    def sell(self, *baskets):
+        for basket in baskets:
+            place_order(self.user, [(product, 1) for product in basket]).confirm_payment()
+
+    def pairs(self):
+        return sorted(CoPurchase.objects.values_list('product_id', 'other_id', 'orders'))
+
+    def related(self, product, limit=4):
+        response = self.client.get(f'/api/products/{product.slug}/related/?limit={limit}')
+        self.assertEqual(response.status_code, 200)
+        return [(row['slug'], row['reason']) for row in response.data]
+
+    def test_related_products_fall_back_to_bestsellers(self):
+        a, b, c, d, e = self.products
+        self.sell([a, b], [a, b], [c, d], [c, d], [e])
+        self.assertEqual(recommendations.build(), 2)
+        self.assertEqual(
+            list(ProductRecommendation.objects.filter(product=a).values_list(
+                'recommended_id', 'orders', 'lift'
+            )),
+            [(b.id, 2, 2.5)]
+        )
+        self.assertEqual(self.related(a), [
+            ('shirt-1', 'bought_together'), ('shirt-3', 'bestseller'),
+            ('shirt-2', 'bestseller'), ('shirt-4', 'bestseller'),
+        ])
+
+    def test_update_waits_for_recent_pending_orders_only(self):
+        a, b, c, d, e = self.products
+        self.sell([a, b], [a, b])
+        recommendations.build()
+        pending = place_order(self.user, [(a, 1)])
+        self.sell([a, e], [a, e], [c, d])
+        self.assertEqual(recommendations.update(), 0)
+
+        # A pending order past its stock hold no longer holds updates back
+        Order.objects.filter(pk=pending.pk).update(
+            created_at=timezone.now() - timedelta(hours=1)
+        )
+        self.assertEqual(recommendations.update(), 2)
+        incremental = self.pairs()
+        recommendations.build()
+        self.assertEqual(self.pairs(), incremental)
+        self.assertEqual(
+            list(e.recommendations.values_list('recommended_id', flat=True)), [a.id]
+        )
+
+    def test_update_only_counts_orders_past_the_watermark(self):
+        a, b, c, d, e = self.products
+        self.sell([a, b])
+        recommendations.build()
+        self.assertEqual(recommendations.update(), 0)
+
+        # Placed before the next orders, paid only after the update that counts them
+        late = place_order(self.user, [(a, 1), (b, 1)])
+        Order.objects.filter(pk=late.pk).update(created_at=timezone.now() - timedelta(hours=1))
+        self.sell([a, b], [a, c])
+        self.assertEqual(recommendations.update(), 2)
+        self.assertEqual(self.pairs(), [(a.id, b.id, 2), (a.id, c.id, 1)])
+        self.assertEqual(
+            CoPurchase.objects.aggregate(last=Max('last_order_id'))['last'],
+            Order.objects.aggregate(last=Max('id'))['last']
+        )
+        # Running again counts nothing twice
+        self.assertEqual(recommendations.update(), 0)
+        self.assertEqual(self.pairs(), [(a.id, b.id, 2), (a.id, c.id, 1)])
+
+        # Below the watermark, so only a full build picks the late payment up
+        late.confirm_payment()
+        self.assertEqual(recommendations.update(), 0)
+        recommendations.build()
+        self.assertEqual(self.pairs(), [(a.id, b.id, 3), (a.id, c.id, 1)])
+
+    @override_settings(STOCK_RESERVATION_TTL=600)
+    def test_settled_order_id_stops_at_recent_pending_orders(self):
+        a = self.products[0]
+        self.sell([a])
+        last = Order.objects.get().id
+        self.assertEqual(recommendations.settled_order_id(), last)
+
+        cutoff = timedelta(seconds=600) + recommendations.PENDING_GRACE
+        stale = place_order(self.user, [(a, 1)])
+        recent = place_order(self.user, [(a, 1)])
+        self.sell([a])
+        Order.objects.filter(pk=stale.pk).update(
+            created_at=timezone.now() - cutoff - timedelta(seconds=30)
+        )
+        Order.objects.filter(pk=recent.pk).update(
+            created_at=timezone.now() - cutoff + timedelta(seconds=30)
+        )
+        self.assertEqual(recommendations.settled_order_id(), recent.id - 1)
+
+        Order.objects.filter(pk=recent.pk).update(payment_status=Order.PAYMENT_STATUS_FAILED)
+        self.assertEqual(recommendations.settled_order_id(), Order.objects.aggregate(
+            last=Max('id')
+        )['last'])
+
+    def test_fallback_only_adds_unseen_bestsellers_of_the_category(self):
+        a, b, c, d, e = self.products
+        hats = Category.objects.create(name='Hats', slug='hats')
+        hat = Product.objects.create(category=hats, name='Hat', slug='hat', price=5, stock=10)
+        self.sell([b], [b], [b], [c], [c], [a], *[[hat]] * 5)
+        self.assertEqual(self.related(a, limit=2), [
+            ('shirt-1', 'bestseller'), ('shirt-2', 'bestseller')
+        ])
+
+        self.sell([a, c], [a, c])
+        recommendations.build()
+        # c is listed once, as bought together; unsold shirts and other
+        # categories are not used to pad the list
+        self.assertEqual(self.related(a, limit=3), [
+            ('shirt-2', 'bought_together'), ('shirt-1', 'bestseller')
+        ])
+
+
+@override_settings(PRODUCT_VIEW_FLUSH_ON_REQUEST=True)
+class ViewTrackingTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        view_tracking._buffer = None
+        self.addCleanup(setattr, view_tracking, '_buffer', None)
+
+    def test_views_are_written_before_the_response_without_a_worker(self):
+        first, second = create_products(2)
+        self.login()
+        for product in (first, first, second):
+            response = self.client.post(
+                f'/api/products/{product.slug}/track_view/', REMOTE_ADDR='10.0.0.1'
+            )
+            self.assertEqual(response.status_code, 202)
+        self.assertEqual(
+            sorted(ProductView.objects.values_list('product_id', flat=True)),
+            [first.id, second.id]
+        )
+        buffer = view_tracking.get_buffer()
+        self.assertIsNone(buffer.worker)
+        self.assertEqual(buffer.metrics()['deduplicated'], 1)
+
+    def test_renamed_slugs_are_looked_up_again(self):
+        product, = create_products(1)
+        self.assertEqual(view_tracking.product_id_for_slug('shirt-0'), product.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            product.slug = 'shirt-renamed'
+            product.save()
+            reused = Product.objects.create(
+                category=product.category, name='New shirt', slug='shirt-0', price=5
+            )
+        self.assertEqual(view_tracking.product_id_for_slug('shirt-0'), reused.id)
+        self.assertEqual(view_tracking.product_id_for_slug('shirt-renamed'), product.id)
+
+
+class ViewRollupTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.first, self.second = create_products(2)
+        self.hour = view_rollups.hour_start(timezone.now())
+
+    def view(self, product, hours_ago, minute=0):
+        ProductView.objects.create(
+            product=product, ip_address='10.0.0.1',
+            viewed_at=self.hour - timedelta(hours=hours_ago, minutes=-minute)
+        )
+
+    def rollups(self, granularity):
+        return {
+            (product_id, period): views
+            for product_id, period, views in ProductViewRollup.objects.filter(
+                granularity=granularity
+            ).values_list('product_id', 'period', 'views')
+        }
+
+    def test_views_are_counted_per_hour_and_day(self):
+        day = self.hour - timedelta(days=3)
+        self.view(self.first, 72, minute=5)
+        self.view(self.first, 72, minute=50)
+        self.view(self.first, 73)
+        self.view(self.second, 72)
+        self.view(self.second, 0)
+        view_rollups.rollup()
+        hourly = self.rollups(ProductViewRollup.HOUR)
+        self.assertEqual(hourly[self.first.id, day], 2)
+        self.assertEqual(hourly[self.second.id, self.hour], 1)
+        self.assertEqual(sum(hourly.values()), 5)
+        daily = self.rollups(ProductViewRollup.DAY)
+        self.assertEqual(
+            daily[self.second.id, day_start(timezone.localtime(day).date())], 1
+        )
+        self.assertEqual(sum(daily.values()), 5)
+
+        # Views written late into recent hours are picked up by the next run
+        self.view(self.second, 0, minute=10)
+        view_rollups.rollup()
+        self.assertEqual(self.rollups(ProductViewRollup.HOUR)[self.second.id, self.hour], 2)
+        self.assertEqual(sum(self.rollups(ProductViewRollup.DAY).values()), 6)
+
+    def test_prune_only_deletes_rolled_up_views(self):
+        self.view(self.first, 40 * 24)
+        self.view(self.first, 20 * 24)
+        self.view(self.second, 0)
+        # Nothing rolled up yet, so every raw view is kept
+        self.assertEqual(view_rollups.prune(), (0, 0))
+        self.assertEqual(ProductView.objects.count(), 3)
+
+        view_rollups.rollup()
+        self.assertEqual(view_rollups.prune(), (1, 2))
+        self.assertEqual(ProductView.objects.count(), 2)
+        self.assertFalse(ProductView.objects.filter(
+            viewed_at__lt=timezone.now() - timedelta(days=30)
+        ).exists())
+        # The daily counts outlive the raw views and hourly rollups
+        self.assertEqual(sum(self.rollups(ProductViewRollup.DAY).values()), 3)
+        self.assertEqual(sum(self.rollups(ProductViewRollup.HOUR).values()), 1)
+
+
+class CatalogImportTests(APITestCase):
+    HEADER = 'slug,name,category,description,price,size,stock,available,image\n'
+
+    def setUp(self):
+        super().setUp()
+        self.products = create_products(2)
+        self.user = self.login()
+
+    def run_import(self, lines, raw=False, **options):
+        """Import CSV lines after HEADER, or already parsed (line, row) pairs if raw"""
+        rows = lines if raw else catalog_io.read_rows(
+            io.StringIO(self.HEADER + ''.join(lines)), 'csv'
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            return catalog_io.import_products(rows, **options)
+
+    def export(self, fmt):
+        return ''.join(catalog_io.export_lines(fmt))
+
+    def test_export_round_trips(self):
+        Product.objects.filter(pk=self.products[1].pk).update(
+            description='Tee, with "quotes"\nand a line break', available=False,
+            price=Decimal('19.99'), image='products/a.jpg'
+        )
+        for fmt in catalog_io.FORMATS:
+            exported = self.export(fmt)
+            Product.objects.all().delete()
+            # The image file does not exist, so there are no variants to render
+            with mock.patch.object(catalog_io.images, 'schedule_derivatives'):
+                result = self.run_import(
+                    catalog_io.read_rows(io.StringIO(exported), fmt), raw=True
+                )
+            self.assertEqual((result.created, result.updated, result.errors), (2, 0, []))
+            self.assertEqual(self.export(fmt), exported)
+
+    def test_invalid_rows_are_reported_and_skipped(self):
+        result = self.run_import([
+            'shirt-0,Shirt 0,shirts,Cotton tee,abc,M,10,true,\n',
+            'shirt-1,Shirt 1,hats,Cotton tee,10,M,10,true,\n',
+            'bad slug,Shirt,shirts,Cotton tee,10,M,10,true,\n',
+            'shirt-2,Shirt 2,shirts,Cotton tee,10,XXXL,10,true,\n',
+            'shirt-3,Shirt 3,shirts,Cotton tee,10,M,-1,true,\n',
+            'shirt-4,Shirt 4,shirts,Cotton tee,10,M,10,maybe,\n',
+            'shirt-5,,shirts,Cotton tee,10,M,10,true,\n',
+            'shirt-6,Shirt 6,shirts,Cotton tee,12.5,M,3,true,\n',
+            'shirt-6,Shirt 6,shirts,Cotton tee,12.5,M,4,true,\n',
+        ])
+        self.assertEqual([error['line'] for error in result.errors], [2, 3, 4, 5, 6, 7, 8, 9])
+        self.assertEqual(result.errors[0]['error'], "Invalid price 'abc'")
+        self.assertEqual(result.errors[1]['error'], "Unknown category 'hats'")
+        self.assertEqual((result.created, result.updated), (1, 0))
+        self.assertEqual(Product.objects.get(slug='shirt-6').stock, 4)
+        self.assertEqual(Product.objects.get(slug='shirt-0').price, Decimal('10'))
+
+        rows = list(catalog_io.read_rows(io.StringIO('{"slug": \n[]\n'), 'ndjson'))
+        result = self.run_import(rows, raw=True)
+        self.assertEqual([error['line'] for error in result.errors], [1, 2])
+        self.assertEqual(result.errors[1]['error'], 'Expected a JSON object')
+
+    def test_dry_run_writes_nothing(self):
+        self.login(role='admin')
+        feed = io.BytesIO((self.HEADER + (
+            'shirt-0,Shirt 0,shirts,Cotton tee,99,M,1,true,\n'
+            'shirt-9,Shirt 9,shirts,Cotton tee,15,M,5,true,\n'
+            'shirt-8,Shirt 8,shirts,Cotton tee,free,M,5,true,\n'
+        )).encode())
+        feed.name = 'products.csv'
+        response = self.client.post(
+            '/api/products/import/', {'file': feed, 'dry_run': 'true'}, format='multipart'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {key: response.data[key] for key in ('dry_run', 'created', 'updated', 'error_count')},
+            {'dry_run': True, 'created': 1, 'updated': 1, 'error_count': 1}
+        )
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(Product.objects.get(slug='shirt-0').price, Decimal('10'))
+
+    def test_stock_held_by_pending_orders_is_left_alone(self):
+        held, free = self.products
+        place_order(self.user, [(held, 3)])
+        result = self.run_import([
+            'shirt-0,Shirt 0,shirts,Cotton tee,10,M,50,true,\n',
+            'shirt-1,Shirt 1,shirts,Cotton tee,11,M,50,true,\n',
+        ])
+        self.assertEqual(result.updated, 2)
+        self.assertEqual(
+            result.warnings,
+            [{'line': 2, 'warning': 'Stock left unchanged while pending orders hold some of it'}]
+        )
+        held.refresh_from_db()
+        free.refresh_from_db()
+        self.assertEqual((held.stock, free.stock), (7, 50))
+        # The ledger still adds up to the stock
+        self.assertEqual(inventory.ledger_levels([held.id, free.id]), {held.id: 7, free.id: 50})
+
+    def test_new_or_changed_images_get_variants(self):
+        first, second = self.products
+        Product.objects.filter(pk=second.pk).update(
+            image='products/same.jpg', image_variants={'source': 'products/same.jpg'}
+        )
+        with mock.patch.object(catalog_io.images, 'schedule_derivatives') as schedule:
+            self.run_import([
+                'shirt-0,Shirt 0,shirts,Cotton tee,10,M,10,true,products/new.jpg\n',
+                'shirt-1,Shirt 1,shirts,Cotton tee,11,M,10,true,products/same.jpg\n',
+            ])
+        schedule.assert_called_once_with(first.pk, 'products/new.jpg')
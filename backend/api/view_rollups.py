@@ -0,0 +1,187 @@
+"""
+Product view rollups, retention and popularity queries.
+
+rollup() aggregates raw ProductView rows into hourly ProductViewRollup rows,
+and the hourly rows into daily ones. prune() deletes raw views and hourly
+rollups past their retention windows in bounded batches. most_viewed() and
+trending() read only the rollups, so their cost does not grow with traffic.
+"""
+import math
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import TruncDate, TruncHour
+from django.utils import timezone
+from . import caching
+from .models import ProductView, ProductViewRollup, day_start
+
+HOUR = ProductViewRollup.HOUR
+DAY = ProductViewRollup.DAY
+UPSERT_BATCH_SIZE = 1000
+
+
+def parse_int(params, name, default, low, high):
+    """Integer query parameter within low..high. Raises ValueError."""
+    value = params.get(name)
+    if not value:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer')
+    if not low <= value <= high:
+        raise ValueError(f'{name} must be between {low} and {high}')
+    return value
+
+
+def hour_start(moment):
+    return timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+
+
+def rollup_start():
+    """
+    Hour the next rollup starts from: PRODUCT_VIEW_ROLLUP_RECOMPUTE_HOURS
+    before the latest hourly rollup, to pick up views written late, or the
+    first raw view. None when there is nothing to roll up.
+    """
+    latest = ProductViewRollup.objects.filter(granularity=HOUR).aggregate(
+        latest=Max('period')
+    )['latest']
+    if latest is not None:
+        return latest - timedelta(hours=settings.PRODUCT_VIEW_ROLLUP_RECOMPUTE_HOURS)
+    first = ProductView.objects.aggregate(first=Min('viewed_at'))['first']
+    return hour_start(first) if first is not None else None
+
+
+def _upsert(granularity, rows):
+    written = 0
+    batch = []
+    for row in rows:
+        batch.append(ProductViewRollup(
+            product_id=row['product_id'], granularity=granularity,
+            period=row['period'], views=row['views']
+        ))
+        if len(batch) == UPSERT_BATCH_SIZE:
+            written += _write(batch)
+            batch = []
+    return written + _write(batch)
+
+
+def _write(batch):
+    ProductViewRollup.objects.bulk_create(
+        batch, update_conflicts=True,
+        unique_fields=['granularity', 'product', 'period'],
+        update_fields=['views', 'updated_at']
+    )
+    return len(batch)
+
+
+@transaction.atomic
+def rollup(start=None):
+    """
+    Recompute hourly rollups from raw views since start (default
+    rollup_start()), then the daily rollups of the days those hours fall in.
+    Returns the number of hourly rows written.
+    """
+    start = start or rollup_start()
+    if start is None:
+        return 0
+    hourly = _upsert(HOUR, ProductView.objects.filter(viewed_at__gte=start).annotate(
+        period=TruncHour('viewed_at')
+    ).values('product_id', 'period').annotate(views=Count('id')).order_by().iterator())
+
+    days = ProductViewRollup.objects.filter(
+        granularity=HOUR, period__gte=day_start(timezone.localtime(start).date())
+    ).annotate(day=TruncDate('period')).values('product_id', 'day').annotate(
+        views=Sum('views')
+    ).order_by().iterator()
+    _upsert(DAY, ({**row, 'period': day_start(row['day'])} for row in days))
+    caching.invalidate(caching.VIEWS)
+    return hourly
+
+
+def _delete_in_batches(queryset, batch_size):
+    total = 0
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return total
+        total += queryset.model.objects.filter(id__in=ids).delete()[0]
+
+
+def prune(now=None, batch_size=None):
+    """
+    Delete raw views older than PRODUCT_VIEW_RETENTION_DAYS and hourly
+    rollups older than PRODUCT_VIEW_HOURLY_RETENTION_DAYS, never touching
+    what the next rollup would recompute. Daily rollups are kept.
+    Returns (views deleted, hourly rollups deleted)
+    """
+    now = now or timezone.now()
+    batch_size = batch_size or settings.PRODUCT_VIEW_PRUNE_BATCH_SIZE
+    start = rollup_start()
+    if start is None:
+        return 0, 0
+    views = _delete_in_batches(
+        ProductView.objects.filter(viewed_at__lt=min(
+            now - timedelta(days=settings.PRODUCT_VIEW_RETENTION_DAYS), start
+        )),
+        batch_size
+    )
+    hourly = _delete_in_batches(
+        ProductViewRollup.objects.filter(granularity=HOUR, period__lt=min(
+            now - timedelta(days=settings.PRODUCT_VIEW_HOURLY_RETENTION_DAYS),
+            day_start(timezone.localtime(start).date())
+        )),
+        batch_size
+    )
+    return views, hourly
+
+
+def _rollups(granularity, since, category=None):
+    rows = ProductViewRollup.objects.filter(granularity=granularity, period__gte=since)
+    if category:
+        rows = rows.filter(product__category__slug=category)
+    return rows.values('product_id').annotate(total=Sum('views')).order_by()
+
+
+def most_viewed(days=7, category=None, limit=10):
+    """[(product_id, views)] over the last `days` days including today, most first"""
+    since = day_start(timezone.localdate() - timedelta(days=days - 1))
+    rows = _rollups(DAY, since, category).order_by('-total', 'product_id')[:limit]
+    return [(row['product_id'], row['total']) for row in rows]
+
+
+def trending(hours=24, baseline_days=7, category=None, limit=10, now=None):
+    """
+    Products viewed more than usual: views in the last `hours` hours against
+    the rate of the `baseline_days` days before them.
+    Returns [{'product_id', 'views', 'expected', 'score'}], highest score first
+    """
+    now = now or timezone.now()
+    since = hour_start(now) - timedelta(hours=hours - 1)
+    first_day = timezone.localtime(since).date()
+    recent = {
+        row['product_id']: row['total'] for row in _rollups(HOUR, since, category)
+    }
+    baseline = dict(
+        _rollups(DAY, day_start(first_day - timedelta(days=baseline_days)), category).filter(
+            period__lt=day_start(first_day)
+        ).values_list('product_id', 'total')
+    )
+    scale = hours / (baseline_days * 24)
+    results = []
+    for product_id, views in recent.items():
+        expected = baseline.get(product_id, 0) * scale
+        if views <= expected:
+            continue
+        # Growth weighted by volume, so one extra view of an obscure product
+        # does not outrank a popular one doubling
+        results.append({
+            'product_id': product_id,
+            'views': views,
+            'expected': round(expected, 2),
+            'score': round((views - expected) / math.sqrt(expected + 1), 4),
+        })
+    results.sort(key=lambda row: (-row['score'], row['product_id']))
+    return results[:limit]
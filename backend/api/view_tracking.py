@@ -0,0 +1,227 @@
+"""
+Write-behind ingestion of product views.
+
+track_view() appends to an in-process buffer instead of writing a row per
+hit. Repeat views of a product by the same visitor (user id, or IP for
+anonymous visitors) within PRODUCT_VIEW_DEDUP_WINDOW are ignored. The buffer
+is flushed with one bulk_create by a background thread every
+PRODUCT_VIEW_FLUSH_INTERVAL seconds, as soon as it holds
+PRODUCT_VIEW_FLUSH_SIZE views, and at interpreter exit; the same
+transaction updates the unique visitor sketches of api.visitors. Where
+there is no long-lived process to run that thread (PRODUCT_VIEW_FLUSH_ON_REQUEST,
+on by default on Vercel), each request flushes the buffer before it returns
+instead. When the
+buffer holds PRODUCT_VIEW_BUFFER_LIMIT views (e.g. the database is down),
+new views are dropped and counted rather than growing memory without bound.
+
+Each server process has its own buffer, so deduplication is per process.
+"""
+import atexit
+import ipaddress
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+from . import caching, visitors
+from .models import Product, ProductView, User
+
+logger = logging.getLogger(__name__)
+
+SLUG_CACHE_SIZE = 10000
+UNKNOWN_IP = '0.0.0.0'
+# Visitors remembered for deduplication, per process
+SEEN_LIMIT = 100000
+
+
+class ViewBuffer:
+    def __init__(self, flush_size, flush_interval, dedup_window, limit, background=True):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.dedup_window = dedup_window
+        self.limit = limit
+        # False: the caller flushes, no thread is started
+        self.background = background
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.views = []
+        # (product id, visitor) -> monotonic time of the last recorded view
+        self.seen = OrderedDict()
+        self.stats = {
+            'accepted': 0,
+            'deduplicated': 0,
+            'dropped': 0,
+            'flushed': 0,
+            'flush_errors': 0,
+        }
+        self.stopping = threading.Event()
+        self.wake = threading.Event()
+        self.worker = None
+
+    def add(self, product_id, user_id, ip_address):
+        """Buffer a view. Returns False if it was deduplicated or dropped."""
+        try:
+            ip_address = str(ipaddress.ip_address(ip_address))
+        except ValueError:
+            # Keep one bad value from failing a whole batch
+            ip_address = UNKNOWN_IP
+        now = time.monotonic()
+        key = (product_id, user_id or ip_address)
+        with self.lock:
+            last = self.seen.get(key)
+            if last is not None and now - last < self.dedup_window:
+                self.stats['deduplicated'] += 1
+                return False
+            if len(self.views) >= self.limit:
+                self.stats['dropped'] += 1
+                return False
+            self.seen[key] = now
+            self.seen.move_to_end(key)
+            if len(self.seen) > SEEN_LIMIT:
+                self.seen.popitem(last=False)
+            self.views.append(ProductView(
+                product_id=product_id, user_id=user_id,
+                ip_address=ip_address, viewed_at=timezone.now()
+            ))
+            self.stats['accepted'] += 1
+            full = len(self.views) >= self.flush_size
+        if self.background:
+            self.start()
+            if full:
+                self.wake.set()
+        return True
+
+    def _forget_expired(self, now):
+        """Drop dedup entries older than the window; oldest entries come first"""
+        while self.seen:
+            key, last = next(iter(self.seen.items()))
+            if now - last < self.dedup_window:
+                break
+            self.seen.popitem(last=False)
+
+    def flush(self):
+        """Write buffered views with one bulk insert. Returns the number written."""
+        with self.flush_lock:
+            with self.lock:
+                views, self.views = self.views, []
+                self._forget_expired(time.monotonic())
+            if not views:
+                return 0
+            try:
+                # Rows deleted since the view was buffered would fail the whole insert
+                categories = dict(Product.objects.filter(
+                    id__in={view.product_id for view in views}
+                ).values_list('id', 'category_id'))
+                views = [view for view in views if view.product_id in categories]
+                user_ids = {view.user_id for view in views if view.user_id}
+                if user_ids:
+                    users = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+                    for view in views:
+                        if view.user_id not in users:
+                            view.user_id = None
+                with transaction.atomic():
+                    ProductView.objects.bulk_create(views, batch_size=1000)
+                    visitors.record(views, categories)
+            except DatabaseError:
+                logger.exception('Could not flush %s product views', len(views))
+                with self.lock:
+                    self.stats['flush_errors'] += 1
+                    # Put the views back in front of newer ones, within the limit
+                    room = max(self.limit - len(self.views), 0)
+                    self.stats['dropped'] += max(len(views) - room, 0)
+                    self.views[:0] = views[:room]
+                return 0
+            with self.lock:
+                self.stats['flushed'] += len(views)
+            return len(views)
+
+    def start(self):
+        if self.worker is not None:
+            return
+        with self.lock:
+            if self.worker is not None:
+                return
+            self.worker = threading.Thread(
+                target=self.run, name='product-view-flusher', daemon=True
+            )
+            self.worker.start()
+        atexit.register(self.stop)
+
+    def run(self):
+        while not self.stopping.is_set():
+            # Woken early when the buffer reaches flush_size
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Product view flusher failed')
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        """Stop the background thread and write what is left"""
+        self.stopping.set()
+        self.wake.set()
+        self.flush()
+
+    def metrics(self):
+        with self.lock:
+            return {**self.stats, 'buffered': len(self.views), 'limit': self.limit}
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+_slugs = OrderedDict()
+# CATALOG generation the remembered slugs were read under
+_slugs_version = None
+
+
+def get_buffer():
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = ViewBuffer(
+                flush_size=settings.PRODUCT_VIEW_FLUSH_SIZE,
+                flush_interval=settings.PRODUCT_VIEW_FLUSH_INTERVAL,
+                dedup_window=settings.PRODUCT_VIEW_DEDUP_WINDOW,
+                limit=settings.PRODUCT_VIEW_BUFFER_LIMIT,
+                background=not settings.PRODUCT_VIEW_FLUSH_ON_REQUEST,
+            )
+        return _buffer
+
+
+def product_id_for_slug(slug):
+    """
+    Product id for a slug, remembered per process until the catalog changes
+    (the CATALOG cache tag moves on). None if there is no such product.
+    """
+    global _slugs_version
+    version = caching.get_tag_versions([caching.CATALOG])[caching.CATALOG]
+    with _buffer_lock:
+        if version != _slugs_version:
+            # A product may have been renamed or deleted, in any process
+            _slugs.clear()
+            _slugs_version = version
+        elif slug in _slugs:
+            _slugs.move_to_end(slug)
+            return _slugs[slug]
+    product_id = Product.objects.filter(slug=slug).values_list('id', flat=True).first()
+    if product_id is not None:
+        with _buffer_lock:
+            if version == _slugs_version:
+                _slugs[slug] = product_id
+                if len(_slugs) > SLUG_CACHE_SIZE:
+                    _slugs.popitem(last=False)
+    return product_id
+
+
+def track_view(product_id, user_id, ip_address):
+    buffer = get_buffer()
+    added = buffer.add(product_id, user_id, ip_address)
+    if not buffer.background:
+        # Also retries views kept after a failed flush
+        buffer.flush()
+    return added
@@ -1,39 +1,40 @@
+import io
 from django.shortcuts import render
+from django.http import StreamingHttpResponse
 from rest_framework import viewsets, status, filters, permissions
 from rest_framework.decorators import action, api_view, permission_classes, throttle_classes
+from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly, AllowAny
 from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
 from django.conf import settings
 from django.db.models import Q, Prefetch, Sum, Count
-from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.views.decorators.cache import cache_page
-from django.utils.decorators import method_decorator
 from django.utils import timezone
 from datetime import timedelta
 import stripe
 from .models import (
     User, Category, Product, Order, OrderItem,
     ProductReview, Wishlist, ProductView,
-    Analytics
+    Analytics, BestsellerCounter, day_start
 )
 from .serializers import (
-    UserSerializer, CategorySerializer, ProductSerializer,
-    OrderSerializer, OrderItemSerializer, ProductReviewSerializer,
+    UserSerializer, CategorySerializer, ProductSerializer, ProductListSerializer,
+    OrderSerializer, OrderItemSerializer, OrderSummarySerializer, ProductReviewSerializer,
     WishlistSerializer, AnalyticsSerializer,
     DashboardAnalyticsSerializer
 )
+from . import caching, catalog_io, facets, payments, recommendations, reports, sales, search, view_rollups, view_tracking, visitors, webhooks
+from .caching import cache_response
+from .idempotency import idempotent
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import get_user_model
 from django.contrib.auth.hashers import make_password
 from django.db import transaction
-from rest_framework.pagination import PageNumberPagination
+from .pagination import ProductPagination, OrderPagination, ReviewPagination
 from django.contrib.auth.tokens import default_token_generator
 from django.utils.http import urlsafe_base64_decode
-from django.utils.encoding import force_text
-
-stripe.api_key = settings.STRIPE_SECRET_KEY
+from django.utils.encoding import force_str
 
 User = get_user_model()
 
@@ -46,26 +47,71 @@ class CategoryViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticatedOrReadOnly]
     lookup_field = 'slug'
 
-    @method_decorator(cache_page(60 * 15))  # Cache for 15 minutes
+    @cache_response(tags=lambda view, request, data: [caching.CATEGORIES])
     def list(self, request, *args, **kwargs):
         return super().list(request, *args, **kwargs)
 
+    @cache_response(tags=lambda view, request, data: [caching.category_tag(data['id'])])
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
 class ProductViewSet(viewsets.ModelViewSet):
     serializer_class = ProductSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     lookup_field = 'slug'
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['name', 'description', 'category__name']
+    filter_backends = [filters.OrderingFilter]
     ordering_fields = ['price', 'created_at', 'name']
-    pagination_class = PageNumberPagination
+    pagination_class = ProductPagination
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return ProductListSerializer
+        return ProductSerializer
+
+    def get_requested_fields(self):
+        fields = self.request.query_params.get('fields', '')
+        requested = {name.strip() for name in fields.split(',') if name.strip()}
+        unknown = requested - set(self.get_serializer_class().Meta.fields)
+        if unknown:
+            raise ParseError(f'Unknown fields: {", ".join(sorted(unknown))}')
+        return requested
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action in ['list', 'retrieve']:
+            context['fields'] = self.get_requested_fields()
+        return context
 
     def get_queryset(self):
-        queryset = Product.objects.select_related('category').prefetch_related(
-            Prefetch(
-                'reviews',
-                queryset=ProductReview.objects.select_related('user')
-            )
-        )
+        queryset = Product.objects.all()
+        if self.action in ['list', 'retrieve']:
+            # Load only the columns and relations the response will use
+            serializer_class = self.get_serializer_class()
+            requested = self.get_requested_fields()
+            columns = serializer_class.columns(requested)
+            columns += [f for f in self.ordering_fields if f not in columns]
+            queryset = queryset.only(*columns)
+            if any(column.startswith('category__') for column in columns):
+                queryset = queryset.select_related('category')
+            if 'reviews' in serializer_class.field_names(requested):
+                queryset = queryset.prefetch_related(
+                    Prefetch(
+                        'reviews',
+                        queryset=ProductReview.objects.select_related('user').only(
+                            'id', 'product', 'rating', 'comment', 'created_at',
+                            'user__id', 'user__email', 'user__name', 'user__role'
+                        )
+                    )
+                )
+        else:
+            queryset = queryset.select_related('category')
+        
+        # Full-text search, ranked by relevance unless ?ordering= is given
+        query = self.request.query_params.get(
+            'q', self.request.query_params.get('search', '')
+        ).strip()
+        if query:
+            queryset = search.search_products(queryset, query)
         
         # Category filter
         category = self.request.query_params.get('category', None)
@@ -98,19 +144,172 @@ class ProductViewSet(viewsets.ModelViewSet):
         return queryset
 
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'facets', 'most_viewed', 'trending', 'bestsellers', 'related']:
             return [AllowAny()]
+        if self.action in ['export_catalog', 'import_catalog']:
+            return [IsAdminUser()]
         return [IsAuthenticated()]
 
-    @method_decorator(cache_page(60 * 5))  # Cache for 5 minutes
+    @cache_response(tags=lambda view, request, data: [caching.CATALOG])
     def list(self, request, *args, **kwargs):
         return super().list(request, *args, **kwargs)
 
-    @method_decorator(cache_page(60 * 5))
+    @cache_response(tags=lambda view, request, data: [
+        caching.product_tag(data['id']),
+        *([caching.category_tag(data['category']['id'])] if 'category' in data else []),
+    ])
     def retrieve(self, request, *args, **kwargs):
         return super().retrieve(request, *args, **kwargs)
 
+    @action(detail=False, methods=['get'])
+    def facets(self, request):
+        """Counts per category, size, price bucket and stock state for the
+        current ?q=, ?category=, ?size= and price filters"""
+        params = request.query_params
+        try:
+            min_price = facets.parse_price(params, 'min_price')
+            max_price = facets.parse_price(params, 'max_price')
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        ids = None
+        query = params.get('q', params.get('search', '')).strip()
+        if query:
+            ids = search.search_products(Product.objects.all(), query).values_list(
+                'id', flat=True
+            )
+        index = facets.get_index()
+        return Response(index.counts(
+            category=params.get('category') or None,
+            size=params.get('size') or None,
+            min_price=min_price,
+            max_price=max_price,
+            ids=ids,
+        ))
+
+    def _ranked(self, rows):
+        """Serialize products for [(product_id, extra fields)], keeping the order"""
+        products = Product.objects.select_related('category').in_bulk(
+            [product_id for product_id, _ in rows]
+        )
+        context = self.get_serializer_context()
+        return [
+            {**ProductListSerializer(products[product_id], context=context).data, **extra}
+            for product_id, extra in rows if product_id in products
+        ]
+
+    @action(detail=False, methods=['get'], url_path='most-viewed')
+    @cache_response(tags=lambda view, request, data: [caching.VIEWS, caching.CATALOG])
+    def most_viewed(self, request):
+        """Most viewed products over ?days= (default 7), optionally in ?category="""
+        params = request.query_params
+        try:
+            days = view_rollups.parse_int(params, 'days', 7, 1, 365)
+            limit = view_rollups.parse_int(params, 'limit', 10, 1, 100)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        rows = view_rollups.most_viewed(days, params.get('category'), limit)
+        return Response(self._ranked([
+            (product_id, {'views': views}) for product_id, views in rows
+        ]))
+
+    @action(detail=False, methods=['get'])
+    @cache_response(tags=lambda view, request, data: [caching.VIEWS, caching.CATALOG])
+    def trending(self, request):
+        """Products viewed more than usual in the last ?hours= (default 24),
+        optionally in ?category="""
+        params = request.query_params
+        try:
+            hours = view_rollups.parse_int(params, 'hours', 24, 1, 168)
+            limit = view_rollups.parse_int(params, 'limit', 10, 1, 100)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        rows = view_rollups.trending(hours, category=params.get('category'), limit=limit)
+        return Response(self._ranked([
+            (row.pop('product_id'), row) for row in rows
+        ]))
+
+    @action(detail=False, methods=['get'])
+    @cache_response(tags=lambda view, request, data: [caching.BESTSELLERS, caching.CATALOG])
+    def bestsellers(self, request):
+        """Best sellers by units over ?window= days (7, 30 or 90, default 30),
+        optionally in ?category="""
+        params = request.query_params
+        try:
+            window = view_rollups.parse_int(params, 'window', 30, 1, max(BestsellerCounter.WINDOWS))
+            limit = view_rollups.parse_int(params, 'limit', 10, 1, 100)
+            if window not in BestsellerCounter.WINDOWS:
+                raise ValueError(
+                    f'window must be one of {", ".join(map(str, BestsellerCounter.WINDOWS))}'
+                )
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        rows = BestsellerCounter.top(window, params.get('category'), limit)
+        return Response(self._ranked([
+            (product_id, {'units_sold': units, 'revenue': revenue})
+            for product_id, units, revenue in rows
+        ]))
+
+    @action(detail=True, methods=['get'])
+    @cache_response(tags=lambda view, request, data: [
+        caching.RECOMMENDATIONS, caching.BESTSELLERS, caching.CATALOG
+    ])
+    def related(self, request, slug=None):
+        """Products frequently bought with this one, or best sellers of its
+        category when there are too few (?limit=, default 6)"""
+        try:
+            limit = view_rollups.parse_int(
+                request.query_params, 'limit', 6, 1, settings.RECOMMENDATION_NEIGHBOURS
+            )
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        product = Product.objects.only('id', 'category_id').filter(slug=slug).first()
+        if product is None:
+            return Response(
+                {'error': 'Product not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(self._ranked(recommendations.related(product, limit)))
+
+    @action(detail=False, methods=['get'], url_path='export')
+    def export_catalog(self, request):
+        """Stream the whole catalog as ?type=csv (default) or ?type=ndjson"""
+        fmt = request.query_params.get('type', 'csv')
+        if fmt not in catalog_io.FORMATS:
+            return Response(
+                {'error': f'type must be one of {", ".join(catalog_io.FORMATS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        response = StreamingHttpResponse(
+            catalog_io.export_lines(fmt), content_type=content_type
+        )
+        response['Content-Disposition'] = f'attachment; filename="products.{fmt}"'
+        return response
+
+    @action(detail=False, methods=['post'], url_path='import')
+    def import_catalog(self, request):
+        """Upsert products by slug from an uploaded CSV or NDJSON `file`"""
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response(
+                {'error': 'file is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        fmt = request.data.get('type') or catalog_io.detect_format(upload.name)
+        if fmt not in catalog_io.FORMATS:
+            return Response(
+                {'error': f'type must be one of {", ".join(catalog_io.FORMATS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        dry_run = str(request.data.get('dry_run', '')).lower() in ('1', 'true', 'yes')
+        stream = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+        result = catalog_io.import_products(
+            catalog_io.read_rows(stream, fmt), dry_run=dry_run
+        )
+        return Response(result.as_dict())
+
     @action(detail=True, methods=['post'])
+    @idempotent
     def review(self, request, slug=None):
         product = self.get_object()
         user = request.user
@@ -124,84 +323,91 @@ class ProductViewSet(viewsets.ModelViewSet):
         
         serializer = ProductReviewSerializer(data=request.data)
         if serializer.is_valid():
-            review = serializer.save(product=product, user=user)
-            # Invalidate product cache
-            cache_key = f'product_{product.slug}'
-            cache.delete(cache_key)
+            serializer.save(product=product, user=user)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     @action(detail=True, methods=['post'])
     def track_view(self, request, slug=None):
-        product = self.get_object()
-        user = request.user if request.user.is_authenticated else None
-        
-        ProductView.objects.create(
-            product=product,
-            user=user,
-            ip_address=request.META.get('REMOTE_ADDR')
+        # Buffered and written in bulk by view_tracking; rows are only written
+        # here where PRODUCT_VIEW_FLUSH_ON_REQUEST is set
+        product_id = view_tracking.product_id_for_slug(slug)
+        if product_id is None:
+            return Response(
+                {'error': 'Product not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        view_tracking.track_view(
+            product_id,
+            request.user.pk if request.user.is_authenticated else None,
+            request.META.get('REMOTE_ADDR')
         )
-        return Response(status=status.HTTP_201_CREATED)
+        return Response(status=status.HTTP_202_ACCEPTED)
 
 class OrderViewSet(viewsets.ModelViewSet):
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = OrderPagination
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return OrderSummarySerializer
+        return OrderSerializer
 
     def get_queryset(self):
-        return Order.objects.filter(user=self.request.user).prefetch_related(
+        orders = Order.objects.filter(user=self.request.user)
+        if self.action == 'list':
+            # Line snapshots only: one query for the orders, one for the items
+            return orders.order_by('-created_at', '-id').prefetch_related('items')
+        return orders.select_related('user').prefetch_related(
             Prefetch(
                 'items',
-                queryset=OrderItem.objects.select_related('product')
+                queryset=OrderItem.objects.select_related('product__category')
             )
         )
 
-    @transaction.atomic
+    @idempotent
     def create(self, request, *args, **kwargs):
+        # Reserve stock and commit before calling the payment gateway, so no product
+        # rows stay locked during the payment round trip
         try:
-            # Create order
-            order = Order.objects.create(
-                user=request.user,
-                shipping_address=request.data.get('shipping_address', ''),
-                payment_method=request.data.get('payment_method', Order.PAYMENT_METHOD_CARD)
+            with transaction.atomic():
+                order = Order.objects.create(
+                    user=request.user,
+                    shipping_address=request.data.get('shipping_address', ''),
+                    payment_method=request.data.get('payment_method', Order.PAYMENT_METHOD_CARD)
+                )
+
+                # Process items
+                items_data = request.data.get('items', [])
+                order.process_order(items_data)
+        except Exception as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
             )
 
-            # Process items
-            items_data = request.data.get('items', [])
-            order.process_order(items_data)
-
-            # Create Stripe payment intent
-            intent = stripe.PaymentIntent.create(
+        try:
+            intent = payments.get_gateway().create_payment_intent(
                 amount=int(order.total_price * 100),  # Convert to cents
                 currency='usd',
                 metadata={
                     'order_id': order.id,
                     'user_id': request.user.id
-                }
+                },
+                idempotency_key=f'order-{order.id}'
             )
             
             order.stripe_payment_intent = intent.id
-            order.save()
+            order.save(update_fields=['stripe_payment_intent', 'updated_at'])
 
             return Response({
                 'order': OrderSerializer(order).data,
                 'client_secret': intent.client_secret
             }, status=status.HTTP_201_CREATED)
 
-        except ValidationError as e:
-            return Response(
-                {'error': str(e)},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        except stripe.error.StripeError as e:
-            if 'order' in locals():
-                order.refund()
-            return Response(
-                {'error': str(e)},
-                status=status.HTTP_400_BAD_REQUEST
-            )
         except Exception as e:
-            if 'order' in locals():
-                order.refund()
+            order.release_reservations()
             return Response(
                 {'error': str(e)},
                 status=status.HTTP_400_BAD_REQUEST
@@ -210,6 +416,7 @@ class OrderViewSet(viewsets.ModelViewSet):
 @api_view(['POST'])
 @permission_classes([AllowAny])
 @throttle_classes([AuthRateThrottle])
+@idempotent(exclude_fields=('token',))
 def register_user(request):
     data = request.data
     try:
@@ -246,7 +453,7 @@ def register_user(request):
 @permission_classes([AllowAny])
 def confirm_email(request, uidb64, token):
     try:
-        uid = force_text(urlsafe_base64_decode(uidb64))
+        uid = force_str(urlsafe_base64_decode(uidb64))
         user = User.objects.get(pk=uid)
     except (TypeError, ValueError, OverflowError, User.DoesNotExist):
         user = None
@@ -292,6 +499,7 @@ class WishlistViewSet(viewsets.ModelViewSet):
         )
 
     @action(detail=False, methods=['post'])
+    @idempotent
     def toggle_product(self, request):
         product_id = request.data.get('product_id')
         if not product_id:
@@ -323,28 +531,42 @@ class IsAdminUser(permissions.BasePermission):
 class AnalyticsViewSet(viewsets.ViewSet):
     permission_classes = [IsAdminUser]
     
+    @cache_response(tags=lambda view, request, data: [caching.ANALYTICS])
     def list(self, request):
-        """Get today's analytics"""
-        analytics = Analytics.update_daily_analytics()
-        serializer = AnalyticsSerializer(analytics)
+        """
+        Daily analytics snapshots, oldest first
+        ?from=&to= (ISO dates, default the last 30 days)
+        """
+        try:
+            start, end, _ = sales.parse_range(request.query_params)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        snapshots = Analytics.objects.filter(date__range=(start, end)).order_by('date')
+        serializer = AnalyticsSerializer(snapshots, many=True)
         return Response(serializer.data)
 
     @action(detail=False, methods=['get'])
     def dashboard(self, request):
-        """Get comprehensive dashboard analytics"""
-        # Get date range
-        end_date = timezone.now()
-        start_date = end_date - timedelta(days=30)
-        
-        # Get completed orders in date range
+        """
+        Get comprehensive dashboard analytics
+        ?from=&to= (ISO dates, default the last 30 days) and
+        ?granularity=day|week|month for the revenue series
+        """
+        try:
+            start, end, granularity = sales.parse_range(request.query_params)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Completed orders in date range
         orders = Order.objects.filter(
             payment_status=Order.PAYMENT_STATUS_COMPLETED,
-            created_at__gte=start_date,
-            created_at__lte=end_date
+            created_at__gte=day_start(start),
+            created_at__lt=day_start(end + timedelta(days=1))
         )
-        
-        # Calculate total revenue and orders
-        total_revenue = orders.aggregate(total=Sum('total_price'))['total'] or 0
+
+        # Revenue per period from the sales rollups
+        daily_revenue = sales.revenue_series(start, end, granularity)
+        total_revenue = sum(period['revenue'] for period in daily_revenue)
         total_orders = orders.count()
         
         # Get total products and users
@@ -352,37 +574,14 @@ class AnalyticsViewSet(viewsets.ViewSet):
         total_users = User.objects.count()
         
         # Get recent orders
-        recent_orders = orders.order_by('-created_at')[:5]
+        recent_orders = orders.select_related('user').prefetch_related(
+            Prefetch('items', queryset=OrderItem.objects.select_related('product__category'))
+        ).order_by('-created_at')[:5]
         
         # Get top selling products
-        top_products = Product.objects.annotate(
-            total_sold=Sum('orderitem__quantity')
-        ).order_by('-total_sold')[:5]
-        
-        # Get sales by category
-        sales_by_category = OrderItem.objects.filter(
-            order__in=orders
-        ).values(
-            'product__category__name'
-        ).annotate(
-            total=Sum('price')
-        ).order_by('-total')
-        
-        # Get daily revenue for the past 30 days
-        daily_revenue = []
-        current_date = start_date
-        while current_date <= end_date:
-            day_revenue = orders.filter(
-                created_at__date=current_date
-            ).aggregate(
-                total=Sum('total_price')
-            )['total'] or 0
-            
-            daily_revenue.append({
-                'date': current_date.date(),
-                'revenue': day_revenue
-            })
-            current_date += timedelta(days=1)
+        top_ids = sales.top_product_ids(start, end)
+        top_products = Product.objects.select_related('category').in_bulk(top_ids)
+        top_products = [top_products[pk] for pk in top_ids if pk in top_products]
         
         data = {
             'total_revenue': total_revenue,
@@ -391,16 +590,107 @@ class AnalyticsViewSet(viewsets.ViewSet):
             'total_users': total_users,
             'recent_orders': recent_orders,
             'top_products': top_products,
-            'sales_by_category': dict(sales_by_category),
+            'sales_by_category': sales.sales_by_category(start, end),
             'daily_revenue': daily_revenue
         }
         
         serializer = DashboardAnalyticsSerializer(data)
         return Response(serializer.data)
 
+    def _report_range(self, request, default_days=30, default_granularity='day'):
+        params = request.query_params.copy()
+        params.setdefault('granularity', default_granularity)
+        return sales.parse_range(params, default_days=default_days)
+
+    @action(detail=False, methods=['get'], url_path='order-value')
+    def order_value(self, request):
+        """Orders, revenue and average order value per ?granularity= period
+        for ?from=&to= (default the last 30 days)"""
+        try:
+            start, end, granularity = self._report_range(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(reports.get_columns().average_order_value(start, end, granularity))
+
+    @action(detail=False, methods=['get'], url_path='repeat-purchases')
+    def repeat_purchases(self, request):
+        """Repeat purchase rate of the customers ordering in ?from=&to="""
+        try:
+            start, end, _ = self._report_range(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(reports.get_columns().repeat_purchases(start, end))
+
+    @action(detail=False, methods=['get'])
+    def cohorts(self, request):
+        """
+        Retention of customers by the ?granularity= period (default month) of
+        their first order, for cohorts starting in ?from=&to= (default the
+        last year), followed for up to ?periods= periods (default 12)
+        """
+        try:
+            start, end, granularity = self._report_range(request, 365, 'month')
+            periods = view_rollups.parse_int(request.query_params, 'periods', 12, 1, 104)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(reports.get_columns().cohort_retention(start, end, granularity, periods))
+
+    @action(detail=False, methods=['get'], url_path='category-mix')
+    def category_mix(self, request):
+        """Revenue per ?granularity= period (default month) and each
+        category's share of it, for ?from=&to= (default the last year)"""
+        try:
+            start, end, granularity = self._report_range(request, 365, 'month')
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(reports.get_columns().category_mix(start, end, granularity))
+
+    @action(detail=False, methods=['get'])
+    def visitors(self, request):
+        """
+        Estimated unique visitors, views, purchases and view-to-purchase
+        conversion for ?from=&to= (ISO dates, default the last 30 days),
+        for the whole site or for ?product= or ?category= (comma separated slugs)
+        """
+        params = request.query_params
+        try:
+            start, end, _ = sales.parse_range(params)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        product_ids = category_ids = None
+        if params.get('product'):
+            product_ids = list(Product.objects.filter(
+                slug__in=params['product'].split(',')
+            ).values_list('id', flat=True))
+            if not product_ids:
+                return Response({'error': 'Product not found'}, status=status.HTTP_404_NOT_FOUND)
+        elif params.get('category'):
+            category_ids = list(Category.objects.filter(
+                slug__in=params['category'].split(',')
+            ).values_list('id', flat=True))
+            if not category_ids:
+                return Response({'error': 'Category not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(visitors.report(start, end, product_ids, category_ids))
+
+    @action(detail=False, methods=['get'])
+    def webhooks(self, request):
+        """Backlog depth and processing lag of the payment webhook inbox"""
+        return Response(webhooks.backlog_stats())
+
+    @action(detail=False, methods=['get'])
+    def payments(self, request):
+        """Payment gateway call latencies for this process"""
+        return Response(payments.get_gateway().metrics())
+
+    @action(detail=False, methods=['get'])
+    def view_tracking(self, request):
+        """Product view buffer counters for this process"""
+        return Response(view_tracking.get_buffer().metrics())
+
 class ProductReviewViewSet(viewsets.ModelViewSet):
     serializer_class = ProductReviewSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
+    pagination_class = ReviewPagination
     
     def get_queryset(self):
         return ProductReview.objects.select_related('user', 'product')
@@ -423,20 +713,8 @@ def stripe_webhook(request):
     except stripe.error.SignatureVerificationError as e:
         return Response({'error': 'Invalid signature'}, status=400)
     
-    if event['type'] == 'payment_intent.succeeded':
-        payment_intent = event['data']['object']
-        order_id = payment_intent.metadata.get('order_id')
-        
-        try:
-            order = Order.objects.get(id=order_id)
-            order.payment_status = Order.PAYMENT_STATUS_COMPLETED
-            order.save()
-        except Order.DoesNotExist:
-            return Response(
-                {'error': f'Order {order_id} not found'},
-                status=404
-            )
-    
+    # Acknowledge right away; process_webhook_events applies the event
+    webhooks.record_event(event.to_dict_recursive())
     return Response({'status': 'success'})
 
 class UserViewSet(viewsets.ModelViewSet):
@@ -453,10 +731,14 @@ class UserViewSet(viewsets.ModelViewSet):
     
     @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
     def my_orders(self, request):
-        orders = Order.objects.filter(user=request.user).order_by('-created_at')
-        page = self.paginate_queryset(orders)
+        orders = Order.objects.filter(user=request.user).order_by(
+            '-created_at', '-id'
+        ).prefetch_related('items')
+        paginator = OrderPagination()
+        context = {'request': request}
+        page = paginator.paginate_queryset(orders, request, view=self)
         if page is not None:
-            serializer = OrderSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        serializer = OrderSerializer(orders, many=True)
+            serializer = OrderSummarySerializer(page, many=True, context=context)
+            return paginator.get_paginated_response(serializer.data)
+        serializer = OrderSummarySerializer(orders, many=True, context=context)
         return Response(serializer.data)
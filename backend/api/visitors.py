@@ -0,0 +1,149 @@
+"""
+Unique visitor estimates from per-day HyperLogLog sketches.
+
+As the view buffer flushes, record() folds each view's visitor (user id, or
+IP for anonymous visitors) into the VisitorSketch of its product, its
+category and the whole site for that day. Adding a visitor twice leaves a
+sketch unchanged, so replaying views is harmless. Estimates for any range of
+days and any set of products or categories merge a few small sketches
+instead of counting distinct visitors over raw views.
+"""
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+from .hyperloglog import HyperLogLog
+from .models import (
+    DailySalesRollup, Product, ProductView, ProductViewRollup, VisitorSketch, day_start
+)
+
+SITE = 'site'
+
+
+def product_scope(product_id):
+    return f'product:{product_id}'
+
+
+def category_scope(category_id):
+    return f'category:{category_id}'
+
+
+def visitor_key(user_id, ip_address):
+    return f'user:{user_id}' if user_id else f'ip:{ip_address}'
+
+
+def _sketches(views, categories):
+    """{(scope, day): HyperLogLog} for views; categories: {product_id: category_id}"""
+    sketches = {}
+    for view in views:
+        day = timezone.localtime(view.viewed_at).date()
+        visitor = visitor_key(view.user_id, view.ip_address)
+        scopes = (
+            product_scope(view.product_id),
+            category_scope(categories[view.product_id]),
+            SITE,
+        )
+        for scope in scopes:
+            sketch = sketches.get((scope, day))
+            if sketch is None:
+                sketch = sketches[(scope, day)] = HyperLogLog()
+            sketch.add(visitor)
+    return sketches
+
+
+@transaction.atomic
+def record(views, categories):
+    """Add the visitors of views to the stored sketches"""
+    sketches = _sketches(views, categories)
+    if not sketches:
+        return
+    # Create missing rows first, so concurrent flushes wait on the same row
+    # locks instead of racing to insert
+    empty = HyperLogLog().to_bytes()
+    VisitorSketch.objects.bulk_create([
+        VisitorSketch(scope=scope, day=day, sketch=empty) for scope, day in sketches
+    ], ignore_conflicts=True)
+    rows = VisitorSketch.objects.select_for_update().filter(
+        scope__in={scope for scope, _ in sketches},
+        day__in={day for _, day in sketches}
+    )
+    now = timezone.now()
+    changed = []
+    for row in rows:
+        sketch = sketches.get((row.scope, row.day))
+        if sketch is None:
+            continue
+        row.sketch = HyperLogLog.from_bytes(row.sketch).merge(sketch).to_bytes()
+        row.updated_at = now
+        changed.append(row)
+    VisitorSketch.objects.bulk_update(changed, ['sketch', 'updated_at'], batch_size=500)
+
+
+def rebuild(start, end):
+    """Recompute the sketches of days start..end from the raw views still retained"""
+    categories = dict(Product.objects.values_list('id', 'category_id'))
+    day = start
+    while day <= end:
+        with transaction.atomic():
+            VisitorSketch.objects.filter(day=day).delete()
+            views = ProductView.objects.filter(
+                viewed_at__gte=day_start(day),
+                viewed_at__lt=day_start(day + timedelta(days=1))
+            ).only('product_id', 'user_id', 'ip_address', 'viewed_at')
+            record(views.iterator(chunk_size=5000), categories)
+        day += timedelta(days=1)
+
+
+def scopes_for(product_ids=None, category_ids=None):
+    if product_ids:
+        return [product_scope(pk) for pk in product_ids]
+    if category_ids:
+        return [category_scope(pk) for pk in category_ids]
+    return [SITE]
+
+
+def unique_visitors(scopes, start, end):
+    """
+    Estimated distinct visitors to any of scopes over days start..end,
+    and per day: (total, {day: estimate})
+    """
+    total = HyperLogLog()
+    daily = {}
+    rows = VisitorSketch.objects.filter(
+        scope__in=scopes, day__range=(start, end)
+    ).values_list('day', 'sketch')
+    for day, data in rows:
+        sketch = HyperLogLog.from_bytes(data)
+        total.merge(sketch)
+        daily.setdefault(day, HyperLogLog()).merge(sketch)
+    return total.count(), {day: sketch.count() for day, sketch in sorted(daily.items())}
+
+
+def report(start, end, product_ids=None, category_ids=None):
+    """Unique visitors, views, purchases and view-to-purchase conversion"""
+    visitors, daily = unique_visitors(scopes_for(product_ids, category_ids), start, end)
+    views = ProductViewRollup.objects.filter(
+        granularity=ProductViewRollup.DAY,
+        period__gte=day_start(start), period__lt=day_start(end + timedelta(days=1))
+    )
+    sales = DailySalesRollup.objects.filter(day__range=(start, end))
+    if product_ids:
+        views = views.filter(product_id__in=product_ids)
+        sales = sales.filter(product_id__in=product_ids)
+    elif category_ids:
+        views = views.filter(product__category_id__in=category_ids)
+        sales = sales.filter(category_id__in=category_ids)
+    # Completed orders per product: an order of two products counts twice
+    # across a category or the site
+    purchases = sales.aggregate(total=Sum('orders'))['total'] or 0
+    return {
+        'from': start,
+        'to': end,
+        'unique_visitors': visitors,
+        'views': views.aggregate(total=Sum('views'))['total'] or 0,
+        'purchases': purchases,
+        'conversion_rate': round(purchases / visitors, 4) if visitors else None,
+        'daily': [
+            {'date': day, 'unique_visitors': estimate} for day, estimate in daily.items()
+        ],
+    }
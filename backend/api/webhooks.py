@@ -0,0 +1,196 @@
+"""
+Stripe webhook inbox.
+
+The webhook view only verifies the signature and appends the event to the
+WebhookEvent table, deduplicated by Stripe event id, so acknowledgements stay
+fast whatever the backlog. `manage.py process_webhook_events` drains the inbox
+in batches, applying every payment outcome in a batch with a handful of bulk
+queries. Full refunds (charge.refunded) refund their order, which gives the
+stock back and takes the order out of the sales figures.
+"""
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, Max, Min
+from django.utils import timezone
+from .models import Order, WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_SUCCEEDED = 'payment_intent.succeeded'
+PAYMENT_FAILED = 'payment_intent.payment_failed'
+CHARGE_REFUNDED = 'charge.refunded'
+
+
+def record_event(event):
+    """Store a verified event. Returns False if it was already received."""
+    _, created = WebhookEvent.objects.get_or_create(
+        event_id=event['id'],
+        defaults={'type': event['type'], 'payload': event}
+    )
+    return created
+
+
+def _order_id(event):
+    metadata = event.payload.get('data', {}).get('object', {}).get('metadata') or {}
+    try:
+        return int(metadata.get('order_id'))
+    except (TypeError, ValueError):
+        return None
+
+
+def apply_events(events):
+    """
+    Apply payment events to their orders in bulk.
+    Returns {event id: error message} for events that could not be applied.
+    """
+    succeeded = {}
+    failed = {}
+    refunded = {}
+    errors = {}
+    for event in events:
+        if event.type == CHARGE_REFUNDED:
+            charge = event.payload.get('data', {}).get('object', {})
+            # Partial refunds leave the order as it is
+            if charge.get('refunded'):
+                if charge.get('payment_intent'):
+                    refunded.setdefault(charge['payment_intent'], []).append(event.pk)
+                else:
+                    errors[event.pk] = 'Charge has no payment_intent'
+            continue
+        order_id = _order_id(event)
+        if event.type not in (PAYMENT_SUCCEEDED, PAYMENT_FAILED):
+            continue
+        if order_id is None:
+            errors[event.pk] = 'Event has no order_id metadata'
+            continue
+        target = succeeded if event.type == PAYMENT_SUCCEEDED else failed
+        target.setdefault(order_id, []).append(event.pk)
+
+    existing = set(Order.objects.filter(
+        id__in=[*succeeded, *failed]
+    ).values_list('id', flat=True))
+    for orders in (succeeded, failed):
+        for order_id in list(orders):
+            if order_id not in existing:
+                for event_id in orders.pop(order_id):
+                    errors[event_id] = f'Order {order_id} not found'
+
+    # A success for the same order wins over a failure in the same batch
+    for order_id in succeeded:
+        failed.pop(order_id, None)
+    if failed:
+        Order.release_payments(list(failed))
+    if succeeded:
+        Order.confirm_payments(list(succeeded))
+    if refunded:
+        # Refunds are rare, so orders are refunded one at a time
+        for order in Order.objects.filter(stripe_payment_intent__in=list(refunded)):
+            order.refund()
+            refunded.pop(order.stripe_payment_intent, None)
+        for payment_intent, event_ids in refunded.items():
+            for event_id in event_ids:
+                errors[event_id] = f'No order for payment intent {payment_intent}'
+    return errors
+
+
+def _mark(events, errors, retries, now):
+    """
+    errors: {pk: message} for events that can never be applied
+    retries: {pk: message} for events that failed on an exception
+    """
+    processed = [event.pk for event in events if event.pk not in errors and event.pk not in retries]
+    WebhookEvent.objects.filter(pk__in=processed).update(
+        status=WebhookEvent.STATUS_PROCESSED,
+        attempts=F('attempts') + 1,
+        error='',
+        processed_at=now
+    )
+    failed = [event for event in events if event.pk in errors or event.pk in retries]
+    for event in failed:
+        event.attempts += 1
+        event.processed_at = now
+        if event.pk in errors:
+            event.error = errors[event.pk]
+            event.status = WebhookEvent.STATUS_FAILED
+        else:
+            event.error = retries[event.pk]
+            if event.attempts >= settings.WEBHOOK_MAX_ATTEMPTS:
+                event.status = WebhookEvent.STATUS_FAILED
+    WebhookEvent.objects.bulk_update(
+        failed, ['attempts', 'error', 'processed_at', 'status']
+    )
+    return len(events) - len(retries)
+
+
+def process_batch(batch_size=100):
+    """
+    Process the oldest pending events.
+    Returns the number of events settled, i.e. not left pending for a retry.
+    If the batch cannot be applied as a whole, its events are applied one by
+    one so a single bad event does not hold up the others.
+    """
+    with transaction.atomic():
+        events = list(
+            WebhookEvent.objects.select_for_update(skip_locked=True).filter(
+                status=WebhookEvent.STATUS_PENDING
+            ).order_by('received_at', 'id')[:batch_size]
+        )
+        if not events:
+            return 0
+        retries = {}
+        try:
+            with transaction.atomic():
+                errors = apply_events(events)
+        except Exception:
+            logger.exception('Webhook batch failed, retrying events one by one')
+            errors = {}
+            for event in events:
+                try:
+                    with transaction.atomic():
+                        errors.update(apply_events([event]))
+                except Exception as e:
+                    logger.exception('Webhook event %s failed', event.event_id)
+                    retries[event.pk] = str(e) or e.__class__.__name__
+        return _mark(events, errors, retries, timezone.now())
+
+
+def process_pending(batch_size=100):
+    """
+    Drain the inbox. Returns the number of events settled.
+    Stops early when a whole batch is left for a retry, so a failing
+    database is not hammered in a tight loop.
+    """
+    total = 0
+    while True:
+        settled = process_batch(batch_size)
+        if not settled:
+            return total
+        total += settled
+
+
+def backlog_stats():
+    """Backlog depth, and processing lag over the last hour"""
+    now = timezone.now()
+    pending = WebhookEvent.objects.filter(status=WebhookEvent.STATUS_PENDING).aggregate(
+        depth=Count('id'), oldest=Min('received_at')
+    )
+    lag = ExpressionWrapper(F('processed_at') - F('received_at'), output_field=DurationField())
+    recent = WebhookEvent.objects.filter(
+        status=WebhookEvent.STATUS_PROCESSED, processed_at__gte=now - timedelta(hours=1)
+    ).aggregate(processed=Count('id'), average_lag=Avg(lag), max_lag=Max(lag))
+    return {
+        'backlog_depth': pending['depth'],
+        'oldest_pending_age': (
+            (now - pending['oldest']).total_seconds() if pending['oldest'] else 0
+        ),
+        'failed': WebhookEvent.objects.filter(status=WebhookEvent.STATUS_FAILED).count(),
+        'processed_last_hour': recent['processed'],
+        'average_lag': _seconds(recent['average_lag']),
+        'max_lag': _seconds(recent['max_lag']),
+    }
+
+
+def _seconds(value):
+    return value.total_seconds() if value is not None else None
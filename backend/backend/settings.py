@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 from dotenv import load_dotenv
 from datetime import timedelta
@@ -106,13 +107,30 @@ DATABASES = {
 }
 
 # Cache settings
+# A SQLite file shared by every worker process on the host, with a small
+# per-process LRU in front of it (see api/cache_backends.py)
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
+        'BACKEND': 'api.cache_backends.TieredCache',
+        'LOCATION': os.getenv(
+            'CACHE_LOCATION',
+            os.path.join(tempfile.gettempdir(), 'ecommerce-cache.sqlite3')
+        ),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 20000)),
+            'MAX_SIZE': int(os.getenv('CACHE_MAX_SIZE', 64 * 1024 * 1024)),
+            'LOCAL_MAX_ENTRIES': 1000,
+            'LOCAL_TIMEOUT': 2,
+        },
     }
 }
 
+# Cached API responses are invalidated by tag on writes, so they can live long
+RESPONSE_CACHE_TIMEOUT = int(os.getenv('RESPONSE_CACHE_TIMEOUT', 60 * 60 * 6))
+
+# Lower edges of the price buckets reported by /api/products/facets/
+FACET_PRICE_BUCKETS = [0, 25, 50, 100, 200]
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -151,6 +169,11 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Product image variants are rendered in a process pool after upload;
+# set IMAGE_DERIVATIVES_ASYNC=False to render them in the request instead
+IMAGE_DERIVATIVES_ASYNC = os.getenv('IMAGE_DERIVATIVES_ASYNC', 'True') == 'True'
+IMAGE_DERIVATIVE_WORKERS = int(os.getenv('IMAGE_DERIVATIVE_WORKERS', 2))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -214,5 +237,67 @@ STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
 
+# Payment gateway used for checkout: 'stripe', or 'fake' to answer in-process
+# without network access (local development and load tests only)
+PAYMENT_GATEWAY = os.getenv('PAYMENT_GATEWAY', 'stripe')
+PAYMENT_CONNECT_TIMEOUT = float(os.getenv('PAYMENT_CONNECT_TIMEOUT', 3.05))
+PAYMENT_READ_TIMEOUT = float(os.getenv('PAYMENT_READ_TIMEOUT', 10))
+PAYMENT_POOL_SIZE = int(os.getenv('PAYMENT_POOL_SIZE', 10))
+PAYMENT_MAX_RETRIES = int(os.getenv('PAYMENT_MAX_RETRIES', 0))
+# Mean latency in seconds and share of declined payments of the fake gateway
+PAYMENT_FAKE_LATENCY = float(os.getenv('PAYMENT_FAKE_LATENCY', 0.05))
+PAYMENT_FAKE_FAILURE_RATE = float(os.getenv('PAYMENT_FAKE_FAILURE_RATE', 0))
+
+# Seconds stock stays reserved for an unpaid order before
+# `manage.py release_expired_reservations` gives it back
+STOCK_RESERVATION_TTL = int(os.getenv('STOCK_RESERVATION_TTL', 15 * 60))
+
+# How long responses to requests sent with an Idempotency-Key are replayed
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+# Seconds a key stays claimed by a request that has not finished, after which
+# a retry may run it again (covers workers that died mid-request)
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', 60))
+
+# Attempts `manage.py process_webhook_events` makes before giving up on an event
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 5))
+
+# Days before the latest analytics snapshot that `manage.py materialize_analytics`
+# recomputes, to pick up payments completed after the order day
+ANALYTICS_RECOMPUTE_DAYS = int(os.getenv('ANALYTICS_RECOMPUTE_DAYS', 2))
+
+# Product views are buffered in each process and written in bulk
+PRODUCT_VIEW_FLUSH_SIZE = int(os.getenv('PRODUCT_VIEW_FLUSH_SIZE', 500))
+PRODUCT_VIEW_FLUSH_INTERVAL = float(os.getenv('PRODUCT_VIEW_FLUSH_INTERVAL', 5))
+# Seconds during which repeat views of a product by the same visitor are ignored
+PRODUCT_VIEW_DEDUP_WINDOW = int(os.getenv('PRODUCT_VIEW_DEDUP_WINDOW', 30 * 60))
+# Views held in memory before new ones are dropped
+PRODUCT_VIEW_BUFFER_LIMIT = int(os.getenv('PRODUCT_VIEW_BUFFER_LIMIT', 50000))
+# Serverless functions (Vercel sets VERCEL=1) are frozen between requests and
+# discarded without running exit handlers, so there views are written before
+# each response instead of by a background thread
+PRODUCT_VIEW_FLUSH_ON_REQUEST = os.getenv(
+    'PRODUCT_VIEW_FLUSH_ON_REQUEST', str(bool(os.getenv('VERCEL')))
+) == 'True'
+
+# Raw product views and hourly view rollups are deleted by
+# `manage.py rollup_product_views` after these many days; daily rollups are kept
+PRODUCT_VIEW_RETENTION_DAYS = int(os.getenv('PRODUCT_VIEW_RETENTION_DAYS', 30))
+PRODUCT_VIEW_HOURLY_RETENTION_DAYS = int(os.getenv('PRODUCT_VIEW_HOURLY_RETENTION_DAYS', 14))
+PRODUCT_VIEW_PRUNE_BATCH_SIZE = int(os.getenv('PRODUCT_VIEW_PRUNE_BATCH_SIZE', 5000))
+# Hours before the latest hourly rollup that are recomputed, to count views written late
+PRODUCT_VIEW_ROLLUP_RECOMPUTE_HOURS = int(os.getenv('PRODUCT_VIEW_ROLLUP_RECOMPUTE_HOURS', 2))
+
+# Seconds between full reloads of the order columns behind the sales reports
+# (incremental refreshes in between pick up changed orders, not deleted ones)
+REPORTS_FULL_RELOAD_INTERVAL = int(os.getenv('REPORTS_FULL_RELOAD_INTERVAL', 60 * 60))
+
+# Co-purchase recommendations: pairs bought together in fewer orders, or no
+# more often than chance (lift), are not recommended
+RECOMMENDATION_MIN_SUPPORT = int(os.getenv('RECOMMENDATION_MIN_SUPPORT', 2))
+RECOMMENDATION_MIN_LIFT = float(os.getenv('RECOMMENDATION_MIN_LIFT', 1.0))
+RECOMMENDATION_NEIGHBOURS = int(os.getenv('RECOMMENDATION_NEIGHBOURS', 10))
+# Products of larger orders are not paired, to bound the pairs per order
+RECOMMENDATION_MAX_BASKET = int(os.getenv('RECOMMENDATION_MAX_BASKET', 50))
+
 # Custom user model
 AUTH_USER_MODEL = 'api.User'